@@ -0,0 +1,290 @@
+import os
+import glob
+import json
+import time
+import argparse
+import calendar
+from datetime import datetime, date, timedelta
+import numpy as np
+from sqlalchemy import select
+from models import db, QuestionLog, Question
+
+# 答题日志的列式快照 (按 QuestionLog.id 增量导出)，供 /api/analytics/* 做向量化统计
+#
+# 目录结构 (默认 instance/analytics，可用 ANALYTICS_DIR 覆盖)：
+#   <列名>.bin     定长二进制列，只追加；读取时按 meta.rows 做 np.memmap
+#   q_tag_ptr.<代>.npy  题目 -> 标签的 CSR 表 (每次导出按当前题库重建，文件名带代号 generation)
+#   q_tag_ids.<代>.npy
+#   meta.json      行数、已导出的最大日志 ID、当前代号，以及用户/题目/标签的字符串驻留表 (编码只增不改)
+# 导出时先追加列、写好新一代的 CSR 文件，最后原子替换 meta.json 切换过去：
+# 读者只看 meta 记录的行数和代号，不会读到半批数据，也不会把旧 meta 和新 CSR 拼在一起。
+# 上一代的 CSR 文件保留到下一次导出，给刚读了旧 meta 的读者用。
+
+COLUMNS = {
+    "log_id": np.int64,
+    "user": np.int32,
+    "question": np.int32,
+    "correct": np.int8,
+    "ts": np.int64,       # 作答时刻：本地时间按 UTC 换算的秒数，// DAY、% DAY 直接得到本地日期/钟点
+    "duration": np.int32,
+}
+DAY = 24 * 3600
+EPOCH = date(1970, 1, 1)
+
+def snapshot_dir(app):
+    return app.config.get('ANALYTICS_DIR') or os.path.join(app.instance_path, 'analytics')
+
+def _meta_path(path):
+    return os.path.join(path, 'meta.json')
+
+def _read_meta(path):
+    try:
+        with open(_meta_path(path), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _tag_files(generation):
+    """某一代的 CSR 文件名 (没有代号的是旧版导出)"""
+    suffix = f'.{generation}' if generation else ''
+    return f'q_tag_ptr{suffix}.npy', f'q_tag_ids{suffix}.npy'
+
+def _replace(path, name, writer):
+    """先写临时文件再原子替换，读者看到的要么是旧文件要么是新文件"""
+    tmp = os.path.join(path, name + '.tmp')
+    with open(tmp, 'wb') as f:
+        writer(f)
+    os.replace(tmp, os.path.join(path, name))
+
+def local_ts(dt):
+    return calendar.timegm(dt.timetuple())
+
+# ================= 导出 =================
+
+def export(path, batch_size=50000):
+    """把 id 大于上次导出位置的 QuestionLog 追加到快照，返回本次追加的行数"""
+    start = time.time()
+    os.makedirs(path, exist_ok=True)
+    meta = _read_meta(path) or {"rows": 0, "last_log_id": 0, "users": [], "questions": [], "tags": []}
+
+    # 上次导出中途失败时，列文件可能比 meta 记录的长，先截断
+    for name, dtype in COLUMNS.items():
+        file = os.path.join(path, name + '.bin')
+        size = meta['rows'] * np.dtype(dtype).itemsize
+        if os.path.exists(file) and os.path.getsize(file) > size:
+            with open(file, 'r+b') as f:
+                f.truncate(size)
+
+    users = {u: i for i, u in enumerate(meta['users'])}
+    questions = {q: i for i, q in enumerate(meta['questions'])}
+    buffers = {name: [] for name in COLUMNS}
+    appended, last_id = 0, meta['last_log_id']
+
+    def flush():
+        for name, dtype in COLUMNS.items():
+            with open(os.path.join(path, name + '.bin'), 'ab') as f:
+                f.write(np.asarray(buffers[name], dtype=dtype).tobytes())
+            buffers[name].clear()
+
+    stmt = select(
+        QuestionLog.id, QuestionLog.user_id, QuestionLog.question_id, QuestionLog.is_correct,
+        QuestionLog.created_at, QuestionLog.duration_ms
+    ).where(QuestionLog.id > meta['last_log_id']).order_by(QuestionLog.id).execution_options(yield_per=batch_size)
+    for log_id, uid, qid, is_correct, created_at, duration in db.session.execute(stmt):
+        buffers["log_id"].append(log_id)
+        buffers["user"].append(users.setdefault(uid, len(users)))
+        buffers["question"].append(questions.setdefault(qid, len(questions)))
+        buffers["correct"].append(1 if is_correct else 0)
+        buffers["ts"].append(local_ts(created_at) if created_at else 0)
+        buffers["duration"].append(duration or 0)
+        appended += 1
+        last_id = log_id
+        if len(buffers["log_id"]) >= batch_size:
+            flush()
+    flush()
+
+    # 题目 -> 标签 (CSR)：标签可能被改过，每次按题库当前值重建，标签编码只追加
+    tag_codes = {t: i for i, t in enumerate(meta['tags'])}
+    tags_by_question = dict(db.session.query(Question.id, Question.tags).all())
+    ptr, ids = [0], []
+    for qid in questions:
+        for tag in tags_by_question.get(qid) or []:
+            ids.append(tag_codes.setdefault(tag, len(tag_codes)))
+        ptr.append(len(ids))
+    previous = meta.get('generation', 0)
+    generation = previous + 1
+    ptr_file, ids_file = _tag_files(generation)
+    _replace(path, ptr_file, lambda f: np.save(f, np.asarray(ptr, dtype=np.int64)))
+    _replace(path, ids_file, lambda f: np.save(f, np.asarray(ids, dtype=np.int32)))
+
+    meta.update(
+        rows=meta['rows'] + appended, last_log_id=last_id, generation=generation,
+        users=list(users), questions=list(questions), tags=list(tag_codes),
+        exported_at=datetime.now().isoformat(timespec='seconds')
+    )
+    _replace(path, 'meta.json', lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode('utf-8')))
+
+    # 切换完成后清理更早的 CSR 文件 (保留当前和上一代)
+    keep = set(_tag_files(generation) + _tag_files(previous))
+    for file in glob.glob(os.path.join(path, 'q_tag_*.npy')):
+        if os.path.basename(file) not in keep:
+            os.remove(file)
+    print(f"✅ Exported {appended} logs (total {meta['rows']}, last id {last_id}) in {time.time() - start:.1f}s")
+    return appended
+
+# ================= 读取 =================
+
+class Snapshot:
+    """只读快照：列以 memmap 打开，按用户的行索引首次使用时排序一次"""
+
+    def __init__(self, path, meta):
+        self.meta = meta
+        self.rows = meta['rows']
+        self.tags = meta['tags']
+        self.user_codes = {u: i for i, u in enumerate(meta['users'])}
+        self.cols = {}
+        for name, dtype in COLUMNS.items():
+            file = os.path.join(path, name + '.bin')
+            self.cols[name] = np.memmap(file, dtype=dtype, mode='r', shape=(self.rows,)) if self.rows else np.zeros(0, dtype=dtype)
+        ptr_file, ids_file = _tag_files(meta.get('generation', 0))
+        self.tag_ptr = np.load(os.path.join(path, ptr_file))
+        self.tag_ids = np.load(os.path.join(path, ids_file))
+        self._by_user = None
+
+    def user_rows(self, user_id, since_ts=None):
+        """某用户的行号 (按导出顺序，即日志 ID 递增)"""
+        code = self.user_codes.get(user_id)
+        if code is None: return np.zeros(0, dtype=np.int64)
+        if self._by_user is None:
+            order = np.argsort(self.cols["user"], kind='stable')
+            self._by_user = (order, np.asarray(self.cols["user"])[order])
+        order, sorted_users = self._by_user
+        rows = order[np.searchsorted(sorted_users, code, 'left'):np.searchsorted(sorted_users, code, 'right')]
+        if since_ts is not None:
+            rows = rows[self.cols["ts"][rows] >= since_ts]
+        return rows
+
+    def expand_tags(self, rows):
+        """把行展开成 (行, 标签) 对：返回与标签一一对应的行号数组和标签编码数组"""
+        q = self.cols["question"][rows]
+        starts = self.tag_ptr[q]
+        counts = self.tag_ptr[q + 1] - starts
+        total = int(counts.sum())
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(rows, counts), self.tag_ids[np.repeat(starts, counts) + offsets]
+
+_snapshots = {}
+
+def load_snapshot(path):
+    """按 meta.json 的修改时间缓存快照；还没导出过时返回 None"""
+    try:
+        mtime = os.path.getmtime(_meta_path(path))
+    except OSError:
+        return None
+    cached = _snapshots.get(path)
+    if cached and cached[0] == mtime: return cached[1]
+    meta = _read_meta(path)
+    if meta is None: return None
+    try:
+        snap = Snapshot(path, meta)
+    except FileNotFoundError:
+        # 读 meta 之后又完成了两次导出，这一代的 CSR 已被清理：重读最新的 meta
+        mtime = os.path.getmtime(_meta_path(path))
+        meta = _read_meta(path)
+        snap = Snapshot(path, meta)
+    _snapshots[path] = (mtime, snap)
+    return snap
+
+# ================= 报表 (全部向量化) =================
+
+def _since(days):
+    return local_ts(datetime.now()) - days * DAY if days else None
+
+def tag_accuracy(snap, user_id, days=90, bucket_days=7, top=8):
+    """各标签按时间段的正确率：取答题次数最多的 top 个标签，每 bucket_days 天一个点"""
+    rows = snap.user_rows(user_id, _since(days))
+    if len(rows) == 0: return []
+    tag_rows, tag_ids = snap.expand_tags(rows)
+    correct = snap.cols["correct"][tag_rows].astype(np.int64)
+    bucket = snap.cols["ts"][tag_rows] // (bucket_days * DAY)
+
+    attempts_by_tag = np.bincount(tag_ids, minlength=len(snap.tags))
+    top_tags = np.argsort(-attempts_by_tag, kind='stable')[:top]
+    top_tags = top_tags[attempts_by_tag[top_tags] > 0]
+
+    keep = np.isin(tag_ids, top_tags)
+    keys = np.stack([tag_ids[keep], bucket[keep]], axis=1)
+    uniq, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    attempts = np.bincount(inverse)
+    hits = np.bincount(inverse, weights=correct[keep])
+
+    series = {int(t): [] for t in top_tags}
+    for (tag, b), n, c in zip(uniq.tolist(), attempts.tolist(), hits.tolist()):
+        series[tag].append({
+            "period_start": (EPOCH + timedelta(days=b * bucket_days)).isoformat(),
+            "attempts": n, "accuracy": round(c / n, 3)
+        })
+    return [{"tag": snap.tags[t], "attempts": int(attempts_by_tag[t]), "points": series[int(t)]} for t in top_tags]
+
+def hour_heatmap(snap, user_id, days=None):
+    """星期 x 钟点 (7 x 24) 的答题次数与正确率；星期一为 0"""
+    rows = snap.user_rows(user_id, _since(days))
+    ts = snap.cols["ts"][rows]
+    weekday = (ts // DAY + 3) % 7 # 1970-01-01 是星期四
+    hour = (ts % DAY) // 3600
+    cell = (weekday * 24 + hour).astype(np.int64)
+    attempts = np.bincount(cell, minlength=7 * 24)
+    hits = np.bincount(cell, weights=snap.cols["correct"][rows], minlength=7 * 24)
+    accuracy = np.divide(hits, attempts, out=np.zeros(7 * 24), where=attempts > 0)
+    return {
+        "attempts": attempts.reshape(7, 24).tolist(),
+        "accuracy": np.round(accuracy, 3).reshape(7, 24).tolist()
+    }
+
+def weak_tags(snap, user_id, days=None, min_attempts=5, limit=10):
+    """最薄弱的标签：按平滑正确率 (c+1)/(n+2) 升序，答题次数不足 min_attempts 的不参与"""
+    rows = snap.user_rows(user_id, _since(days))
+    if len(rows) == 0: return []
+    tag_rows, tag_ids = snap.expand_tags(rows)
+    attempts = np.bincount(tag_ids, minlength=len(snap.tags))
+    hits = np.bincount(tag_ids, weights=snap.cols["correct"][tag_rows], minlength=len(snap.tags))
+    score = (hits + 1) / (attempts + 2)
+    eligible = np.flatnonzero(attempts >= min_attempts)
+    ranked = eligible[np.argsort(score[eligible], kind='stable')][:limit]
+    return [{
+        "tag": snap.tags[t], "attempts": int(attempts[t]),
+        "accuracy": round(float(hits[t] / attempts[t]), 3), "score": round(float(score[t]), 3)
+    } for t in ranked]
+
+RESPONSE_BINS_MS = [0, 2000, 5000, 10000, 20000, 30000, 60000, 120000, 300000]
+
+def response_times(snap, user_id, days=None):
+    """作答用时分布 (只统计记录了用时的作答)：分段直方图 + 分位数，按答对/答错分开"""
+    rows = snap.user_rows(user_id, _since(days))
+    duration = snap.cols["duration"][rows]
+    correct = snap.cols["correct"][rows].astype(bool)
+    timed = duration > 0
+    bins = np.asarray(RESPONSE_BINS_MS + [np.iinfo(np.int32).max])
+
+    def summary(mask):
+        values = duration[timed & mask]
+        if len(values) == 0: return {"count": 0, "histogram": [0] * (len(bins) - 1), "p50": None, "p90": None}
+        p50, p90 = np.percentile(values, [50, 90])
+        return {"count": int(len(values)), "histogram": np.histogram(values, bins=bins)[0].tolist(),
+                "p50": int(p50), "p90": int(p90)}
+
+    return {
+        "bins_ms": RESPONSE_BINS_MS,
+        "all": summary(np.ones(len(rows), dtype=bool)),
+        "correct": summary(correct),
+        "wrong": summary(~correct)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export QuestionLog into the columnar analytics snapshot (incremental)")
+    parser.add_argument('--batch-size', type=int, default=50000, help="rows per fetch/append batch")
+    args = parser.parse_args()
+    from app import app
+    with app.app_context():
+        export(snapshot_dir(app), args.batch_size)
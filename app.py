@@ -6,6 +6,9 @@ from flask import Flask, render_template, jsonify, request, redirect, url_for, f
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_wtf.csrf import CSRFProtect
 from question_service import service
+from log_buffer import log_buffer
+from sqlite_profile import sqlite_profile
+import analytics
 from models import db, User, InvitationCode
 from config import Config
 from werkzeug.utils import secure_filename # <--- [新增]
@@ -13,19 +16,12 @@ from werkzeug.utils import secure_filename # <--- [新增]
 app = Flask(__name__)
 app.config.from_object(Config)
 
-# --- [关键修改] 数据库路径重定向到 instance 文件夹 ---
-# 1. 确保 instance 文件夹存在
-try:
-    os.makedirs(app.instance_path)
-except OSError:
-    pass
-
-# 2. 重新设置数据库 URI，指向 instance/physics.db
-# app.instance_path 会自动指向项目根目录下的 instance 文件夹
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.instance_path, 'physics.db')
-# --------------------------------------------------
+# --- 数据库地址取自 Config (DATABASE_URL，默认 instance/physics.db)，SQLite 文件放在 instance 文件夹 ---
+os.makedirs(app.instance_path, exist_ok=True)
 
 db.init_app(app)
+sqlite_profile.init_app(app, db)
+log_buffer.init_app(app)
 csrf = CSRFProtect(app)
 
 login_manager = LoginManager()
@@ -168,6 +164,34 @@ def api_question_copy():
         return jsonify({"success": True})
     return jsonify({"success": False, "msg": "Failed to copy"})
 
+def _bulk_q_ids(d):
+    q_ids = d.get('q_ids') or []
+    return [str(q) for q in q_ids] if isinstance(q_ids, list) else []
+
+@app.route('/api/questions/bulk_move', methods=['POST'])
+@login_required
+def api_questions_bulk_move():
+    d = request.json
+    count = service.move_questions(_bulk_q_ids(d), d.get('from_book'), d.get('to_book'))
+    if count is not None: return jsonify({"success": True, "count": count})
+    return jsonify({"success": False, "msg": "Failed to move"})
+
+@app.route('/api/questions/bulk_copy', methods=['POST'])
+@login_required
+def api_questions_bulk_copy():
+    d = request.json
+    count = service.copy_questions(_bulk_q_ids(d), d.get('to_book'))
+    if count is not None: return jsonify({"success": True, "count": count})
+    return jsonify({"success": False, "msg": "Failed to copy"})
+
+@app.route('/api/questions/bulk_remove', methods=['POST'])
+@login_required
+def api_questions_bulk_remove():
+    d = request.json
+    count = service.remove_questions(d.get('book_id'), _bulk_q_ids(d))
+    if count is not None: return jsonify({"success": True, "count": count})
+    return jsonify({"success": False})
+
 # 确认 update_tags 路由存在 (原文件中已有，无需修改，确保没删即可)
 # @app.route('/api/question/update_tags', methods=['POST']) ...
 @app.route('/logout')
@@ -182,9 +206,13 @@ def logout():
 @login_required
 @admin_required
 def admin_dashboard():
-    users = User.query.all()
+    search = request.args.get('q', '').strip()
+    after = request.args.get('after') or None
+    page = service.get_admin_users(search or None, after)
+    trend = service.get_activity_trend(30)
     codes = InvitationCode.query.filter_by(is_used=False).all()
-    return render_template('admin.html', user=current_user, users=users, codes=codes)
+    return render_template('admin.html', user=current_user, users=page['items'], next_after=page['next_after'],
+                           search=search, after=after, trend=trend, total_users=User.query.count(), codes=codes)
 
 @app.route('/admin/generate_code', methods=['POST'])
 @login_required
@@ -208,6 +236,24 @@ def admin_toggle_user(user_id):
         return jsonify({"success": True, "status": user.is_active})
     return jsonify({"success": False})
 
+@app.route('/admin/cache_stats')
+@login_required
+@admin_required
+def admin_cache_stats():
+    return jsonify({"question_cache": service.question_cache.stats()})
+
+@app.route('/admin/log_buffer_stats')
+@login_required
+@admin_required
+def admin_log_buffer_stats():
+    return jsonify(log_buffer.stats())
+
+@app.route('/admin/db_stats')
+@login_required
+@admin_required
+def admin_db_stats():
+    return jsonify(sqlite_profile.stats())
+
 # ================== 业务路由 (保持不变) ==================
 
 def render_page(template_name, **kwargs):
@@ -244,6 +290,12 @@ def api_get_question():
     mode = request.args.get('mode', 'training')
     book = request.args.get('book')
     q_id = request.args.get('q_id')
+    count = request.args.get('count', type=int)
+    # [NEW] count: 批量返回接下来的若干题，供前端预取队列使用
+    if count and not q_id:
+        questions = service.get_questions(mode=mode, count=max(1, min(count, 20)), book_id=book)
+        if not questions: return jsonify({"error": "No questions available", "code": 404}), 404
+        return jsonify({"questions": questions})
     question = service.get_question(mode=mode, q_id=q_id, book_id=book)
     if not question:
         if mode == 'mistake': return jsonify({"error": "Book empty!", "code": 404}), 404
@@ -331,6 +383,22 @@ def api_submit():
     result = service.check_answer(data['q_id'], data['choice'])
     return jsonify(result)
 
+@app.route('/api/submit_batch', methods=['POST'])
+@login_required
+def api_submit_batch():
+    # [NEW] 离线/缓冲答题批量同步：{"answers": [{q_id, choice, answered_at, duration_ms}, ...]}
+    data = request.json
+    answers = data.get('answers') if isinstance(data, dict) else data
+    if not isinstance(answers, list):
+        return jsonify({"success": False, "msg": "answers must be a list"}), 400
+    result = service.submit_batch(answers)
+    return jsonify(result), 413 if result.get('too_large') else 200
+
+@app.route('/api/due_forecast', methods=['GET'])
+@login_required
+def api_due_forecast():
+    return jsonify(service.get_due_forecast() or {"due_count": 0, "forecast": [], "computed_at": None})
+
 @app.route('/api/create_book', methods=['POST'])
 @login_required
 def api_create_book():
@@ -362,8 +430,9 @@ def api_notes_create():
 @login_required
 def api_notes_save():
     d = request.json
-    if service.save_note_content(d.get('id'), d.get('content')): return jsonify({"success": True})
-    return jsonify({"success": False})
+    result = service.save_note_content(d.get('id'), d.get('content'), d.get('base_version'), d.get('patch'))
+    if result.get('conflict'): return jsonify(result), 409
+    return jsonify(result)
 
 @app.route('/api/notes/rename', methods=['POST'])
 @login_required
@@ -402,7 +471,9 @@ def api_notes_sort():
 @app.route('/api/notes/search', methods=['GET'])
 @login_required
 def api_notes_search():
-    return jsonify(service.search_notes(request.args.get('q', '')))
+    page = request.args.get('page', 1, type=int)
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), 50)
+    return jsonify(service.search_notes(request.args.get('q', ''), page, per_page))
 
 @app.route('/api/notes/info', methods=['GET'])
 @login_required
@@ -457,6 +528,38 @@ def api_update_profile():
         return jsonify({"success": True})
     return jsonify({"success": False, "msg": "Empty nickname"})
 
+# ================== [NEW] 学习分析 API (读 analytics.py 导出的列式快照) ==================
+
+def analytics_report(build):
+    snap = analytics.load_snapshot(analytics.snapshot_dir(app))
+    if snap is None: return jsonify({"error": "Analytics snapshot not exported yet", "code": 404}), 404
+    days = request.args.get('days', type=int)
+    return jsonify({"exported_at": snap.meta.get('exported_at'), "data": build(snap, days if days and days > 0 else None)})
+
+@app.route('/api/analytics/tag_accuracy', methods=['GET'])
+@login_required
+def api_analytics_tag_accuracy():
+    bucket_days = min(max(request.args.get('bucket_days', 7, type=int), 1), 90)
+    top = min(max(request.args.get('top', 8, type=int), 1), 30)
+    return analytics_report(lambda snap, days: analytics.tag_accuracy(snap, current_user.id, days or 90, bucket_days, top))
+
+@app.route('/api/analytics/heatmap', methods=['GET'])
+@login_required
+def api_analytics_heatmap():
+    return analytics_report(lambda snap, days: analytics.hour_heatmap(snap, current_user.id, days))
+
+@app.route('/api/analytics/weak_tags', methods=['GET'])
+@login_required
+def api_analytics_weak_tags():
+    min_attempts = max(request.args.get('min_attempts', 5, type=int), 1)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return analytics_report(lambda snap, days: analytics.weak_tags(snap, current_user.id, days, min_attempts, limit))
+
+@app.route('/api/analytics/response_times', methods=['GET'])
+@login_required
+def api_analytics_response_times():
+    return analytics_report(lambda snap, days: analytics.response_times(snap, current_user.id, days))
+
 
 
 if __name__ == '__main__':
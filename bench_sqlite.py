@@ -0,0 +1,107 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+from multiprocessing import Pool
+import numpy as np
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from config import Config
+import sqlite_profile
+
+# SQLite 配置压测：模拟 gunicorn 多 worker 共用一个数据库文件，
+# 每个进程循环执行“读” (按用户取进度) 或“写” (先读进度再 UPSERT + 追加日志，同 check_answer 的读后写模式)，
+# 逐项打开 sqlite_profile 的各个设置，对比吞吐、延迟和 database is locked 错误数。
+# 用法: python bench_sqlite.py [--workers 4] [--seconds 5] [--write-ratio 0.3]
+
+BASE = {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL"} # SQLite/pysqlite 默认 (pysqlite 自带 5 秒忙等待)
+TUNED = {k: getattr(Config, k) for k in ("SQLITE_BUSY_TIMEOUT_MS", "SQLITE_MMAP_SIZE", "SQLITE_CACHE_SIZE_KB")}
+# (名称, PRAGMA, 只读连接池, BEGIN IMMEDIATE)，逐项叠加
+PROFILES = [
+    ("default (rollback journal)", BASE, False, False),
+    ("+ WAL", dict(BASE, SQLITE_JOURNAL_MODE="WAL"), False, False),
+    ("+ synchronous=NORMAL", dict(BASE, SQLITE_JOURNAL_MODE="WAL", SQLITE_SYNCHRONOUS="NORMAL"), False, False),
+    ("+ busy_timeout/mmap/cache", dict(TUNED, SQLITE_JOURNAL_MODE="WAL", SQLITE_SYNCHRONOUS="NORMAL"), False, False),
+    ("+ read-only pool", dict(TUNED, SQLITE_JOURNAL_MODE="WAL", SQLITE_SYNCHRONOUS="NORMAL"), True, False),
+    ("+ BEGIN IMMEDIATE writes", dict(TUNED, SQLITE_JOURNAL_MODE="WAL", SQLITE_SYNCHRONOUS="NORMAL"), True, True),
+]
+USERS = 200
+QUESTIONS = 500
+
+def setup(path):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE progress (user_id INTEGER, question_id INTEGER, attempts INTEGER, "
+                             "PRIMARY KEY (user_id, question_id))")
+        conn.exec_driver_sql("CREATE TABLE logs (id INTEGER PRIMARY KEY, user_id INTEGER, question_id INTEGER, "
+                             "is_correct INTEGER, created_at REAL)")
+        conn.execute(text("INSERT INTO progress VALUES (:u, :q, 1)"),
+                     [{"u": u, "q": q} for u in range(USERS) for q in range(0, QUESTIONS, 10)])
+    engine.dispose()
+
+def worker(args):
+    path, settings, read_pool, immediate, seconds, write_ratio, seed = args
+    state = {"reading": False}
+    engine = create_engine(f"sqlite:///{path}")
+    sqlite_profile.install(engine, settings, immediate=immediate, is_read=lambda: state["reading"])
+    reader = engine
+    if read_pool:
+        reader = create_engine(f"sqlite:///{path}")
+        sqlite_profile.install(reader, settings, read_only=True)
+
+    rnd = random.Random(seed)
+    reads = writes = errors = 0
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user, question = rnd.randrange(USERS), rnd.randrange(QUESTIONS)
+        start = time.perf_counter()
+        try:
+            if rnd.random() < write_ratio:
+                with engine.begin() as conn:
+                    conn.execute(text("SELECT attempts FROM progress WHERE user_id = :u AND question_id = :q"),
+                                 {"u": user, "q": question}).first()
+                    conn.execute(text("INSERT INTO progress VALUES (:u, :q, 1) ON CONFLICT (user_id, question_id) "
+                                      "DO UPDATE SET attempts = attempts + 1"), {"u": user, "q": question})
+                    conn.execute(text("INSERT INTO logs (user_id, question_id, is_correct, created_at) VALUES (:u, :q, 1, :t)"),
+                                 {"u": user, "q": question, "t": time.time()})
+                writes += 1
+            else:
+                state["reading"] = True
+                with reader.begin() as conn:
+                    conn.execute(text("SELECT question_id, attempts FROM progress WHERE user_id = :u"), {"u": user}).all()
+                    conn.execute(text("SELECT count(*) FROM logs WHERE user_id = :u"), {"u": user}).scalar()
+                state["reading"] = False
+                reads += 1
+            latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            state["reading"] = False
+            errors += 1
+    engine.dispose()
+    if reader is not engine: reader.dispose()
+    return reads, writes, errors, latencies
+
+def run(workers, seconds, write_ratio):
+    print(f"{'profile':<28}{'ops/s':>10}{'writes/s':>10}{'errors':>8}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, settings, read_pool, immediate in PROFILES:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            setup(path)
+            jobs = [(path, settings, read_pool, immediate, seconds, write_ratio, i) for i in range(workers)]
+            with Pool(workers) as pool:
+                results = pool.map(worker, jobs)
+        reads = sum(r[0] for r in results)
+        writes = sum(r[1] for r in results)
+        errors = sum(r[2] for r in results)
+        latencies = np.concatenate([np.asarray(r[3]) for r in results]) * 1000 if reads + writes else np.zeros(1)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{name:<28}{(reads + writes) / seconds:>10.0f}{writes / seconds:>10.0f}{errors:>8}{p50:>9.2f}{p99:>9.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite connection profile settings")
+    parser.add_argument('--workers', type=int, default=4, help="concurrent processes (like gunicorn -w)")
+    parser.add_argument('--seconds', type=float, default=5, help="duration per profile")
+    parser.add_argument('--write-ratio', type=float, default=0.3, help="fraction of operations that write")
+    args = parser.parse_args()
+    run(args.workers, args.seconds, args.write_ratio)
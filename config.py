@@ -6,7 +6,43 @@ load_dotenv(os.path.join(basedir, '.env'))
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    # 兼容性处理：如果环境变量里没有，就用默认的 sqlite
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
-        'sqlite:///' + os.path.join(basedir, 'physics.db')
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    # 数据库地址：优先用环境变量 DATABASE_URL (sqlite:///physics.db 这类相对路径按 instance 目录解析)，
+    # 没有就用 instance/physics.db；postgres:// 开头的旧式地址改写成 SQLAlchemy 认的 postgresql://
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('DATABASE_URL') or
+        'sqlite:///' + os.path.join(basedir, 'instance', 'physics.db')).replace('postgres://', 'postgresql://', 1)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 非 SQLite 数据库的连接池 (每个 gunicorn worker 各自一个池，总连接数 = worker 数 x (pool_size + max_overflow))
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800)) # 秒，早于数据库/代理的空闲断开时间
+    SQLALCHEMY_ENGINE_OPTIONS = {} if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True, # 取连接前探活，数据库重启/连接被回收后自动重连
+    }
+    # 每日特训：进程内到期队列每次从数据库补充的题数 (0 = 关闭队列，每次直接 SQL 抽样)
+    DAILY_QUEUE_BATCH = int(os.environ.get('DAILY_QUEUE_BATCH', 20))
+    # 题目序列化结果的进程内 LRU 缓存容量 (条)
+    QUESTION_CACHE_SIZE = int(os.environ.get('QUESTION_CACHE_SIZE', 2048))
+    # /api/submit_batch 单次最多接受的答题数：整批在一个写事务里重放，超过的请求直接拒绝，由客户端分批同步
+    SUBMIT_BATCH_MAX = int(os.environ.get('SUBMIT_BATCH_MAX', 500))
+    # QuestionLog 写后缓冲：答题日志先入进程内队列，后台线程按条数/秒数阈值批量插入
+    QUESTION_LOG_WRITE_BEHIND = os.environ.get('QUESTION_LOG_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes')
+    QUESTION_LOG_FLUSH_SIZE = int(os.environ.get('QUESTION_LOG_FLUSH_SIZE', 200))
+    QUESTION_LOG_FLUSH_INTERVAL = float(os.environ.get('QUESTION_LOG_FLUSH_INTERVAL', 2.0))
+    # 答题日志列式快照目录 (python analytics.py 增量导出)；为空时用 instance/analytics
+    ANALYTICS_DIR = os.environ.get('ANALYTICS_DIR')
+    # SQLite 生产配置 (仅对 sqlite:// 生效，见 sqlite_profile.py)：每个连接建立时执行的 PRAGMA，置空则不设置
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+    # GET/HEAD 请求的只读查询走单独的只读连接池
+    SQLITE_READ_POOL = os.environ.get('SQLITE_READ_POOL', '0').lower() in ('1', 'true', 'yes')
+    SQLITE_READ_POOL_SIZE = int(os.environ.get('SQLITE_READ_POOL_SIZE', 5))
+    # 写事务用 BEGIN IMMEDIATE 一开始就拿写锁，多 worker 的写入按 busy_timeout 排队 (会同时启用上面的只读连接池)
+    SQLITE_IMMEDIATE_WRITES = os.environ.get('SQLITE_IMMEDIATE_WRITES', '0').lower() in ('1', 'true', 'yes')
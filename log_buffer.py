@@ -0,0 +1,110 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from sqlalchemy import insert
+from models import db, QuestionLog
+
+
+class QuestionLogBuffer:
+    """QuestionLog 写后缓冲：请求线程只负责入队，后台线程按条数/时间阈值批量插入。
+    QuestionLog 是只追加的流水，不参与答题结果计算，所以可以移出请求的关键路径。"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.flush_size = 200
+        self.flush_interval = 2.0
+        self._queue = queue.Queue()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        # 调优用指标
+        self.enqueued = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('QUESTION_LOG_WRITE_BEHIND', False)
+        self.flush_size = app.config.get('QUESTION_LOG_FLUSH_SIZE', self.flush_size)
+        self.flush_interval = app.config.get('QUESTION_LOG_FLUSH_INTERVAL', self.flush_interval)
+        if self.enabled:
+            # worker 正常退出 (gunicorn 优雅重启/SIGTERM) 时把队列里剩下的全部落库
+            atexit.register(self.flush)
+
+    def add(self, row):
+        """入队一条日志 (dict，字段同 QuestionLog，created_at 需由调用方填好)"""
+        self._ensure_thread()
+        self._queue.put(row)
+        self.enqueued += 1
+        if self._queue.qsize() >= self.flush_size:
+            self._wake.set()
+
+    def _ensure_thread(self):
+        # gunicorn --preload 时 fork 之后父进程的线程不会带到子进程，按 pid 懒启动
+        if self._thread and self._pid == os.getpid(): return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='question-log-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """把队列中的日志按 flush_size 分批插入，直到清空"""
+        with self._flush_lock:
+            while True:
+                rows = []
+                while len(rows) < self.flush_size:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not rows: return
+                self._write(rows)
+
+    def _write(self, rows):
+        start = time.perf_counter()
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(QuestionLog), rows)
+                db.session.commit()
+                self.flushed += len(rows)
+            except Exception as e:
+                db.session.rollback()
+                self.failed += len(rows)
+                self.app.logger.error(f'QuestionLog flush failed, dropped {len(rows)} rows: {e}')
+                return
+        elapsed = (time.perf_counter() - start) * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self.total_flush_ms += elapsed
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "queue_depth": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0,
+            "flush_size": self.flush_size,
+            "flush_interval": self.flush_interval
+        }
+
+
+log_buffer = QuestionLogBuffer()
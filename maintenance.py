@@ -0,0 +1,61 @@
+import argparse
+from app import app
+from question_service import service
+
+# 维护命令：重建/回填各类派生数据 (汇总表等)，可重复执行
+# 用法: python maintenance.py <command> [--user USER_ID]
+
+def rebuild_rollups(args):
+    count = service.rebuild_notebook_rollups(args.user)
+    print(f"✅ Rebuilt rollups for {count} notebooks")
+
+def rebuild_paths(args):
+    count = service.rebuild_notebook_paths(args.user)
+    print(f"✅ Rebuilt paths for {count} notebooks")
+    count = service.rebuild_note_paths(args.user)
+    print(f"✅ Rebuilt paths for {count} notes")
+
+def rebuild_order_keys(args):
+    count = service.rebuild_order_keys(args.user)
+    print(f"✅ Rebalanced order keys for {count} notes/notebooks")
+
+def backfill_note_links(args):
+    count = service.backfill_note_links(args.user)
+    print(f"✅ Indexed links for {count} notes")
+
+def rebuild_note_search(args):
+    count = service.rebuild_note_search(args.user)
+    print(f"✅ Indexed {count} notes for full-text search")
+
+def backfill_previews(args):
+    count = service.backfill_previews(only_missing=False)
+    print(f"✅ Generated previews for {count} notes/questions")
+
+def rebuild_user_stats(args):
+    count = service.rebuild_user_stats(args.user)
+    print(f"✅ Rebuilt stats for {count} users")
+
+def rebuild_daily_activity(args):
+    count = service.rebuild_daily_activity()
+    print(f"✅ Rebuilt daily activity for {count} days")
+
+COMMANDS = {
+    "backfill-previews": (backfill_previews, "fill notes.preview / questions.summary from content"),
+    "backfill-note-links": (backfill_note_links, "rebuild note_links from note content"),
+    "rebuild-daily-activity": (rebuild_daily_activity, "recompute user_daily_activity/daily_activity from question_logs (all users)"),
+    "rebuild-note-search": (rebuild_note_search, "rebuild the notes_fts full-text index"),
+    "rebuild-order-keys": (rebuild_order_keys, "re-space notes/notebooks order_key (backfills from order_index)"),
+    "rebuild-paths": (rebuild_paths, "recompute notebooks.path / notes.path from parent_id"),
+    "rebuild-rollups": (rebuild_rollups, "recompute notebook_rollups from notebook_questions/question_progress"),
+    "rebuild-user-stats": (rebuild_user_stats, "recompute user_stats (incl. streaks) from question_progress/question_logs"),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Physics Pro maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument('--user', default=None, help="limit to one user id")
+    args = parser.parse_args()
+    with app.app_context():
+        COMMANDS[args.command][0](args)
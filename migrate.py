@@ -38,7 +38,7 @@ def migrate():
         
         db.session.commit() # 提交用户以获取 ID
         # [NEW] 给管理员也整一份说明书
-        from question_service import service
+        from question_service import service, plain_preview
         service.init_new_user(admin)
         print(f"   ✅ 管理员账号: admin / 123456")
         print(f"   ✅ 通用邀请码: HELLO2025")
@@ -63,10 +63,13 @@ def migrate():
                     correct_id=q_data.get('correct_id', 'A'),
                     analysis=q_data.get('ai_context', {}).get('explanation', ''),
                     tags=q_data.get('tags', []),
-                    mode=mode
+                    mode=mode,
+                    summary=plain_preview(q_data['content'])
                 )
                 db.session.add(new_q)
                 count_q += 1
+        # 题库变了：让所有 worker 的题目缓存失效
+        service.bump_question_version()
         db.session.commit()
         print(f"   ✅ 导入题目: {count_q} 道")
 
@@ -160,6 +163,15 @@ def migrate():
             print("   ✅ 迁移错题本完成")
             
             db.session.commit()
+            service.rebuild_note_paths()
+            service.rebuild_order_keys()
+            service.backfill_note_links()
+            service.rebuild_note_search()
+            service.backfill_previews()
+            service.rebuild_user_stats()
+            service.rebuild_daily_activity()
+            service.rebuild_notebook_paths()
+            service.rebuild_notebook_rollups()
         else:
             print("   ℹ️  未发现 user_data.json，跳过旧数据迁移。")
 
@@ -5,8 +5,15 @@ from datetime import datetime
 import uuid
 import random
 import string
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlite_profile import RoutingSession
 
-db = SQLAlchemy()
+# 会话按请求类型路由到只读连接池 (见 sqlite_profile.py，未启用时与默认会话相同)
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# 标签列：PostgreSQL 上存为 JSONB (可建 GIN 索引，支持 ?| 等运算符)，其它数据库仍是 JSON
+TagList = db.JSON().with_variant(JSONB(), 'postgresql')
 
 def generate_uuid():
     return str(uuid.uuid4())
@@ -67,18 +74,46 @@ class Note(db.Model):
     user_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
     name = db.Column(db.String(200), nullable=False)
     type = db.Column(db.String(20), default='file')
-    content = db.Column(db.Text, nullable=True)
+    # 正文延迟加载：列表只读 preview (保存时生成的纯文本摘要)，打开笔记时才取正文
+    content = db.deferred(db.Column(db.Text, nullable=True))
+    preview = db.Column(db.String(200), default='')
     parent_id = db.Column(db.String(36), db.ForeignKey('notes.id'), nullable=True)
+    # 物化路径 "/祖先id/.../自身id/"，同 Notebook.path
+    path = db.Column(db.Text, index=True)
     children = db.relationship('Note', backref=db.backref('parent', remote_side=[id]), lazy='dynamic', cascade="all, delete-orphan")
-    order_index = db.Column(db.Integer, default=0)
+    order_index = db.Column(db.Integer, default=0) # 旧排序字段，仅用于回填 order_key
+    # 分数排序键 (见 ranking.py)：同级按字符串升序，拖拽只改写被移动的一行
+    order_key = db.Column(db.String(64))
+    # 增量保存：每次写入正文 version + 1；content_hash 用来跳过内容没变的保存
+    version = db.Column(db.Integer, default=0, nullable=False)
+    content_hash = db.Column(db.String(64))
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+    __table_args__ = (
+        db.Index('ix_notes_sibling_order', 'user_id', 'parent_id', 'order_key'),
+    )
+
+# 笔记中的引用索引：保存笔记时解析 [[note:id]] / [[题目id]] 写入，
+# 反向链接和“引用了这道题的笔记”都按 (kind, target_id) 走索引，不再扫描正文
+class NoteLink(db.Model):
+    __tablename__ = 'note_links'
+    source_id = db.Column(db.String(36), db.ForeignKey('notes.id', ondelete='CASCADE'), primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True) # 'note' | 'question'
+    target_id = db.Column(db.String(50), primary_key=True)
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_note_links_target', 'user_id', 'kind', 'target_id'),
+    )
+
 # ================== 3. 错题本系统 ==================
 notebook_questions = db.Table('notebook_questions',
     db.Column('notebook_id', db.String(36), db.ForeignKey('notebooks.id'), primary_key=True),
     db.Column('question_id', db.String(50), db.ForeignKey('questions.id'), primary_key=True),
-    db.Column('added_at', db.DateTime, default=datetime.now)
+    db.Column('added_at', db.DateTime, default=datetime.now),
+    # 本子内题目的排序键；为空的排在最后 (按加入时间)
+    db.Column('order_key', db.String(64))
 )
 
 class Notebook(db.Model):
@@ -86,21 +121,49 @@ class Notebook(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
     user_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
     name = db.Column(db.String(200), nullable=False)
-    tags = db.Column(db.JSON, default=list)
+    tags = db.Column(TagList, default=list)
     parent_id = db.Column(db.String(36), db.ForeignKey('notebooks.id'), nullable=True)
+    # 物化路径 "/祖先id/.../自身id/"：面包屑、子树查询、防环检查都只需一条按 path 索引的查询
+    path = db.Column(db.Text, index=True)
     children = db.relationship('Notebook', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
-    questions = db.relationship('Question', secondary=notebook_questions, lazy='subquery', backref=db.backref('notebooks', lazy=True))
-    order_index = db.Column(db.Integer, default=0)
+    # lazy='select'：查询本子时不再连带加载全部题目 (含正文)，需要时再按需访问
+    questions = db.relationship('Question', secondary=notebook_questions, lazy='select', backref=db.backref('notebooks', lazy=True))
+    order_index = db.Column(db.Integer, default=0) # 旧排序字段，仅用于回填 order_key
+    order_key = db.Column(db.String(64))
+
+    __table_args__ = (
+        db.Index('ix_notebooks_sibling_order', 'user_id', 'parent_id', 'order_key'),
+    )
+
+# 错题本统计汇总 (物化)：随做题进度/题目归属变化在同一事务里增量维护，
+# total/error/proficiency/tag 均为含子文件夹的整棵子树口径，direct_count 只计直属题目
+class NotebookRollup(db.Model):
+    __tablename__ = 'notebook_rollups'
+    notebook_id = db.Column(db.String(36), db.ForeignKey('notebooks.id'), primary_key=True)
+    direct_count = db.Column(db.Integer, default=0, nullable=False)
+    total_count = db.Column(db.Integer, default=0, nullable=False)
+    error_sum = db.Column(db.Integer, default=0, nullable=False)
+    proficiency_sum = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+# 汇总的标签直方图：每个 (本子, 标签) 一行，计数在 SQL 里原子加减，Top Tags 读取时按 count 排序
+class NotebookRollupTag(db.Model):
+    __tablename__ = 'notebook_rollup_tags'
+    notebook_id = db.Column(db.String(36), db.ForeignKey('notebooks.id'), primary_key=True)
+    tag = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
 
 # ================== 4. 静态题库 ==================
 class Question(db.Model):
     __tablename__ = 'questions'
     id = db.Column(db.String(50), primary_key=True)
-    content = db.Column(db.Text, nullable=False)
-    options = db.Column(db.JSON, nullable=False)
+    # 大字段归入 'body' 组延迟加载 (需要时一次取齐)；列表只读 summary
+    content = db.deferred(db.Column(db.Text, nullable=False), group='body')
+    options = db.deferred(db.Column(db.JSON, nullable=False), group='body')
     correct_id = db.Column(db.String(10), nullable=False)
-    analysis = db.Column(db.Text, nullable=True)
-    tags = db.Column(db.JSON, default=list)
+    analysis = db.deferred(db.Column(db.Text, nullable=True), group='body')
+    summary = db.Column(db.String(200), default='')
+    tags = db.Column(TagList, default=list)
     mode = db.Column(db.String(20), default='training')
 
 # ================== 5. 数据核心 ==================
@@ -116,6 +179,69 @@ class QuestionProgress(db.Model):
     next_review_time = db.Column(db.Float, default=0)
     last_reviewed_at = db.Column(db.DateTime, default=datetime.now)
 
+    __table_args__ = (
+        # 每日特训到期队列：按用户 + 到期时间范围扫描，附带 question_id 构成覆盖索引
+        db.Index('ix_progress_due_queue', 'user_id', 'next_review_time', 'errors', 'question_id'),
+        # 每个用户每道题只有一行进度，答题时按此唯一键 UPSERT
+        db.Index('uq_progress_user_question', 'user_id', 'question_id', unique=True),
+    )
+
+# 训练/考试模式的洗牌题组：每个用户每种模式一副，洗一次牌后按游标逐张发放
+class QuestionDeck(db.Model):
+    __tablename__ = 'question_decks'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), primary_key=True)
+    mode = db.Column(db.String(20), primary_key=True)
+    cursor = db.Column(db.Integer, default=0)   # 下一张要发的位置
+    size = db.Column(db.Integer, default=0)
+    built_at = db.Column(db.DateTime, default=datetime.now)
+
+class QuestionDeckCard(db.Model):
+    __tablename__ = 'question_deck_cards'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), primary_key=True)
+    mode = db.Column(db.String(20), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    question_id = db.Column(db.String(50), db.ForeignKey('questions.id'), nullable=False)
+
+# 夜间批处理 (scheduler.py) 预先算好的每日到期队列和未来 30 天复习量预测
+class UserDueQueue(db.Model):
+    __tablename__ = 'user_due_queues'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), primary_key=True)
+    question_ids = db.Column(db.JSON, default=list)   # 已到期错题，按逾期时长从久到近排列
+    due_count = db.Column(db.Integer, default=0)
+    forecast = db.Column(db.JSON, default=list)       # forecast[i] = 第 i 天到期的题数 (第 0 天含已逾期)
+    computed_at = db.Column(db.DateTime, default=datetime.now)
+
+# 每个用户一行的做题统计 (物化)：答题时在同一事务里增量更新，仪表盘按主键读一行
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), primary_key=True)
+    questions_done = db.Column(db.Integer, default=0, nullable=False)   # 做过的不同题目数
+    proficiency_sum = db.Column(db.Integer, default=0, nullable=False)  # 各题熟练度之和
+    current_streak = db.Column(db.Integer, default=0, nullable=False)   # 截至 last_active_day 的连续打卡天数
+    longest_streak = db.Column(db.Integer, default=0, nullable=False)
+    last_active_day = db.Column(db.Date, nullable=True)
+    today_count = db.Column(db.Integer, default=0, nullable=False)      # last_active_day 当天的答题次数
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+# 按 (用户, 日期) 汇总的答题量，随答题同事务更新；管理后台的近 7 天活跃度从这里读，不扫 question_logs
+class UserDailyActivity(db.Model):
+    __tablename__ = 'user_daily_activity'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    answers = db.Column(db.Integer, default=0, nullable=False)
+    correct = db.Column(db.Integer, default=0, nullable=False)
+    __table_args__ = (
+        db.Index('ix_user_daily_activity_day', 'day'),
+    )
+
+# 全站按日汇总：日活 (当天答过题的用户数)、答题数、答对数
+class DailyActivity(db.Model):
+    __tablename__ = 'daily_activity'
+    day = db.Column(db.Date, primary_key=True)
+    active_users = db.Column(db.Integer, default=0, nullable=False)
+    answers = db.Column(db.Integer, default=0, nullable=False)
+    correct = db.Column(db.Integer, default=0, nullable=False)
+
 class StudySession(db.Model):
     __tablename__ = 'study_sessions'
     id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
@@ -137,4 +263,23 @@ class QuestionLog(db.Model):
     is_correct = db.Column(db.Boolean, nullable=False)
     user_choice = db.Column(db.String(10))
     duration_ms = db.Column(db.Integer)
-    created_at = db.Column(db.DateTime, default=datetime.now)
\ No newline at end of file
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+# ================== 6. 缓存版本 ==================
+# 进程内缓存 (题目序列化结果、标签索引等) 的失效版本号，所有 gunicorn worker 共享
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_versions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, default=0, nullable=False)
+
+# ================== 7. PostgreSQL 专用索引 ==================
+# 标签 GIN 索引 (变式题按 tags ?| 查找)；物化路径用 text_pattern_ops，非 C 排序规则下 LIKE 'prefix%' 也能走索引。
+# 建表时按方言触发，已有库由 update_db.py 补建 (语句带 IF NOT EXISTS)
+POSTGRES_INDEXES = {
+    'questions': ["CREATE INDEX IF NOT EXISTS ix_questions_tags_gin ON questions USING gin (tags)"],
+    'notebooks': ["CREATE INDEX IF NOT EXISTS ix_notebooks_path_pattern ON notebooks (path text_pattern_ops)"],
+    'notes': ["CREATE INDEX IF NOT EXISTS ix_notes_path_pattern ON notes (path text_pattern_ops)"],
+}
+for _table, _statements in POSTGRES_INDEXES.items():
+    for _statement in _statements:
+        event.listen(db.metadata.tables[_table], 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
@@ -0,0 +1,161 @@
+import re
+import html
+import sqlite3
+from sqlalchemy import text, bindparam
+from models import db
+
+# 笔记全文检索 (SQLite FTS5)
+# unicode61 分词器会把连续的汉字当成一个词，搜“第二定律”就匹配不到“牛顿第二定律”。
+# 所以写入索引前在每个汉字前后插入零宽空格 (分词器把它当分隔符，按字建索引)，
+# 查询时把连续汉字组成短语 ("第 二 定 律" 要求相邻)，英文/LaTeX 词按前缀匹配。
+# 非 SQLite 或 FTS5 不可用时，search() 返回 None，由调用方退回 LIKE 查询。
+
+FTS_TABLE = 'notes_fts'
+# note_id (UUID) -> FTS 行的 rowid。FTS5 只有 rowid 能按主键定位，按 UNINDEXED 的 note_id 删除要全表扫描
+ROWID_TABLE = 'notes_fts_rowids'
+SEPARATOR = '\u200b' # 零宽空格
+CJK = '\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+CJK_CHAR = re.compile(f'([{CJK}])')
+CJK_RUN = re.compile(f'[{CJK}]+')
+TOKEN = re.compile(f'[{CJK}]+|[^\\W{CJK}]+')
+HTML_TAG = re.compile(r'<[^>]+>')
+# snippet/highlight 的临时标记 (转义正文后再换成 <mark>)
+MARK_OPEN, MARK_CLOSE = '\x02', '\x03'
+
+_ready = {}
+
+
+def segment(value):
+    """去掉 HTML 标签，并在每个汉字两侧插入分隔符"""
+    value = HTML_TAG.sub(' ', value or '')
+    return CJK_CHAR.sub(SEPARATOR + r'\1' + SEPARATOR, value)
+
+
+def build_query(raw):
+    """把用户输入转成 FTS5 查询：汉字串 -> 相邻短语，其他词 -> 前缀匹配，之间为 AND"""
+    terms = []
+    for token in TOKEN.findall(raw or ''):
+        if CJK_RUN.fullmatch(token):
+            terms.append('"' + ' '.join(token) + '"')
+        else:
+            terms.append(f'"{token}"*')
+    return ' '.join(terms)
+
+
+def fts5_supported():
+    try:
+        sqlite3.connect(':memory:').execute("CREATE VIRTUAL TABLE probe USING fts5(x)")
+        return True
+    except sqlite3.Error:
+        return False
+
+
+def available():
+    """当前数据库能否使用 FTS5；索引表不存在时在当前事务里建表 (表确认存在后按数据库地址缓存)"""
+    engine = db.engine
+    key = str(engine.url)
+    if key not in _ready:
+        if engine.dialect.name != 'sqlite' or not fts5_supported():
+            _ready[key] = False
+        elif ensure_fts():
+            _ready[key] = True
+        else:
+            return True # 刚在本事务里建的表，提交后下次再确认
+    return _ready[key]
+
+
+def ensure_fts():
+    """建索引表 (走当前会话的事务，避免另开连接和未提交的写事务抢锁)；返回表是否原本就存在"""
+    exists = db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+    ), {"name": FTS_TABLE}).first()
+    if not exists:
+        db.session.execute(text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "note_id UNINDEXED, user_id UNINDEXED, name, content, tokenize='unicode61 remove_diacritics 2')"
+        ))
+    mapped = db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+    ), {"name": ROWID_TABLE}).first()
+    if not mapped:
+        db.session.execute(text(f"CREATE TABLE {ROWID_TABLE} (rowid INTEGER PRIMARY KEY, note_id TEXT NOT NULL UNIQUE)"))
+        # 老索引表：沿用已有行的 rowid
+        db.session.execute(text(f"INSERT OR IGNORE INTO {ROWID_TABLE} (rowid, note_id) SELECT rowid, note_id FROM {FTS_TABLE}"))
+    return bool(exists and mapped)
+
+
+def _rowids(note_ids, create=False):
+    """{note_id: rowid}；create=True 时先为还没有 rowid 的笔记分配一个"""
+    if create:
+        db.session.execute(text(f"INSERT OR IGNORE INTO {ROWID_TABLE} (note_id) VALUES (:id)"),
+                           [{"id": nid} for nid in note_ids])
+    return dict(db.session.execute(text(f"SELECT note_id, rowid FROM {ROWID_TABLE} WHERE note_id IN :ids").bindparams(
+        bindparam('ids', expanding=True)), {"ids": list(note_ids)}).all())
+
+
+def index_note(note_id, user_id, name, content):
+    """写入/覆盖一篇笔记的索引行 (按 rowid 先删后插)；随调用方事务提交"""
+    if not available(): return
+    rowid = _rowids([note_id], create=True)[note_id]
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"), {"rowid": rowid})
+    db.session.execute(text(
+        f"INSERT INTO {FTS_TABLE} (rowid, note_id, user_id, name, content) VALUES (:rowid, :id, :user, :name, :content)"
+    ), {"rowid": rowid, "id": note_id, "user": user_id, "name": segment(name), "content": segment(content)})
+
+
+def remove_notes(note_ids):
+    if not available() or not note_ids: return
+    rowids = list(_rowids(note_ids).values())
+    if not rowids: return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN :rowids").bindparams(
+        bindparam('rowids', expanding=True)), {"rowids": rowids})
+    db.session.execute(text(f"DELETE FROM {ROWID_TABLE} WHERE rowid IN :rowids").bindparams(
+        bindparam('rowids', expanding=True)), {"rowids": rowids})
+
+
+def rebuild(rows, user_id=None):
+    """rows: [(note_id, user_id, name, content), ...]；清空 (全部或某个用户的) 索引后整体重建"""
+    if not available(): return 0
+    if user_id:
+        db.session.execute(text(
+            f"DELETE FROM {ROWID_TABLE} WHERE rowid IN (SELECT rowid FROM {FTS_TABLE} WHERE user_id = :user)"
+        ), {"user": user_id})
+        db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE user_id = :user"), {"user": user_id})
+    else:
+        db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+        db.session.execute(text(f"DELETE FROM {ROWID_TABLE}"))
+    rows = list(rows)
+    rowids = {}
+    for i in range(0, len(rows), 500):
+        rowids.update(_rowids([r[0] for r in rows[i:i + 500]], create=True))
+    items = [{"rowid": rowids[nid], "id": nid, "user": uid, "name": segment(name), "content": segment(content)}
+             for nid, uid, name, content in rows]
+    if items:
+        db.session.execute(text(
+            f"INSERT INTO {FTS_TABLE} (rowid, note_id, user_id, name, content) VALUES (:rowid, :id, :user, :name, :content)"
+        ), items)
+    return len(items)
+
+
+def render(fragment):
+    """去掉分隔符，转义正文，再把临时标记换成 <mark>"""
+    fragment = html.escape((fragment or '').replace(SEPARATOR, ''))
+    return fragment.replace(MARK_OPEN, '<mark>').replace(MARK_CLOSE, '</mark>')
+
+
+def plain_text(fragment):
+    """render() 结果去掉高亮、还原成纯文本"""
+    return html.unescape((fragment or '').replace('<mark>', '').replace('</mark>', ''))
+
+
+def search(user_id, raw, limit, offset):
+    """bm25 排序 (标题权重高于正文)，返回 [(note_id, 标题高亮, 正文摘要)]；不可用时返回 None"""
+    if not available(): return None
+    query = build_query(raw)
+    if not query: return []
+    rows = db.session.execute(text(
+        f"SELECT note_id, highlight({FTS_TABLE}, 2, :mo, :mc), snippet({FTS_TABLE}, 3, :mo, :mc, '…', 24) "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :q AND user_id = :user "
+        f"ORDER BY bm25({FTS_TABLE}, 0, 0, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+    ), {"q": query, "user": user_id, "mo": MARK_OPEN, "mc": MARK_CLOSE, "limit": limit, "offset": offset})
+    return [(nid, render(name), render(snip)) for nid, name, snip in rows]
@@ -0,0 +1,149 @@
+import os
+import sys
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine import make_url
+
+# PostgreSQL 冒烟测试：在 DATABASE_URL 指向的服务器上建一个临时库，先做成“旧库”的样子
+# (tags 是 json 类型、没有 GIN / text_pattern_ops 索引)，跑一遍 update_db 的迁移，再检查
+#   1. tags 已转成 jsonb，GIN / text_pattern_ops 索引已建好 (再跑一次迁移不报错)；
+#   2. 变式题的 ?| 查询 (_variant_candidates) 结果与按标签交集算出的一致，且能走 GIN 索引；
+#   3. 物化路径的前缀查询能走 text_pattern_ops 索引；
+#   4. 多个连接同时抽题 (含牌堆发完时重新洗牌)，每道题发出的次数恰好等于轮数。
+# 结束后删掉临时库；有检查失败时以非 0 退出。
+# 用法 (docker-compose.yml 的 postgres profile)：
+#   docker compose --profile postgres up -d db
+#   docker compose --profile postgres run --rm -e DATABASE_URL=postgresql://physics:physics@db:5432/physics web python pg_smoke.py
+
+TAGS = {
+    "pg-q1": ["力学", "牛顿定律"],
+    "pg-q2": ["力学", "动量"],
+    "pg-q3": ["牛顿定律", "力学", "受力分析"],
+    "pg-q4": ["电磁学"],
+    "pg-q5": ["动量"],
+}
+failures = []
+
+def check(ok, label):
+    print(f"{'✅' if ok else '❌'} {label}")
+    if not ok: failures.append(label)
+
+def explain(conn, sql, params):
+    """关掉顺序扫描后的执行计划 (测试数据太少，不关的话规划器总会选全表扫描)"""
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    return '\n'.join(r[0] for r in conn.execute(text("EXPLAIN " + sql), params))
+
+def legacy_schema(db):
+    """把刚建好的新表改回旧库的样子：tags 为 json，没有 PostgreSQL 专用索引"""
+    from models import POSTGRES_INDEXES
+    with db.engine.begin() as conn:
+        for table in ('questions', 'notebooks'):
+            conn.exec_driver_sql(f"ALTER TABLE {table} ALTER COLUMN tags TYPE json USING tags::json")
+        for statements in POSTGRES_INDEXES.values():
+            for statement in statements:
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS {statement.split()[5]}")
+
+def seed(db):
+    from models import User, Question, Notebook
+    user = User(username='pg-smoke')
+    db.session.add(user)
+    for qid, tags in TAGS.items():
+        db.session.add(Question(id=qid, content=qid, options=[{"id": "A", "text": "A"}], correct_id='A', tags=tags, mode='exam'))
+    db.session.flush()
+    root = Notebook(user_id=user.id, name='pg-root', tags=["力学"])
+    db.session.add(root)
+    db.session.flush()
+    db.session.add(Notebook(user_id=user.id, name='pg-child', parent_id=root.id))
+    db.session.commit()
+
+def draw_cards(app, user_id, n):
+    """线程：逐张领牌，每张单独提交 (每个线程有自己的 app context，即自己的 session 与连接)"""
+    from models import db
+    from question_service import service
+    with app.app_context():
+        ids = []
+        for _ in range(n):
+            ids += service._draw_from_deck(user_id, 'exam')
+            db.session.commit()
+        db.session.remove()
+    return ids
+
+def run():
+    from app import app
+    from models import db
+    from update_db import update_database
+    from question_service import service
+
+    with app.app_context():
+        db.create_all()
+        legacy_schema(db)
+        seed(db)
+
+    update_database()
+    update_database() # 迁移可重复执行
+
+    with app.app_context():
+        from models import User
+        uid = User.query.filter_by(username='pg-smoke').first().id
+    # 4 个线程各抽一整副 = 4 轮：行锁下重新洗牌只发生在真正发完时，领取不丢不重
+    with ThreadPoolExecutor(4) as pool:
+        drawn = Counter(q for ids in pool.map(lambda n: draw_cards(app, uid, n), [len(TAGS)] * 4) for q in ids)
+    check(sorted(drawn.values()) == [4] * len(TAGS), f"concurrent deck draws over 4 rounds: {dict(drawn)}")
+
+    with app.app_context():
+        insp = inspect(db.engine)
+        for table in ('questions', 'notebooks'):
+            tags = next(c for c in insp.get_columns(table) if c['name'] == 'tags')
+            check(isinstance(tags['type'], JSONB), f"{table}.tags is jsonb")
+        indexes = {r[0] for r in db.session.execute(text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"))}
+        for name in ('ix_questions_tags_gin', 'ix_notebooks_path_pattern', 'ix_notes_path_pattern'):
+            check(name in indexes, f"index {name} exists")
+
+        for qid, tags in TAGS.items():
+            expected = sorted(((other, len(set(tags) & set(other_tags))) for other, other_tags in TAGS.items()
+                               if other != qid and set(tags) & set(other_tags)), key=lambda c: (-c[1], c[0]))
+            got = sorted(service._variant_candidates(qid), key=lambda c: (-c[1], c[0]))
+            check(got == expected, f"variant candidates of {qid}: {got}")
+
+        with db.engine.begin() as conn:
+            plan = explain(conn, "SELECT id FROM questions WHERE tags ?| :tags", {"tags": ["动量"]})
+            check('ix_questions_tags_gin' in plan, "tags ?| uses the GIN index")
+        with db.engine.begin() as conn:
+            plan = explain(conn, "SELECT id FROM notebooks WHERE path LIKE :prefix", {"prefix": "/abc/%"})
+            check('ix_notebooks_path_pattern' in plan, "path prefix LIKE uses the text_pattern_ops index")
+
+        paths = dict(db.session.execute(text("SELECT name, path FROM notebooks WHERE name LIKE 'pg-%'")).all())
+        check(paths.get('pg-child', '').startswith(paths.get('pg-root') or '-'), "materialized paths backfilled")
+        db.session.remove()
+        db.engine.dispose()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Smoke-test the PostgreSQL backend in a throwaway database")
+    parser.add_argument('--keep', action='store_true', help="do not drop the temporary database")
+    args = parser.parse_args()
+
+    raw = os.environ.get('DATABASE_URL', '')
+    if raw.startswith('postgres://'): raw = raw.replace('postgres://', 'postgresql://', 1)
+    if not raw.startswith('postgresql'):
+        sys.exit("DATABASE_URL must point at a PostgreSQL server (see the usage at the top of pg_smoke.py)")
+    server = make_url(raw)
+    name = f"{server.database or 'physics'}_smoke_{os.getpid()}"
+    admin = create_engine(server, isolation_level='AUTOCOMMIT')
+    with admin.connect() as conn:
+        conn.exec_driver_sql(f'CREATE DATABASE "{name}"')
+    # config.py 在导入 app 时读取 DATABASE_URL，所以必须在导入之前改掉
+    os.environ['DATABASE_URL'] = server.set(database=name).render_as_string(hide_password=False)
+    try:
+        run()
+    finally:
+        if not args.keep:
+            with admin.connect() as conn:
+                conn.exec_driver_sql(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        admin.dispose()
+
+    if failures:
+        sys.exit(f"PG SMOKE FAILED: {len(failures)} check(s)")
+    print("PG SMOKE OK")
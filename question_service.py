@@ -1,19 +1,316 @@
+import re
 import random
 import time
 import json
-from datetime import datetime
-from sqlalchemy import func, or_
+import copy
+import heapq
+import hashlib
+import html
+import unicodedata
+import threading
+from collections import deque, Counter, OrderedDict
+from datetime import datetime, date, timedelta
+from sqlalchemy import func, or_, and_, select, insert, update, case, bindparam, exists, literal, event, text
+from flask import current_app, g, has_request_context
 from flask_login import current_user
-from models import db, User, Question, QuestionProgress, Note, Notebook, QuestionLog
+from log_buffer import log_buffer
+import note_search
+from ranking import rank_after, rank_before, rank_sequence, rerank, needs_rebalance
+from models import db, notebook_questions, User, Question, QuestionProgress, Note, Notebook, QuestionLog, QuestionDeck, QuestionDeckCard, CacheVersion, UserDueQueue, NotebookRollup, NotebookRollupTag, NoteLink, UserStats, UserDailyActivity, DailyActivity
+
+QUESTION_VERSION_KEY = 'questions'
+# 笔记里的引用语法：[[note:笔记id]] 链接笔记，[[题目id]] 引用题目 (与前端渲染的正则一致)
+NOTE_LINK_PATTERN = re.compile(r'\[\[(note:)?(.*?)\]\]')
+
+def upsert(model):
+    """按当前数据库方言构造支持 ON CONFLICT 的 INSERT (SQLite / PostgreSQL 语法一致)"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model)
+
+def acquire_write_lock(table):
+    """读-改-写之前先拿写锁。
+    SQLite 默认的延迟事务在第一条 DML 才加锁，这里发一条不命中任何行的 UPDATE 提前拿到；
+    PostgreSQL 是行级锁，由调用方在读取时加 FOR UPDATE，这里什么也不做"""
+    if db.session.get_bind().dialect.name != 'sqlite': return
+    col = next(iter(table.primary_key.columns))
+    db.session.execute(table.update().where(literal(False)).values({col.name: col}))
+
+def subtree_clause(column, prefix):
+    """物化路径前缀匹配 (整棵子树，含自身)。
+    SQLite 的 LIKE 默认用不上索引，额外加一个等价的范围条件 ('/' 的下一个字符是 '0')"""
+    clause = column.startswith(prefix, autoescape=True)
+    if db.session.get_bind().dialect.name == 'sqlite':
+        clause = and_(column >= prefix, column < prefix[:-1] + '0', clause)
+    return clause
+
+def path_ids(path):
+    """"/a/b/c/" -> ['a', 'b', 'c'] (从根到自身)"""
+    return [p for p in (path or '').split('/') if p]
+
+def set_path(node):
+    """新建的节点 (已 flush 出 id) 按父节点写入物化路径"""
+    model = type(node)
+    parent_path = db.session.query(model.path).filter_by(id=node.parent_id).scalar() if node.parent_id else None
+    node.path = (parent_path or '/') + node.id + '/'
+
+def ensure_paths(*nodes):
+    """老数据 (update_db 回填之前) 的 path 可能为空：先按 parent_id 为该用户整体重算一次，再按路径做子树操作"""
+    missing = [n for n in nodes if n is not None and n.path is None]
+    if not missing: return
+    rebuild_paths(type(missing[0]), missing[0].user_id)
+    for n in nodes:
+        if n is not None: db.session.expire(n, ['path'])
+
+def move_subtree(node, target):
+    """改父节点，并用一条 UPDATE 把整棵子树的路径前缀替换掉 (target 为 None 表示移到根目录)"""
+    table = type(node).__table__
+    old_prefix = node.path
+    new_prefix = (target.path if target else '/') + node.id + '/'
+    db.session.execute(table.update().where(
+        table.c.user_id == node.user_id, subtree_clause(table.c.path, old_prefix)
+    ).values(path=new_prefix + func.substr(table.c.path, len(old_prefix) + 1)))
+    db.session.execute(table.update().where(table.c.id == node.id).values(parent_id=target.id if target else None))
+    db.session.expire(node)
+
+def rebuild_paths(model, user_id=None):
+    """按 parent_id 重新计算整张表 (或某个用户) 的物化路径，批量写回；遇到环的节点挂到根下"""
+    rows = db.session.query(model.id, model.parent_id)
+    if user_id: rows = rows.filter(model.user_id == user_id)
+    parents = dict(rows.all())
+    paths = {}
+
+    def resolve(node_id):
+        chain, cursor = [], node_id
+        while cursor and cursor not in paths and cursor in parents and cursor not in chain:
+            chain.append(cursor)
+            cursor = parents[cursor]
+        prefix = paths.get(cursor, '/') if cursor not in chain else '/'
+        for nid in reversed(chain):
+            prefix = prefix + nid + '/'
+            paths[nid] = prefix
+        return paths.get(node_id)
+
+    for node_id in parents: resolve(node_id)
+    table = model.__table__
+    stmt = table.update().where(table.c.id == bindparam('node_id')).values(path=bindparam('node_path'))
+    items = [{"node_id": nid, "node_path": p} for nid, p in paths.items()]
+    for i in range(0, len(items), 1000):
+        db.session.execute(stmt, items[i:i + 1000])
+    return len(items)
+
+
+HTML_TAG = re.compile(r'<[^>]+>')
+LATEX_COMMAND = re.compile(r'\\([A-Za-z]+|.)')
+LATEX_SYMBOLS = {'cdot': '·', 'times': '×', 'pm': '±', 'approx': '≈', 'neq': '≠', 'leq': '≤', 'geq': '≥',
+                 'infty': '∞', 'to': '→', 'rightarrow': '→', 'hbar': 'ħ', 'partial': '∂', 'sqrt': '√', 'circ': '°'}
+MARKDOWN_NOISE = re.compile(r'\[\[[^\]]*\]\]|^\s{0,3}(#{1,6}|>|[-*+]|\d+\.)\s+|[*`~]{1,3}', re.M)
+LATEX_FRAC = re.compile(r'\\[dt]?frac\s*\{([^{}]*)\}\s*\{([^{}]*)\}')
+
+def _latex_token(match):
+    name = match.group(1)
+    if len(name) == 1: return name if name in '{}$%&#_' else ' '
+    if name in LATEX_SYMBOLS: return LATEX_SYMBOLS[name]
+    try:
+        case_name = 'CAPITAL' if name[0].isupper() else 'SMALL'
+        return unicodedata.lookup(f'GREEK {case_name} LETTER {name.upper()}')
+    except KeyError:
+        return ' '
+
+def plain_preview(value, length=120):
+    """正文 -> 纯文本摘要：去掉 HTML 标签/实体、LaTeX 定界符与命令 (希腊字母和常用符号换成 Unicode)、
+    Markdown 标记和 [[引用]]，压缩空白后截断"""
+    text = html.unescape(HTML_TAG.sub(' ', value or ''))
+    text = MARKDOWN_NOISE.sub(' ', text)
+    text = re.sub(r'\$\$?|\\[()\[\]]', ' ', text)
+    text = LATEX_FRAC.sub(r'\1/\2', text)
+    text = LATEX_COMMAND.sub(_latex_token, text)
+    text = re.sub(r'[{}^_]', '', text)
+    return ' '.join(text.split())[:length]
+
+def parse_note_links(content):
+    """从笔记正文解析出引用集合 {(kind, target_id)}"""
+    links = set()
+    for is_note, target in NOTE_LINK_PATTERN.findall(content or ''):
+        target = target.strip()
+        if target and len(target) <= 50:
+            links.add(('note' if is_note else 'question', target))
+    return links
+
+def sync_note_links(note_id, user_id, content):
+    """用正文重写某篇笔记的引用索引 (先删后插)；不提交"""
+    db.session.execute(NoteLink.__table__.delete().where(NoteLink.source_id == note_id))
+    links = parse_note_links(content)
+    if links:
+        db.session.execute(insert(NoteLink), [
+            {"source_id": note_id, "kind": kind, "target_id": target, "user_id": user_id} for kind, target in links
+        ])
+
+def content_digest(content):
+    return hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+
+def apply_text_patch(content, start, end, text):
+    """把 content 的 [start, end) 替换成 text；偏移量按 UTF-16 码元计 (与前端 JS 字符串下标一致)。
+    越界或切在代理对中间时返回 None"""
+    units = (content or '').encode('utf-16-le')
+    if not (isinstance(start, int) and isinstance(end, int) and 0 <= start <= end <= len(units) // 2):
+        return None
+    try:
+        head = units[:start * 2].decode('utf-16-le')
+        tail = units[end * 2:].decode('utf-16-le')
+    except UnicodeDecodeError:
+        return None
+    return head + (text or '') + tail
+
+def rebuild_order_keys(model, *criteria):
+    """按现有顺序 (order_key，其次旧的 order_index) 给每组同级重新均匀分配排序键，批量写回"""
+    rows = db.session.query(model.id, model.user_id, model.parent_id).filter(*criteria).order_by(
+        model.user_id, model.parent_id, model.order_key.is_(None), model.order_key, model.order_index, model.id
+    ).all()
+    groups = OrderedDict()
+    for node_id, user_id, parent_id in rows:
+        groups.setdefault((user_id, parent_id), []).append(node_id)
+    items = []
+    for ids in groups.values():
+        items.extend({"node_id": nid, "node_key": key} for nid, key in zip(ids, rank_sequence(len(ids))))
+    table = model.__table__
+    stmt = table.update().where(table.c.id == bindparam('node_id')).values(order_key=bindparam('node_key'))
+    for i in range(0, len(items), 1000):
+        db.session.execute(stmt, items[i:i + 1000])
+    return len(items)
+
+
+class QuestionCache:
+    """题目序列化结果的进程内 LRU 缓存；题库版本号变化 (其它 worker 改了标签/重新导题) 时整体失效"""
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sync(self, version):
+        if version == self.version: return
+        with self._lock:
+            if self.version is not None:
+                self.invalidations += 1
+            self._data.clear()
+            self.version = version
+
+    def get(self, key):
+        with self._lock:
+            payload = self._data.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload):
+        with self._lock:
+            self._data[key] = payload
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0,
+            "invalidations": self.invalidations
+        }
+
+
+class TagIndex:
+    """标签倒排索引：(mode, tag) -> {question_id}，每个 worker 进程构建一次，改标签时增量更新"""
+
+    def __init__(self):
+        self.by_tag = {}   # (mode, tag) -> set(question_id)
+        self.meta = {}     # question_id -> (mode, tags)
+        self.ready = False
+        self.version = None
+        self._lock = threading.Lock()
+
+    def ensure_built(self, version=None):
+        """首次使用时构建；题库版本号变了 (其它进程改过题库) 则重建"""
+        if self.ready and version == self.version: return
+        with self._lock:
+            if self.ready and version == self.version: return
+            self.by_tag.clear()
+            self.meta.clear()
+            for qid, mode, tags in db.session.query(Question.id, Question.mode, Question.tags):
+                self._add(qid, mode, tags)
+            self.ready = True
+            self.version = version
+
+    def _add(self, qid, mode, tags):
+        tags = tuple(tags or [])
+        self.meta[qid] = (mode, tags)
+        for t in tags:
+            self.by_tag.setdefault((mode, t), set()).add(qid)
+
+    def _remove(self, qid):
+        old = self.meta.pop(qid, None)
+        if not old: return
+        mode, tags = old
+        for t in tags:
+            bucket = self.by_tag.get((mode, t))
+            if bucket:
+                bucket.discard(qid)
+                if not bucket: del self.by_tag[(mode, t)]
+
+    def update(self, qid, mode, tags, previous, version):
+        """增量更新单题：只有索引正好停在本次修改之前的版本 (previous) 时才能直接套用；
+        否则中间还有其它 worker 的修改没读到，标记为待重建 (下次使用时整体重建)。
+        索引尚未构建时忽略，构建时会读到最新数据"""
+        if not self.ready: return
+        with self._lock:
+            if self.version != previous:
+                self.ready = False
+                return
+            self._remove(qid)
+            self._add(qid, mode, tags)
+            self.version = version
+
+    def candidates(self, qid, limit=50):
+        """同模式、标签有交集的题目，按重合标签数取前 limit 个：[(question_id, overlap), ...]"""
+        meta = self.meta.get(qid)
+        if not meta: return []
+        mode, tags = meta
+        overlap = Counter()
+        for t in tags:
+            overlap.update(self.by_tag.get((mode, t), ()))
+        overlap.pop(qid, None)
+        return heapq.nlargest(limit, overlap.items(), key=lambda x: x[1])
+
 
 class QuestionService:
     def __init__(self):
         # 遗忘曲线复习间隔 (单位: 天)
         self.review_intervals = [0, 1, 3, 7, 15, 30]
+        # 每日特训的进程内到期队列 {user_id: deque([question_id, ...])}，按最近使用淘汰，最多保留 due_queue_users 个用户
+        self._due_queues = OrderedDict()
+        self.due_queue_users = 1000
+        # 变式题查找用的标签倒排索引 (首次使用时构建)
+        self.tag_index = TagIndex()
+        self.variant_pool_size = 50
+        # 题目序列化结果缓存 (容量取自 QUESTION_CACHE_SIZE)
+        self.question_cache = QuestionCache()
 
     def _get_user(self):
-        """获取当前登录用户"""
-        if current_user.is_authenticated:
+        """获取当前登录用户 (命令行/批处理任务中没有请求上下文，返回 None)"""
+        if has_request_context() and current_user.is_authenticated:
             return current_user
         return None
 
@@ -24,8 +321,11 @@ class QuestionService:
         
         # 1. 创建默认错题本 'Inbox'
         if not Notebook.query.filter_by(user_id=user.id, name="Inbox").first():
-            inbox = Notebook(user_id=user.id, name="Inbox")
+            inbox = Notebook(user_id=user.id, name="Inbox", order_key=self._edge_order_key(Notebook, user.id, None))
             db.session.add(inbox)
+            db.session.flush()
+            set_path(inbox)
+            self._ensure_rollup(inbox.id)
 
         # 2. 创建默认说明笔记
         readme_title = "使用说明 (Read Me)"
@@ -60,91 +360,129 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
                 name=readme_title,
                 type="file",
                 content=content,
-                order_index=0 # 放在最前面
+                order_key=self._edge_order_key(Note, user.id, None, first=True), # 放在最前面
+                preview=plain_preview(content)
             )
             db.session.add(readme)
+            db.session.flush()
+            set_path(readme)
+            sync_note_links(readme.id, user.id, readme.content)
+            note_search.index_note(readme.id, user.id, readme.name, readme.content)
         
         db.session.commit()
 
     # ================= 辅助工具方法 =================
 
-    def get_question_by_id(self, q_id):
-        q = db.session.get(Question, q_id)
-        if not q: return None
-        return {
-            "id": q.id,
-            "content": q.content,
-            "options": q.options,
-            "correct_id": q.correct_id,
-            "analysis": q.analysis,
-            "tags": q.tags,
-            "mode": q.mode,
-            "ai_context": {"explanation": q.analysis}
-        }
+    def _question_version(self):
+        """读取题库版本号 (每个请求最多查一次)"""
+        if 'question_version' not in g:
+            row = db.session.get(CacheVersion, QUESTION_VERSION_KEY)
+            g.question_version = row.version if row else 0
+        return g.question_version
+
+    def bump_question_version(self):
+        """题库被修改后调用 (改标签/导题)：版本号递增，所有 worker 的题目缓存随之失效。
+        返回 (修改前的版本号, 新版本号)；先锁住版本行再读旧值，两次修改之间不会夹着别人的递增"""
+        acquire_write_lock(CacheVersion.__table__)
+        previous = db.session.query(CacheVersion.version).filter_by(
+            name=QUESTION_VERSION_KEY).with_for_update().scalar() or 0
+        now_ms = int(time.time() * 1000)
+        # 取 max(version + 1, 当前毫秒时间)，即使表被重建，新版本号也不会与旧 worker 手里的撞上
+        res = db.session.execute(update(CacheVersion).where(CacheVersion.name == QUESTION_VERSION_KEY).values(
+            version=case((CacheVersion.version + 1 > now_ms, CacheVersion.version + 1), else_=now_ms)
+        ))
+        if res.rowcount == 0:
+            db.session.add(CacheVersion(name=QUESTION_VERSION_KEY, version=now_ms))
+            db.session.flush()
+        g.pop('question_version', None)
+        return previous, self._question_version()
 
-    def _find_variant_question(self, original_q_id):
-        """[Restored] 查找变式题：Tag 相同但 ID 不同的题目"""
-        original_q = db.session.get(Question, original_q_id)
-        if not original_q or not original_q.tags:
+    def get_question_by_id(self, q_id):
+        cache = self.question_cache
+        cache.maxsize = current_app.config.get('QUESTION_CACHE_SIZE', cache.maxsize)
+        cache.sync(self._question_version())
+
+        payload = cache.get(q_id)
+        if payload is None:
+            q = db.session.get(Question, q_id, options=[db.undefer_group('body')])
+            if not q: return None
+            payload = {
+                "id": q.id,
+                "content": q.content,
+                "options": q.options,
+                "correct_id": q.correct_id,
+                "analysis": q.analysis,
+                "tags": q.tags,
+                "mode": q.mode,
+                "ai_context": {"explanation": q.analysis}
+            }
+            # 存一份独立的深拷贝，不与 ORM 对象共享 options/tags 列表
+            cache.put(q_id, copy.deepcopy(payload))
+            return payload
+        # 调用方可能修改 options/tags/ai_context 等嵌套字段，交出深拷贝，缓存条目不受影响
+        return copy.deepcopy(payload)
+
+    def _variant_candidates(self, q_id):
+        """同模式、标签有交集的候选题，按重合标签数排好：[(question_id, overlap), ...]
+        PostgreSQL 上直接查 tags 的 GIN 索引 (?| 运算符)，其它数据库用进程内的标签倒排索引"""
+        if db.session.get_bind().dialect.name != 'postgresql':
+            self.tag_index.ensure_built(self._question_version())
+            return self.tag_index.candidates(q_id, limit=self.variant_pool_size)
+        row = db.session.query(Question.mode, Question.tags).filter_by(id=q_id).first()
+        if not row or not row.tags: return []
+        rows = db.session.execute(text(
+            "SELECT q.id, (SELECT count(*) FROM jsonb_array_elements_text(q.tags) AS t(tag) WHERE t.tag = ANY(:tags)) AS overlap "
+            "FROM questions q WHERE q.mode = :mode AND q.tags ?| :tags AND q.id <> :id "
+            "ORDER BY overlap DESC LIMIT :limit"
+        ), {"tags": list(row.tags), "mode": row.mode, "id": q_id, "limit": self.variant_pool_size})
+        return [(qid, overlap) for qid, overlap in rows]
+
+    def _find_variant_question(self, original_q_id, exclude=()):
+        """[Restored] 查找变式题：Tag 相同但 ID 不同的题目 (exclude 中的题目不选，如同一批里已有的题)"""
+        candidates = [c for c in self._variant_candidates(original_q_id) if c[0] not in exclude]
+        if not candidates:
             return None
-        
-        original_tags = set(original_q.tags)
-        
-        # 在数据库中查找同模式的其他题目
-        #由于 SQLite JSON查询限制，这里先获取同模式题目再在内存筛选(数据量<1万时性能无损)
-        candidates_query = Question.query.filter(
-            Question.id != original_q_id, 
-            Question.mode == original_q.mode
-        ).all()
-        
-        candidates = []
-        for q in candidates_query:
-            q_tags = set(q.tags)
-            # 如果标签有交集，视为变式
-            if len(original_tags & q_tags) > 0:
-                candidates.append(q)
-        
-        if candidates:
-            # 优先选做得少的 (Attempts 少的)
-            # 需联表查询进度，这里简化为随机，或者再次查询进度
-            user = self._get_user()
-            if user:
-                # 简单排序：优先推没做过的
-                candidates.sort(key=lambda x: random.random()) 
-            return self.get_question_by_id(candidates[0].id)
-            
-        return None
+
+        # 优先选做得少的 (Attempts 少的)：一次批量查询候选题的做题进度
+        attempts = {}
+        user = self._get_user()
+        if user:
+            attempts = dict(db.session.query(QuestionProgress.question_id, QuestionProgress.attempts).filter(
+                QuestionProgress.user_id == user.id,
+                QuestionProgress.question_id.in_([cid for cid, _ in candidates])
+            ).all())
+
+        best_id, _ = min(candidates, key=lambda c: (attempts.get(c[0], 0), -c[1], random.random()))
+        return self.get_question_by_id(best_id)
 
     def _get_recursive_stats(self, notebook_id):
-        """[Restored] 递归计算文件夹及其子文件夹的统计数据"""
+        """[Restored] 计算文件夹及其子文件夹的统计数据：按物化路径一次查出整棵子树的题目标签与进度"""
         user = self._get_user()
-        node = db.session.get(Notebook, notebook_id)
-        if not node: return {"errors": 0, "proficiency": 0, "total": 0, "tags": {}}
-        
         stats = {"errors": 0, "proficiency": 0, "total": 0, "tags": {}}
-        
-        # 1. 统计当前节点的题目
-        for q in node.questions:
+
+        prefix = db.session.query(Notebook.path).filter_by(id=notebook_id, user_id=user.id).scalar()
+        if not prefix: return stats
+
+        # 子树 = 物化路径以当前节点路径开头的所有本子
+        rows = db.session.execute(
+            select(Question.tags, QuestionProgress.errors, QuestionProgress.proficiency)
+            .select_from(Notebook)
+            .join(notebook_questions, notebook_questions.c.notebook_id == Notebook.id)
+            .join(Question, Question.id == notebook_questions.c.question_id)
+            .outerjoin(QuestionProgress, and_(
+                QuestionProgress.question_id == Question.id,
+                QuestionProgress.user_id == user.id
+            ))
+            .where(Notebook.user_id == user.id, subtree_clause(Notebook.path, prefix))
+        )
+        for tags, errors, proficiency in rows:
             stats['total'] += 1
-            prog = QuestionProgress.query.filter_by(user_id=user.id, question_id=q.id).first()
-            if prog:
-                stats['errors'] += prog.errors
-                stats['proficiency'] += prog.proficiency
-            
+            stats['errors'] += errors or 0
+            stats['proficiency'] += proficiency or 0
             # 统计标签
-            for t in q.tags:
+            for t in tags or []:
                 stats['tags'][t] = stats['tags'].get(t, 0) + 1
-                
-        # 2. 递归统计子节点
-        for child in node.children:
-            child_stats = self._get_recursive_stats(child.id)
-            stats['errors'] += child_stats['errors']
-            stats['proficiency'] += child_stats['proficiency']
-            stats['total'] += child_stats['total']
-            # 合并标签统计
-            for t, count in child_stats['tags'].items():
-                stats['tags'][t] = stats['tags'].get(t, 0) + count
-                
+
         return stats
 
     def get_note_view(self, node_id="root"):
@@ -159,7 +497,7 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
         view_node = None # None 代表 Root 根目录
         
         if node_id != "root":
-            target_node = db.session.get(Note, node_id)
+            target_node = db.session.get(Note, node_id, options=[db.undefer(Note.content)])
             if not target_node: return {"error": "Not found"}
             if target_node.user_id != user.id: return {"error": "Access denied"}
             
@@ -173,49 +511,39 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
         # 2. 获取子项列表 (从视图上下文取)
         if view_node:
             # 特定文件夹下
-            children = view_node.children.order_by(Note.order_index).all()
+            children = view_node.children.order_by(Note.order_key).all()
         else:
             # 根目录下
-            children = Note.query.filter_by(user_id=user.id, parent_id=None).order_by(Note.order_index).all()
+            children = Note.query.filter_by(user_id=user.id, parent_id=None).order_by(Note.order_key).all()
 
         items = []
         for child in children:
-            preview = ""
-            if child.type == 'file' and child.content:
-                preview = child.content[:50]
             items.append({
                 "id": child.id,
                 "name": child.name,
                 "type": child.type,
-                "preview": preview
+                "preview": (child.preview or "")[:50] if child.type == 'file' else ""
             })
 
         # 3. 构建面包屑 (显示文件夹路径)
         breadcrumbs = []
-        curr = view_node
-        while curr:
-            breadcrumbs.insert(0, {"id": curr.id, "name": curr.name})
-            curr = curr.parent
+        if view_node:
+            # 路径上的祖先一次查出，层级再深也只有一条查询
+            chain = path_ids(view_node.path) or [view_node.id]
+            names = dict(db.session.query(Note.id, Note.name).filter(Note.id.in_(chain)).all())
+            breadcrumbs = [{"id": nid, "name": names[nid]} for nid in chain if nid in names]
         breadcrumbs.insert(0, {"id": "root", "name": "My Note"})
         # 4. 获取文件内容 (只针对 target_node)
         content = None
         backlinks = []
         
+        version = None
         if target_node and target_node.type == 'file':
             content = target_node.content
-            # 计算反向链接
-            target_tag = f"[[note:{target_node.id}]]"
-            refs = Note.query.filter(
-                Note.user_id == user.id, 
-                Note.content.contains(target_tag), 
-                Note.id != target_node.id
-            ).all()
-            for ref in refs:
-                backlinks.append({
-                    "id": ref.id, 
-                    "name": ref.name, 
-                    "preview": (ref.content or "")[:60] + "..."
-                })
+            version = target_node.version
+            # 计算反向链接 (走 note_links 索引)
+            refs = self._notes_linking_to('note', target_node.id, user.id)
+            backlinks = [ref for ref in refs if ref['id'] != target_node.id]
 
         # 5. 构造 Info 信息 (用于前端判断是显示编辑器还是文件夹视图)
         if target_node:
@@ -228,40 +556,74 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
             "items": items,
             "breadcrumbs": breadcrumbs,
             "content": content,
+            "version": version,
             "backlinks": backlinks
         }
 
     def create_note_item(self, name, type="folder", parent_id="root"):
         user = self._get_user()
         pid = None if parent_id == "root" else parent_id
-        # 计算排序：放在最后
-        max_order = db.session.query(func.max(Note.order_index)).filter_by(parent_id=pid).scalar()
-        new_order = (max_order or 0) + 1
-        
+        if pid:
+            parent = db.session.get(Note, pid)
+            if not parent or parent.user_id != user.id: return False
         new_note = Note(
             user_id=user.id,
             name=name,
             type=type,
             parent_id=pid,
             content="" if type == "file" else None,
-            order_index=new_order
+            order_key=self._edge_order_key(Note, user.id, pid) # 放在最后
         )
         db.session.add(new_note)
+        db.session.flush()
+        set_path(new_note)
+        if new_note.type == 'file':
+            note_search.index_note(new_note.id, user.id, name, new_note.content)
         db.session.commit()
         return True
 
-    def save_note_content(self, note_id, content):
+    def save_note_content(self, note_id, content=None, base_version=None, patch=None):
+        """保存笔记正文。
+        - patch={"start", "end", "text"}：相对 base_version 版本正文的一段替换 (UTF-16 偏移)，只传改动部分
+        - content：整篇正文 (旧客户端)
+        base_version 与当前版本不一致时拒绝 (conflict)，避免两个标签页互相覆盖；
+        内容哈希没变时不写库。返回 dict，失败时 success=False"""
         note = db.session.get(Note, note_id)
-        if note and note.user_id == self._get_user().id:
-            note.content = content
-            db.session.commit()
-            return True
-        return False
+        if not note or note.user_id != self._get_user().id or note.type != 'file':
+            return {"success": False}
+        if base_version is not None and base_version != note.version:
+            return {"success": False, "conflict": True, "version": note.version, "content": note.content}
+        if patch is not None:
+            if base_version is None: return {"success": False, "msg": "patch requires base_version"}
+            content = apply_text_patch(note.content, patch.get('start'), patch.get('end'), patch.get('text'))
+            if content is None: return {"success": False, "msg": "invalid patch"}
+        if content is None: return {"success": False}
+
+        digest = content_digest(content)
+        if digest == (note.content_hash or content_digest(note.content)):
+            return {"success": True, "version": note.version, "unchanged": True}
+
+        # 条件更新：版本号在读取之后被别的请求改过则本次不生效
+        result = db.session.execute(update(Note).where(Note.id == note.id, Note.version == note.version).values(
+            content=content, content_hash=digest, preview=plain_preview(content), version=Note.version + 1,
+            updated_at=datetime.now()
+        ).execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            db.session.rollback()
+            note = db.session.get(Note, note_id)
+            return {"success": False, "conflict": True, "version": note.version, "content": note.content}
+        sync_note_links(note.id, note.user_id, content)
+        note_search.index_note(note.id, note.user_id, note.name, content)
+        db.session.commit()
+        db.session.expire(note)
+        return {"success": True, "version": note.version}
 
     def rename_note_item(self, note_id, new_name):
         note = db.session.get(Note, note_id)
         if note and note.user_id == self._get_user().id:
             note.name = new_name
+            if note.type == 'file':
+                note_search.index_note(note.id, note.user_id, new_name, note.content)
             db.session.commit()
             return True
         return False
@@ -269,7 +631,15 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
     def delete_note_item(self, note_id):
         note = db.session.get(Note, note_id)
         if note and note.user_id == self._get_user().id:
-            db.session.delete(note)
+            # 整棵子树一条 DELETE，不走 ORM 级联逐个加载子孙 (先删掉这些笔记发出的引用)
+            ensure_paths(note)
+            table = Note.__table__
+            subtree = select(table.c.id).where(table.c.user_id == note.user_id, subtree_clause(table.c.path, note.path))
+            db.session.execute(NoteLink.__table__.delete().where(NoteLink.source_id.in_(subtree)))
+            note_search.remove_notes([r[0] for r in db.session.execute(subtree.where(table.c.type == 'file'))])
+            db.session.execute(table.delete().where(
+                table.c.user_id == note.user_id, subtree_clause(table.c.path, note.path)))
+            db.session.expunge(note)
             db.session.commit()
             return True
         return False
@@ -291,61 +661,176 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
             if not target_folder or target_folder.user_id != user.id:
                 return False
             
-            # 3. 死循环检查 (不能把爷爷移到孙子下面)
-            if note.type == 'folder':
-                cursor = target_folder
-                while cursor:
-                    if cursor.id == note.id:
-                        return False # 目标是自己的子孙
-                    cursor = cursor.parent
+            # 3. 死循环检查 (不能把爷爷移到孙子下面)：目标路径落在自己的子树里
+            ensure_paths(note, target_folder)
+            if target_folder.path.startswith(note.path):
+                return False
 
         # 4. 如果原地移动，直接返回成功
         if note.parent_id == pid:
             return True
 
-        # 5. 执行移动
-        # 计算新位置的 order_index (放在队尾)
-        max_order = db.session.query(func.max(Note.order_index)).filter_by(parent_id=pid).scalar()
-        new_order = (max_order or 0) + 1
-        
-        note.parent_id = pid
-        note.order_index = new_order
+        # 5. 执行移动 (放在新位置的队尾)
+        ensure_paths(note)
+        new_key = self._edge_order_key(Note, user.id, pid)
+        target = db.session.get(Note, pid) if pid else None
+        move_subtree(note, target)
+        note.order_key = new_key
         note.updated_at = datetime.now() # 强制更新时间戳
         
         db.session.commit()
         return True
 
+    def rebuild_note_paths(self, user_id=None):
+        count = rebuild_paths(Note, user_id)
+        db.session.commit()
+        return count
+
     def reorder_note_children(self, parent_id, new_order_ids):
-        for idx, nid in enumerate(new_order_ids):
-            note = db.session.get(Note, nid)
-            if note and note.user_id == self._get_user().id:
-                note.order_index = idx
+        pid = None if parent_id in (None, 'root') else parent_id
+        self._apply_order(Note, self._get_user().id, pid, new_order_ids or [])
         db.session.commit()
         return True
 
     def sort_note_children(self, parent_id, sort_by='name'):
         pid = None if parent_id == 'root' else parent_id
-        children = Note.query.filter_by(user_id=self._get_user().id, parent_id=pid).all()
+        children = db.session.query(Note.id, Note.name, Note.created_at).filter_by(
+            user_id=self._get_user().id, parent_id=pid).all()
         
         if sort_by == 'name':
             children.sort(key=lambda x: x.name.lower())
         elif sort_by == 'time':
             children.sort(key=lambda x: x.created_at, reverse=True)
             
-        for idx, note in enumerate(children):
-            note.order_index = idx
+        self._apply_order(Note, self._get_user().id, pid, [c.id for c in children])
         db.session.commit()
         return True
 
-    def search_notes(self, query):
+    # --- 排序键 (order_key) 的维护 ---
+
+    def _edge_order_key(self, model, user_id, parent_id, first=False):
+        """同级 (同一用户、同一父节点) 最前/最后位置的新排序键；键过长时提交后整组重排"""
+        agg = func.min if first else func.max
+        edge = db.session.query(agg(model.order_key)).filter(
+            model.user_id == user_id, model.parent_id == parent_id).scalar()
+        key = rank_before(edge) if first else rank_after(edge)
+        if needs_rebalance([key]):
+            self._rebalance_later(lambda: rebuild_order_keys(model, model.user_id == user_id, model.parent_id == parent_id))
+        return key
+
+    def _apply_order(self, model, user_id, parent_id, ordered_ids):
+        """按前端提交的完整新顺序，只改写相对次序变了的行 (一次拖拽只写一行)；不提交"""
+        current = dict(db.session.query(model.id, model.order_key).filter(
+            model.user_id == user_id, model.parent_id == parent_id, model.id.in_(ordered_ids)
+        ).all()) if ordered_ids else {}
+        changes = rerank(ordered_ids, current)
+        if not changes: return 0
+        table = model.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('node_id')).values(order_key=bindparam('node_key')),
+            [{"node_id": nid, "node_key": key} for nid, key in changes.items()]
+        )
+        if needs_rebalance(changes.values()):
+            self._rebalance_later(lambda: rebuild_order_keys(model, model.user_id == user_id, model.parent_id == parent_id))
+        return len(changes)
+
+    def _apply_question_order(self, book_id, ordered_ids):
+        """本子内题目顺序，同 _apply_order；不提交"""
+        nq = notebook_questions
+        current = dict(db.session.execute(select(nq.c.question_id, nq.c.order_key).where(
+            nq.c.notebook_id == book_id, nq.c.question_id.in_(ordered_ids)
+        )).all()) if ordered_ids else {}
+        changes = rerank(ordered_ids, current)
+        if not changes: return 0
+        db.session.execute(
+            nq.update().where(nq.c.notebook_id == book_id, nq.c.question_id == bindparam('q_id'))
+            .values(order_key=bindparam('q_key')),
+            [{"q_id": qid, "q_key": key} for qid, key in changes.items()]
+        )
+        if needs_rebalance(changes.values()):
+            self._rebalance_later(lambda: self._rebuild_question_order(book_id))
+        return len(changes)
+
+    def _rebuild_question_order(self, book_id):
+        nq = notebook_questions
+        ids = [r[0] for r in db.session.execute(select(nq.c.question_id).where(nq.c.notebook_id == book_id).order_by(
+            nq.c.order_key.is_(None), nq.c.order_key, nq.c.added_at))]
+        if ids:
+            db.session.execute(
+                nq.update().where(nq.c.notebook_id == book_id, nq.c.question_id == bindparam('q_id'))
+                .values(order_key=bindparam('q_key')),
+                [{"q_id": qid, "q_key": key} for qid, key in zip(ids, rank_sequence(len(ids)))]
+            )
+        return len(ids)
+
+    def _rebalance_later(self, job):
+        """排序键过长时，提交后在后台线程里整组重新均匀分配 (请求本身不等待)"""
+        app = current_app._get_current_object()
+        def run():
+            with app.app_context():
+                try:
+                    job()
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f'order_key rebalance failed: {e}')
+        # 等当前事务提交后再启动，避免读到未提交的键或和它抢写锁
+        event.listen(db.session(), 'after_commit',
+                     lambda session: threading.Thread(target=run, name='order-key-rebalance', daemon=True).start(),
+                     once=True)
+
+    def rebuild_order_keys(self, user_id=None):
+        """回填/重排笔记与错题本的排序键 (update_db / migrate / maintenance 使用)"""
+        count = 0
+        for model in (Note, Notebook):
+            count += rebuild_order_keys(model, *([model.user_id == user_id] if user_id else []))
+        db.session.commit()
+        return count
+
+    def search_notes(self, query, page=1, per_page=10):
+        """笔记全文检索：标题 + 正文，bm25 排序，带高亮摘要，分页 (page 从 1 开始)"""
         user = self._get_user()
         if not query: return []
-        results = Note.query.filter(
-            Note.user_id == user.id,
-            Note.type == 'file',
-            Note.name.ilike(f"%{query}%")
-        ).limit(10).all()
-        return [{"id": r.id, "name": r.name, "preview": (r.content or "")[:30]} for r in results]
+        limit, offset = per_page, (max(page, 1) - 1) * per_page
+        hits = note_search.search(user.id, query, limit, offset)
+        if hits is None:
+            # 非 SQLite / 无 FTS5：退回 LIKE (同样搜正文)
+            rows = db.session.query(Note.id, Note.name, Note.preview).filter(
+                Note.user_id == user.id,
+                Note.type == 'file',
+                or_(Note.name.ilike(f"%{query}%"), Note.content.ilike(f"%{query}%"))
+            ).order_by(Note.updated_at.desc()).limit(limit).offset(offset).all()
+            return [{"id": nid, "name": name, "name_html": note_search.render(name),
+                     "preview": head or "", "snippet": note_search.render(head)} for nid, name, head in rows]
+
+        names = dict(db.session.query(Note.id, Note.name).filter(Note.id.in_([h[0] for h in hits])).all()) if hits else {}
+        return [{"id": nid, "name": names[nid], "name_html": name_html,
+                 "preview": note_search.plain_text(snippet), "snippet": snippet}
+                for nid, name_html, snippet in hits if nid in names]
+
+    def backfill_previews(self, only_missing=True):
+        """按正文生成 notes.preview / questions.summary (分批读取，避免一次载入全部正文)"""
+        count = 0
+        for model, column in ((Note, 'preview'), (Question, 'summary')):
+            table = model.__table__
+            query = select(table.c.id, table.c.content)
+            if only_missing: query = query.where(or_(table.c[column].is_(None), table.c[column] == ''))
+            stmt = table.update().where(table.c.id == bindparam('row_id')).values({column: bindparam('row_text')})
+            rows = db.session.execute(query).fetchall()
+            for i in range(0, len(rows), 500):
+                batch = [{"row_id": rid, "row_text": plain_preview(content)} for rid, content in rows[i:i + 500]]
+                db.session.execute(stmt, batch)
+            count += len(rows)
+        db.session.commit()
+        return count
+
+    def rebuild_note_search(self, user_id=None):
+        """全量重建笔记全文索引 (回填/修复)"""
+        query = db.session.query(Note.id, Note.user_id, Note.name, Note.content).filter(Note.type == 'file')
+        if user_id: query = query.filter(Note.user_id == user_id)
+        count = note_search.rebuild(query.all(), user_id)
+        db.session.commit()
+        return count
     
     def get_note_by_id_simple(self, note_id):
         note = db.session.get(Note, note_id)
@@ -355,46 +840,230 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
 
     # ================= 错题本逻辑 (Mistake Notebooks) =================
 
+    # --- 统计汇总 (notebook_rollups) 的增量维护 ---
+
+    def _ancestor_ids(self, book_id):
+        """book_id 自身及其所有祖先的 ID (直接从物化路径解析)"""
+        return path_ids(db.session.query(Notebook.path).filter_by(id=book_id).scalar())
+
+
+    def _rollup_add(self, book_id, count=0, errors=0, proficiency=0, tags=None, direct=True):
+        """把增量累加到 book_id 及其所有祖先的汇总行 (direct_count 只加在 book_id 自己身上)；不提交"""
+        if not book_id: return
+        R = NotebookRollup
+        chain = self._ancestor_ids(book_id)
+        if count or errors or proficiency:
+            db.session.execute(update(R).where(R.notebook_id.in_(chain)).values(
+                total_count=R.total_count + count,
+                error_sum=R.error_sum + errors,
+                proficiency_sum=R.proficiency_sum + proficiency
+            ))
+            if direct and count:
+                db.session.execute(update(R).where(R.notebook_id == book_id).values(direct_count=R.direct_count + count))
+        tags = {t: n for t, n in (tags or {}).items() if n}
+        if tags:
+            # 每个 (本子, 标签) 一行，count = count + n 在库里累加；减到 0 的行删掉
+            T = NotebookRollupTag
+            stmt = upsert(T)
+            stmt = stmt.on_conflict_do_update(index_elements=['notebook_id', 'tag'], set_={"count": T.count + stmt.excluded['count']})
+            db.session.execute(stmt, [{"notebook_id": bid, "tag": t, "count": n} for bid in chain for t, n in tags.items()])
+            db.session.execute(T.__table__.delete().where(T.notebook_id.in_(chain), T.count <= 0))
+
+    def _rollup_membership(self, book, q_ids, sign):
+        """一批题目加入 (sign=1) 或移出 (sign=-1) 某个本子时，聚合一次进度与标签，再一次性更新该本子及祖先的汇总"""
+        if not q_ids: return
+        errors, proficiency = db.session.query(
+            func.coalesce(func.sum(QuestionProgress.errors), 0),
+            func.coalesce(func.sum(QuestionProgress.proficiency), 0)
+        ).filter(QuestionProgress.user_id == book.user_id, QuestionProgress.question_id.in_(q_ids)).one()
+        tags = Counter()
+        for (question_tags,) in db.session.query(Question.tags).filter(Question.id.in_(q_ids)):
+            tags.update(question_tags or [])
+        self._rollup_add(
+            book.id, count=sign * len(q_ids),
+            errors=sign * errors, proficiency=sign * proficiency,
+            tags={t: sign * n for t, n in tags.items()}
+        )
+
+    def _rollup_progress_change(self, user_id, q_id, d_errors, d_proficiency):
+        """某题进度变化后，更新该用户所有包含此题的本子 (及祖先) 的汇总"""
+        self._rollup_progress_changes(user_id, {q_id: (d_errors, d_proficiency)})
+
+    def _rollup_progress_changes(self, user_id, deltas, chunk_size=500):
+        """一批题目进度变化后更新汇总：一次查出包含这些题的本子 (带路径)，在内存里按本子及祖先累加，
+        再用一条 executemany UPDATE 写回 (按 notebook_id 顺序，多 worker 间加锁顺序一致)；不提交
+        deltas: {q_id: (d_errors, d_proficiency)}"""
+        deltas = {qid: d for qid, d in deltas.items() if d[0] or d[1]}
+        if not deltas: return
+        nq = notebook_questions
+        sums = {}
+        q_ids = list(deltas)
+        for i in range(0, len(q_ids), chunk_size):
+            rows = db.session.execute(
+                select(nq.c.question_id, Notebook.id, Notebook.path)
+                .join(Notebook, Notebook.id == nq.c.notebook_id)
+                .where(Notebook.user_id == user_id, nq.c.question_id.in_(q_ids[i:i + chunk_size]))
+            )
+            for qid, book_id, path in rows:
+                d_errors, d_proficiency = deltas[qid]
+                for bid in path_ids(path) or [book_id]:
+                    errors, proficiency = sums.get(bid, (0, 0))
+                    sums[bid] = (errors + d_errors, proficiency + d_proficiency)
+        if not sums: return
+        table = NotebookRollup.__table__
+        db.session.execute(
+            table.update().where(table.c.notebook_id == bindparam('book_id')).values(
+                error_sum=table.c.error_sum + bindparam('d_errors'),
+                proficiency_sum=table.c.proficiency_sum + bindparam('d_proficiency')
+            ),
+            [{"book_id": bid, "d_errors": e, "d_proficiency": p} for bid, (e, p) in sorted(sums.items())]
+        )
+
+    def _book_ids_containing(self, q_id, user_id=None):
+        stmt = select(notebook_questions.c.notebook_id).where(notebook_questions.c.question_id == q_id)
+        if user_id:
+            stmt = stmt.join(Notebook, Notebook.id == notebook_questions.c.notebook_id).where(Notebook.user_id == user_id)
+        return [r[0] for r in db.session.execute(stmt)]
+
+    def _rollup_tags(self, book_id, limit=None):
+        """汇总的标签直方图 [(tag, count)]，按计数从高到低"""
+        T = NotebookRollupTag
+        query = db.session.query(T.tag, T.count).filter(T.notebook_id == book_id).order_by(T.count.desc(), T.tag)
+        return query.limit(limit).all() if limit else query.all()
+
+    def _ensure_rollup(self, book_id):
+        if not db.session.get(NotebookRollup, book_id):
+            db.session.add(NotebookRollup(notebook_id=book_id))
+
+    def rebuild_notebook_rollups(self, user_id=None):
+        """按明细全量重算汇总表 (修复漂移)：一条聚合查询取直属数据，再在内存里自底向上累加"""
+        books = db.session.query(Notebook.id, Notebook.parent_id)
+        if user_id: books = books.filter(Notebook.user_id == user_id)
+        parents = dict(books.all())
+
+        rows = db.session.execute(
+            select(notebook_questions.c.notebook_id, Question.tags, QuestionProgress.errors, QuestionProgress.proficiency)
+            .join(Notebook, Notebook.id == notebook_questions.c.notebook_id)
+            .join(Question, Question.id == notebook_questions.c.question_id)
+            .outerjoin(QuestionProgress, and_(
+                QuestionProgress.question_id == Question.id,
+                QuestionProgress.user_id == Notebook.user_id
+            ))
+            .where(Notebook.id.in_(select(books.subquery().c.id)))
+        )
+        own = {bid: {"direct": 0, "errors": 0, "proficiency": 0, "tags": Counter()} for bid in parents}
+        for book_id, tags, errors, proficiency in rows:
+            agg = own[book_id]
+            agg['direct'] += 1
+            agg['errors'] += errors or 0
+            agg['proficiency'] += proficiency or 0
+            agg['tags'].update(tags or [])
+
+        # 自底向上：每个本子的数据加到自己和所有祖先上 (遇到环就停)
+        totals = {bid: {"total": 0, "errors": 0, "proficiency": 0, "tags": Counter()} for bid in parents}
+        for bid, agg in own.items():
+            cursor, visited = bid, set()
+            while cursor in totals and cursor not in visited:
+                visited.add(cursor)
+                t = totals[cursor]
+                t['total'] += agg['direct']
+                t['errors'] += agg['errors']
+                t['proficiency'] += agg['proficiency']
+                t['tags'].update(agg['tags'])
+                cursor = parents.get(cursor)
+
+        db.session.execute(NotebookRollup.__table__.delete().where(NotebookRollup.notebook_id.in_(list(parents))))
+        db.session.execute(NotebookRollupTag.__table__.delete().where(NotebookRollupTag.notebook_id.in_(list(parents))))
+        if parents:
+            db.session.execute(insert(NotebookRollup), [{
+                "notebook_id": bid,
+                "direct_count": own[bid]['direct'],
+                "total_count": t['total'],
+                "error_sum": t['errors'],
+                "proficiency_sum": t['proficiency'],
+                "updated_at": datetime.now()
+            } for bid, t in totals.items()])
+            tag_rows = [{"notebook_id": bid, "tag": tag, "count": n}
+                        for bid, t in totals.items() for tag, n in t['tags'].items() if n > 0]
+            if tag_rows:
+                db.session.execute(insert(NotebookRollupTag), tag_rows)
+        db.session.commit()
+        return len(parents)
+
+
+
+    # --- 题目归属 (notebook_questions) 的集合操作：不加载 book.questions ---
+
+    def _add_members(self, book, q_ids):
+        """INSERT ... SELECT ... ON CONFLICT DO NOTHING：只插入存在且尚未在本子里的题目，
+        返回真正新加入的题目 ID，并同步汇总；不提交"""
+        q_ids = list(dict.fromkeys(q_ids or []))
+        if not q_ids: return []
+        nq = notebook_questions
+        stmt = upsert(nq).from_select(
+            ['notebook_id', 'question_id', 'added_at'],
+            select(literal(book.id), Question.id, literal(datetime.now())).where(
+                Question.id.in_(q_ids),
+                ~exists().where(nq.c.notebook_id == book.id, nq.c.question_id == Question.id)
+            )
+        ).on_conflict_do_nothing().returning(nq.c.question_id)
+        added = [r[0] for r in db.session.execute(stmt)]
+        self._rollup_membership(book, added, 1)
+        return added
+
+    def _remove_members(self, book, q_ids):
+        """DELETE ... RETURNING：移出一批题目，返回真正被移出的题目 ID，并同步汇总；不提交"""
+        q_ids = list(dict.fromkeys(q_ids or []))
+        if not q_ids: return []
+        nq = notebook_questions
+        removed = [r[0] for r in db.session.execute(
+            nq.delete().where(nq.c.notebook_id == book.id, nq.c.question_id.in_(q_ids)).returning(nq.c.question_id)
+        )]
+        self._rollup_membership(book, removed, -1)
+        return removed
+
+    def _owned_book(self, book_id):
+        book = db.session.get(Notebook, book_id) if book_id else None
+        if book and book.user_id == self._get_user().id: return book
+        return None
+
+    def move_questions(self, q_ids, from_book_id, to_book_id):
+        """批量移动：从旧本子移出 -> 加入新本子，返回移动的题目数 (失败返回 None)"""
+        if from_book_id == to_book_id: return None
+        old_book, new_book = self._owned_book(from_book_id), self._owned_book(to_book_id)
+        if not (old_book and new_book): return None
+        removed = self._remove_members(old_book, q_ids)
+        self._add_members(new_book, q_ids)
+        db.session.commit()
+        return len(removed)
+
+    def copy_questions(self, q_ids, to_book_id):
+        """批量复制 (保留在源本子，同时加入目标本子)，返回新加入的题目数 (失败返回 None)"""
+        new_book = self._owned_book(to_book_id)
+        if not new_book: return None
+        added = self._add_members(new_book, q_ids)
+        db.session.commit()
+        return len(added)
 
+    def remove_questions(self, book_id, q_ids):
+        """批量从本子中移除 (不删除题目本身)，返回移除的题目数 (失败返回 None)"""
+        book = self._owned_book(book_id)
+        if not book: return None
+        removed = self._remove_members(book, q_ids)
+        db.session.commit()
+        return len(removed)
 
     # --- [NEW] 题目管理 (移动/复制/标签) ---
 
     def move_question_to_book(self, q_id, from_book_id, to_book_id):
         """移动题目：从旧本子移除 -> 加入新本子"""
-        user = self._get_user()
-        if from_book_id == to_book_id: return False
-        
-        # 1. 获取两个本子
-        old_book = db.session.get(Notebook, from_book_id)
-        new_book = db.session.get(Notebook, to_book_id)
-        question = db.session.get(Question, q_id)
-        
-        if not (old_book and new_book and question): return False
-        if old_book.user_id != user.id or new_book.user_id != user.id: return False
-        
-        # 2. 执行移动
-        if question in old_book.questions:
-            old_book.questions.remove(question)
-        if question not in new_book.questions:
-            new_book.questions.append(question)
-            
-        db.session.commit()
-        return True
+        if not db.session.get(Question, q_id): return False
+        return self.move_questions([q_id], from_book_id, to_book_id) is not None
 
     # 2. [NEW] 新增复制逻辑 (保留在源本子，同时加入目标本子)
     def copy_question_to_book(self, q_id, to_book_id):
-        user = self._get_user()
-        new_book = db.session.get(Notebook, to_book_id)
-        question = db.session.get(Question, q_id)
-        
-        if not (new_book and question): return False
-        if new_book.user_id != user.id: return False
-        
-        if question not in new_book.questions:
-            new_book.questions.append(question)
-            db.session.commit()
-            return True
-        return True # 已经在里面了也算成功
+        if not db.session.get(Question, q_id): return False
+        return self.copy_questions([q_id], to_book_id) is not None # 已经在里面了也算成功
 
     def update_question_tags(self, q_id, new_tags):
         """更新题目标签"""
@@ -402,23 +1071,24 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
         # 如果你想只修改当前本子的标签，那逻辑会极其复杂。这里默认修改题目全局标签。
         question = db.session.get(Question, q_id)
         if question:
+            # 所有包含这道题的本子，标签直方图随之调整
+            delta = Counter(new_tags)
+            delta.subtract(question.tags or [])
+            delta = {t: n for t, n in delta.items() if n}
+            if delta:
+                for book_id in self._book_ids_containing(q_id):
+                    self._rollup_add(book_id, tags=delta)
+
             question.tags = new_tags
+            previous, version = self.bump_question_version()
             db.session.commit()
+            self.tag_index.update(question.id, question.mode, new_tags, previous, version)
             return True
         return False
     
     def remove_question_from_book(self, book_id, q_id):
         """从本子中移除题目 (不删除题目本身)"""
-        user = self._get_user()
-        book = db.session.get(Notebook, book_id)
-        question = db.session.get(Question, q_id)
-        
-        if book and question and book.user_id == user.id:
-            if question in book.questions:
-                book.questions.remove(question)
-                db.session.commit()
-                return True
-        return False
+        return bool(self.remove_questions(book_id, [q_id]))
 
     def get_notebook_view(self, notebook_id="root"):
         user = self._get_user()
@@ -426,7 +1096,7 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
         # 1. 获取当前节点结构
         if notebook_id == "root":
             current_node = None
-            sub_books = Notebook.query.filter_by(user_id=user.id, parent_id=None).order_by(Notebook.order_index).all()
+            sub_books = Notebook.query.filter_by(user_id=user.id, parent_id=None).order_by(Notebook.order_key).all()
             breadcrumbs = []
             current_level_questions = [] # 根目录不直接显示题
             node_tags = []
@@ -434,29 +1104,35 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
             current_node = db.session.get(Notebook, notebook_id)
             if not current_node or current_node.user_id != user.id: return {"error": "Not found"}
             
-            sub_books = current_node.children
+            sub_books = current_node.children.order_by(Notebook.order_key)
             node_tags = current_node.tags
             
-            # 获取直属题目 (Direct Children Only)
+            # 获取直属题目 (Direct Children Only)：归属表 + 题目摘要列 (summary，不读正文) + 本人进度，一条联表查询
+            rows = db.session.execute(
+                select(Question.id, Question.tags, Question.summary, QuestionProgress.proficiency)
+                .join(notebook_questions, notebook_questions.c.question_id == Question.id)
+                .outerjoin(QuestionProgress, and_(
+                    QuestionProgress.question_id == Question.id,
+                    QuestionProgress.user_id == user.id
+                ))
+                .where(notebook_questions.c.notebook_id == current_node.id)
+                .order_by(notebook_questions.c.order_key.is_(None), notebook_questions.c.order_key, notebook_questions.c.added_at)
+            )
             current_level_questions = []
-            for q in current_node.questions:
-                prog = QuestionProgress.query.filter_by(user_id=user.id, question_id=q.id).first()
-                prof = prog.proficiency if prog else 0
-                
-                final_tags = list(set(q.tags + node_tags))
+            for q_id, q_tags, head, prof in rows:
+                final_tags = list(set((q_tags or []) + (node_tags or [])))
                 
                 current_level_questions.append({
-                    "id": q.id,
-                    "summary": q.content[:30].replace('<p>', '').replace('</p>', '') + "...",
+                    "id": q_id,
+                    "summary": (head or '')[:30] + "...",
                     "tags": final_tags,
-                    "proficiency": prof
+                    "proficiency": prof or 0
                 })
             
-            breadcrumbs = []
-            curr = current_node
-            while curr:
-                breadcrumbs.insert(0, {"id": curr.id, "name": curr.name})
-                curr = curr.parent
+            # 面包屑：路径上的祖先一次查出
+            chain = path_ids(current_node.path) or [current_node.id]
+            names = dict(db.session.query(Notebook.id, Notebook.name).filter(Notebook.id.in_(chain)).all())
+            breadcrumbs = [{"id": nid, "name": names[nid]} for nid in chain if nid in names]
 
             breadcrumbs.insert(0, {"id": "root", "name": "My Library"})
         # 2. [Restored] 递归计算统计数据 (Total, Avg Prof, Top Tags)
@@ -465,27 +1141,39 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
             # 根目录做个简化统计，或者遍历所有
             stats = {"errors": 0, "proficiency": 0, "total": 0, "top_tags": []} # 根目录暂简略
         else:
-            raw_stats = self._get_recursive_stats(notebook_id)
-            avg_prof = int(raw_stats['proficiency'] / raw_stats['total']) if raw_stats['total'] > 0 else 0
+            # 直接读物化汇总表 (按主键取一行)；缺失时 (老数据，待 update_db / maintenance.py rebuild-rollups 回填)
+            # 退回按物化路径现算，GET 里不写库
+            rollup = db.session.get(NotebookRollup, notebook_id)
+            if rollup:
+                errors, proficiency, total = rollup.error_sum, rollup.proficiency_sum, rollup.total_count
+                sorted_tags = self._rollup_tags(notebook_id, limit=8)
+            else:
+                live = self._get_recursive_stats(notebook_id)
+                errors, proficiency, total = live['errors'], live['proficiency'], live['total']
+                sorted_tags = sorted(live['tags'].items(), key=lambda x: x[1], reverse=True)[:8]
+            avg_prof = int(proficiency / total) if total > 0 else 0
             
             # 排序 Tags
-            sorted_tags = sorted(raw_stats['tags'].items(), key=lambda x: x[1], reverse=True)[:8]
             top_tags = [{"name": k, "count": v} for k,v in sorted_tags]
             
             stats = {
-                "errors": raw_stats['errors'],
-                "proficiency": raw_stats['proficiency'], # 总熟练度分
-                "avg_prof": avg_prof,                    # 平均分
-                "total": raw_stats['total'],             # 总题数
+                "errors": errors,
+                "proficiency": proficiency,   # 总熟练度分
+                "avg_prof": avg_prof,         # 平均分
+                "total": total,               # 总题数
                 "top_tags": top_tags
             }
 
-        # 3. 格式化子目录
+        # 3. 格式化子目录 (直属题数同样取自汇总表，一条查询)
+        sub_books = list(sub_books)
+        direct_counts = dict(db.session.query(NotebookRollup.notebook_id, NotebookRollup.direct_count).filter(
+            NotebookRollup.notebook_id.in_([sub.id for sub in sub_books])
+        ).all()) if sub_books else {}
         sub_notebooks_data = []
         for sub in sub_books:
             # 这里显示直属题数还是递归题数？通常显示递归题数更有用
-            # 为了性能，这里先显示直属，如果需要递归，可以调用 _get_recursive_stats(sub.id)['total']
-            count = len(sub.questions) 
+            # 为了性能，这里先显示直属；递归题数见汇总表的 total_count
+            count = direct_counts.get(sub.id, 0)
             sub_notebooks_data.append({
                 "id": sub.id,
                 "name": sub.name,
@@ -508,30 +1196,35 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
     def get_notebook_list_simple(self):
         user = self._get_user()
         options = []
+        # 一条查询取出整棵树，再在内存里按层级展开
+        books = db.session.query(Notebook.id, Notebook.name, Notebook.parent_id).filter_by(
+            user_id=user.id).order_by(Notebook.order_key).all()
+        children = {}
+        for book in books:
+            children.setdefault(book.parent_id, []).append(book)
         def traverse(parent_id, level=0):
-            pid = None if parent_id == 'root' else parent_id
-            books = Notebook.query.filter_by(user_id=user.id, parent_id=pid).all()
-            for book in books:
+            for book in children.get(parent_id, []):
                 options.append({"id": book.id, "name": ("— " * level) + book.name})
                 traverse(book.id, level + 1)
-        traverse('root')
+        traverse(None)
         return options
 
     def add_question_to_target_book(self, book_id, q_id):
-        notebook = db.session.get(Notebook, book_id)
-        question = db.session.get(Question, q_id)
-        if notebook and question and notebook.user_id == self._get_user().id:
-            if question not in notebook.questions:
-                notebook.questions.append(question)
-                db.session.commit()
-            return True
-        return False
+        if not db.session.get(Question, q_id): return False
+        return self.copy_questions([q_id], book_id) is not None
 
     def create_notebook(self, name, parent_id="root", tags=[]):
         user = self._get_user()
         pid = None if parent_id == "root" else parent_id
-        new_book = Notebook(user_id=user.id, name=name, parent_id=pid, tags=tags)
+        if pid:
+            parent = db.session.get(Notebook, pid)
+            if not parent or parent.user_id != user.id: return False
+        new_book = Notebook(user_id=user.id, name=name, parent_id=pid, tags=tags,
+                            order_key=self._edge_order_key(Notebook, user.id, pid))
         db.session.add(new_book)
+        db.session.flush()
+        set_path(new_book)
+        self._ensure_rollup(new_book.id)
         db.session.commit()
         return True
 
@@ -546,7 +1239,21 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
     def delete_notebook(self, book_id):
         book = db.session.get(Notebook, book_id)
         if book and book.user_id == self._get_user().id:
-            db.session.delete(book)
+            ensure_paths(book)
+            # 祖先扣掉整棵子树的汇总
+            rollup = db.session.get(NotebookRollup, book.id)
+            if rollup:
+                self._rollup_add(book.parent_id, count=-rollup.total_count, errors=-rollup.error_sum,
+                                 proficiency=-rollup.proficiency_sum,
+                                 tags={t: -n for t, n in self._rollup_tags(book.id)}, direct=False)
+
+            # 整棵子树用集合语句删除 (不走 ORM 级联逐个加载)
+            subtree = select(Notebook.id).where(Notebook.user_id == book.user_id, subtree_clause(Notebook.path, book.path))
+            db.session.execute(notebook_questions.delete().where(notebook_questions.c.notebook_id.in_(subtree)))
+            db.session.execute(NotebookRollup.__table__.delete().where(NotebookRollup.notebook_id.in_(subtree)))
+            db.session.execute(NotebookRollupTag.__table__.delete().where(NotebookRollupTag.notebook_id.in_(subtree)))
+            db.session.execute(Notebook.__table__.delete().where(Notebook.id.in_(subtree)))
+            db.session.expunge(book)
             db.session.commit()
             return True
         return False
@@ -554,84 +1261,283 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
     def move_notebook(self, book_id, new_parent_id):
         book = db.session.get(Notebook, book_id)
         pid = None if new_parent_id == 'root' else new_parent_id
-        # 检查死循环略
         if book and book.user_id == self._get_user().id:
-            book.parent_id = pid
+            target = None
+            if pid:
+                target = db.session.get(Notebook, pid)
+                if not target or target.user_id != book.user_id: return False
+            ensure_paths(book, target)
+            if target:
+                # 死循环检查：目标在自己的子树里 (含自身)
+                if target.path.startswith(book.path): return False
+            if book.parent_id == pid: return True
+
+            # 整棵子树的汇总从旧祖先链挪到新祖先链
+            rollup = db.session.get(NotebookRollup, book.id)
+            if rollup:
+                moved = dict(count=rollup.total_count, errors=rollup.error_sum, proficiency=rollup.proficiency_sum)
+                tags = dict(self._rollup_tags(book.id))
+                self._rollup_add(book.parent_id, **{k: -v for k, v in moved.items()},
+                                 tags={t: -n for t, n in tags.items()}, direct=False)
+            new_key = self._edge_order_key(Notebook, book.user_id, pid)
+            move_subtree(book, target)
+            book.order_key = new_key
+            if rollup:
+                self._rollup_add(pid, **moved, tags=tags, direct=False)
             db.session.commit()
             return True
         return False
 
+    def rebuild_notebook_paths(self, user_id=None):
+        count = rebuild_paths(Notebook, user_id)
+        db.session.commit()
+        return count
+
     def reorder_notebook_content(self, book_id, sub_order=None, q_order=None):
+        """sub_order: 子文件夹的完整新顺序；q_order: 本子内题目的完整新顺序 (都只改写移动过的行)"""
+        user = self._get_user()
+        pid = None if book_id in (None, 'root') else book_id
+        if pid:
+            book = db.session.get(Notebook, pid)
+            if not book or book.user_id != user.id: return False
         if sub_order:
-            for idx, nid in enumerate(sub_order):
-                book = db.session.get(Notebook, nid)
-                if book and book.user_id == self._get_user().id:
-                    book.order_index = idx
-            db.session.commit()
+            self._apply_order(Notebook, user.id, pid, sub_order)
+        if q_order and pid:
+            self._apply_question_order(pid, q_order)
+        db.session.commit()
         return True
 
     # ================= 做题与分发逻辑 (Quiz) =================
 
+    def _build_deck(self, user_id, mode):
+        """重新洗牌：取该模式全部题目 ID，打乱后整副写入 question_deck_cards"""
+        ids = [r[0] for r in db.session.query(Question.id).filter_by(mode=mode).all()]
+        if not ids: return None
+        random.shuffle(ids)
+
+        QuestionDeckCard.query.filter_by(user_id=user_id, mode=mode).delete()
+        db.session.execute(insert(QuestionDeckCard), [
+            {"user_id": user_id, "mode": mode, "position": idx, "question_id": qid}
+            for idx, qid in enumerate(ids)
+        ])
+
+        deck = db.session.get(QuestionDeck, (user_id, mode))
+        if not deck:
+            deck = QuestionDeck(user_id=user_id, mode=mode)
+            db.session.add(deck)
+        deck.cursor = 0
+        deck.size = len(ids)
+        deck.built_at = datetime.now()
+        return deck
+
+    def _draw_from_deck(self, user_id, mode, count=1):
+        """领取接下来的 count 张牌 (按位置范围一次读出)；整副发完后自动重新洗牌，保证一轮内不重复。不提交，由调用方提交一次。
+        先锁住牌堆行 (SQLite 提前拿写锁，PostgreSQL 行不存在时先插入再 SELECT ... FOR UPDATE)，
+        读游标、发完时重新洗牌、推进游标都在这把锁下完成：并发请求既不会领到同一位置，也不会各自重洗一遍"""
+        acquire_write_lock(QuestionDeck.__table__)
+        db.session.execute(upsert(QuestionDeck).values(user_id=user_id, mode=mode, cursor=0, size=0).on_conflict_do_nothing())
+        deck = db.session.query(QuestionDeck).filter_by(user_id=user_id, mode=mode).with_for_update().populate_existing().one()
+
+        q_ids = []
+        rebuilt = False
+        while len(q_ids) < count:
+            if deck.cursor >= deck.size:
+                # 没有牌或已发完：重新洗牌 (每次最多一次，题库为空时不空转)
+                if rebuilt or not self._build_deck(user_id, mode): break
+                rebuilt = True
+            n = min(count - len(q_ids), deck.size - deck.cursor)
+            q_ids += db.session.execute(
+                select(QuestionDeckCard.question_id)
+                .where(QuestionDeckCard.user_id == user_id, QuestionDeckCard.mode == mode,
+                       QuestionDeckCard.position >= deck.cursor, QuestionDeckCard.position < deck.cursor + n)
+                .order_by(QuestionDeckCard.position)
+            ).scalars().all()
+            deck.cursor += n
+        return q_ids
+
+    def _sample_due_ids(self, user_id, limit):
+        """在 SQL 中对到期错题随机抽样 (走 ix_progress_due_queue 索引，只取 limit 条)"""
+        rows = db.session.query(QuestionProgress.question_id).filter(
+            QuestionProgress.user_id == user_id,
+            QuestionProgress.next_review_time <= time.time(),
+            QuestionProgress.errors > 0
+        ).order_by(func.random()).limit(limit).all()
+        return [r[0] for r in rows]
+
+    def _due_ids(self, user_id, limit):
+        """下一批到期错题：先取夜间批处理 (scheduler.py) 按逾期时长排好的队列，只留仍然到期的 (一次索引查询复查)；
+        不够 limit 条 (队列已做完、尚未生成，或夜间之后新到期的题) 再随机抽样补足"""
+        row = db.session.get(UserDueQueue, user_id)
+        ids = []
+        if row and row.question_ids:
+            still_due = {r[0] for r in db.session.query(QuestionProgress.question_id).filter(
+                QuestionProgress.user_id == user_id,
+                QuestionProgress.question_id.in_(row.question_ids),
+                QuestionProgress.next_review_time <= time.time(),
+                QuestionProgress.errors > 0
+            )}
+            ids = [q_id for q_id in row.question_ids if q_id in still_due][:limit]
+        if len(ids) < limit:
+            queued = set(ids)
+            ids += [q_id for q_id in self._sample_due_ids(user_id, limit) if q_id not in queued][:limit - len(ids)]
+        return ids
+
+    def _next_due_question_id(self, user_id):
+        """从到期队列取下一题，队列空了再按批次从数据库补充"""
+        batch = current_app.config.get('DAILY_QUEUE_BATCH', 0)
+        if batch <= 0:
+            ids = self._due_ids(user_id, 1)
+            return ids[0] if ids else None
+
+        queue = self._due_queues.get(user_id)
+        if queue is not None:
+            self._due_queues.move_to_end(user_id)
+        # 队列里的题可能已在别的 worker 上作答过 (复习时间已后移)，出题前逐个按索引复查，过期的跳过
+        while queue:
+            q_id = queue.popleft()
+            if self._is_due(user_id, q_id): return q_id
+
+        queue = deque(self._due_ids(user_id, batch))
+        self._due_queues[user_id] = queue
+        self._due_queues.move_to_end(user_id)
+        while len(self._due_queues) > self.due_queue_users:
+            self._due_queues.popitem(last=False)
+        return queue.popleft() if queue else None
+
+    def _is_due(self, user_id, q_id):
+        """按 (user_id, question_id) 唯一索引复查一题是否仍然到期"""
+        return db.session.query(QuestionProgress.id).filter(
+            QuestionProgress.user_id == user_id,
+            QuestionProgress.question_id == q_id,
+            QuestionProgress.next_review_time <= time.time(),
+            QuestionProgress.errors > 0
+        ).first() is not None
+
+    def _discard_due(self, user_id, q_id):
+        """题目已作答 (复习时间已后移)，从本进程的到期队列里剔除"""
+        queue = self._due_queues.get(user_id)
+        if queue and q_id in queue:
+            queue.remove(q_id)
+
     def get_question(self, mode="training", q_id=None, book_id=None):
-        user = self._get_user()
-        
         # 1. 定向 ID
         if q_id: 
             q_obj = self.get_question_by_id(q_id)
             if q_obj: return q_obj
 
-        target_q = None
+        batch = self.get_questions(mode=mode, count=1, book_id=book_id)
+        return batch[0] if batch else None
+
+    def get_questions(self, mode="training", count=1, book_id=None):
+        """批量取接下来的 count 道题 (前端预取队列用)，各模式的出题与变式逻辑与单题一致"""
+        user = self._get_user()
+        picks = []
+        seen = set()
+
+        def take(q_id):
+            # 同一批内去重 (队列补充/重新洗牌时可能再次抽到尚未作答的题)
+            if q_id in seen: return None
+            seen.add(q_id)
+            q = self.get_question_by_id(q_id)
+            if q: picks.append(q)
+            return q
 
         # 2. 每日特训
         if mode == 'daily':
-            now = time.time()
-            due_progs = QuestionProgress.query.filter(
-                QuestionProgress.user_id == user.id,
-                QuestionProgress.next_review_time <= now,
-                QuestionProgress.errors > 0
-            ).all()
-            
-            if due_progs:
-                prog = random.choice(due_progs)
-                target_q = self.get_question_by_id(prog.question_id)
-                if target_q: target_q['is_due'] = True
-            else:
+            for _ in range(count):
+                due_id = self._next_due_question_id(user.id)
+                if not due_id: break
+                q = take(due_id)
+                if q: q['is_due'] = True
+
+            if not picks:
                 low_prog = QuestionProgress.query.filter(
                     QuestionProgress.user_id == user.id,
                     QuestionProgress.proficiency < 80
                 ).first()
                 if low_prog:
-                    target_q = self.get_question_by_id(low_prog.question_id)
+                    take(low_prog.question_id)
 
         # 3. 错题本模式
         elif mode == 'mistake' and book_id:
             book = db.session.get(Notebook, book_id)
-            if book and book.user_id == user.id and book.questions:
-                q_orm = random.choice(book.questions)
-                target_q = self.get_question_by_id(q_orm.id)
-                if target_q: target_q['custom_tags'] = book.tags
+            if book and book.user_id == user.id:
+                # 在 SQL 中随机抽取题目 ID，不加载整本题目
+                sampled = db.session.execute(
+                    select(notebook_questions.c.question_id)
+                    .where(notebook_questions.c.notebook_id == book.id)
+                    .order_by(func.random()).limit(count)
+                ).scalars().all()
+                for sampled_id in sampled:
+                    q = take(sampled_id)
+                    if q: q['custom_tags'] = book.tags
 
         # 4. 普通/考试模式
         else:
-            q_orm = Question.query.filter_by(mode=mode).order_by(func.random()).first()
-            if q_orm:
-                target_q = self.get_question_by_id(q_orm.id)
+            # 一次领取整批并提交 (锁只在领取期间持有)；题目可能在洗牌后被删除，遇到空牌再补领
+            for _ in range(3):
+                if len(picks) >= count: break
+                q_ids = self._draw_from_deck(user.id, mode, count - len(picks))
+                db.session.commit()
+                if not q_ids: break
+                for next_id in q_ids: take(next_id)
 
         # --- [Restored] 智能变式逻辑 ---
-        if target_q and mode in ['daily', 'mistake']:
-            # 检查做题次数
-            prog = QuestionProgress.query.filter_by(user_id=user.id, question_id=target_q['id']).first()
-            attempts = prog.attempts if prog else 0
-            
-            # 如果太熟了 (做过3次以上)，尝试换变式
-            if attempts > 3:
-                variant = self._find_variant_question(target_q['id'])
-                if variant:
-                    variant['is_variant_of'] = target_q['content'][:20] + "..."
-                    variant['custom_tags'] = target_q.get('custom_tags', [])
-                    return variant
-
-        return target_q
+        if picks and mode in ['daily', 'mistake']:
+            # 检查做题次数 (整批一次查询)
+            attempts = dict(db.session.query(QuestionProgress.question_id, QuestionProgress.attempts).filter(
+                QuestionProgress.user_id == user.id,
+                QuestionProgress.question_id.in_([q['id'] for q in picks])
+            ).all())
+
+            for idx, target_q in enumerate(picks):
+                # 如果太熟了 (做过3次以上)，尝试换变式
+                if (attempts.get(target_q['id']) or 0) > 3:
+                    # 同一批里已有的题 (含之前换上的变式) 不再选，保证整批不重复
+                    variant = self._find_variant_question(target_q['id'], exclude=seen)
+                    if variant:
+                        seen.add(variant['id'])
+                        variant['is_variant_of'] = target_q['content'][:20] + "..."
+                        variant['custom_tags'] = target_q.get('custom_tags', [])
+                        picks[idx] = variant
+
+        return picks
+
+    def _schedule(self, stage, proficiency, is_correct, now):
+        """遗忘曲线调度 (Python 版)：由作答前的 stage/proficiency 算出作答后的 (stage, proficiency, next_review_time)"""
+        if is_correct:
+            next_stage = min(stage + 1, len(self.review_intervals) - 1)
+            return next_stage, min(100, proficiency + 15), now + (self.review_intervals[next_stage] * 24 * 3600)
+        return 0, max(0, proficiency - 10), now + (12 * 3600)
+
+    def _schedule_sql(self, is_correct, now):
+        """与 _schedule 相同的规则，写成基于当前行值的 SQL 表达式，供 UPSERT 的 DO UPDATE 使用"""
+        P = QuestionProgress
+        attempts = func.coalesce(P.attempts, 0)
+        errors = func.coalesce(P.errors, 0)
+        proficiency = func.coalesce(P.proficiency, 0)
+        stage = func.coalesce(P.stage, 0)
+
+        values = {"attempts": attempts + 1, "last_reviewed_at": datetime.now()}
+        if is_correct:
+            max_stage = len(self.review_intervals) - 1
+            next_stage = case((stage + 1 > max_stage, max_stage), else_=stage + 1)
+            values.update(
+                proficiency=case((proficiency + 15 > 100, 100), else_=proficiency + 15),
+                stage=next_stage,
+                next_review_time=now + case(
+                    {idx: days * 24 * 3600 for idx, days in enumerate(self.review_intervals)},
+                    value=next_stage, else_=self.review_intervals[-1] * 24 * 3600
+                )
+            )
+        else:
+            values.update(
+                errors=errors + 1,
+                proficiency=case((proficiency - 10 < 0, 0), else_=proficiency - 10),
+                stage=0,
+                next_review_time=now + (12 * 3600)
+            )
+        return values
 
     def check_answer(self, q_id, user_choice):
         user = self._get_user()
@@ -640,51 +1546,71 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
         
         is_correct = (user_choice == question['correct_id'])
         
-        # 1. 记录流水日志
-        log = QuestionLog(
+        # 1. 记录流水日志 (开启写后缓冲时只入队，由后台线程批量落库)
+        log = dict(
             user_id=user.id,
             question_id=q_id,
             is_correct=is_correct,
             user_choice=user_choice,
-            duration_ms=0
+            duration_ms=0,
+            created_at=datetime.now()
         )
-        db.session.add(log)
-
-        # 2. 更新状态
-        prog = QuestionProgress.query.filter_by(user_id=user.id, question_id=q_id).first()
-        if not prog:
-            # [FIX] 显式初始化所有计数器为 0，防止 += 操作报错
-            prog = QuestionProgress(
-                user_id=user.id, 
-                question_id=q_id,
-                attempts=0,
-                proficiency=0,
-                errors=0,
-                stage=0
-            )
-            db.session.add(prog)
-        
-        # 现在的 prog.attempts 绝对是 0，不会是 None
-        prog.attempts += 1
+        if log_buffer.enabled:
+            log_buffer.add(log)
+        else:
+            db.session.add(QuestionLog(**log))
+
+        # 2. 更新状态：按 (user_id, question_id) 唯一键 UPSERT，计数器在 SQL 中原子自增
+        #    多 worker 并发 / 重复点击时不会再出现读-改-写丢失更新。
+        #    汇总需要熟练度的变化量 (RETURNING 只有新值，封顶/触底时反推不出旧值)，所以先拿写锁再读旧值
         now = time.time()
-        prog.last_reviewed_at = datetime.now()
+        acquire_write_lock(QuestionProgress.__table__)
+        old_proficiency = db.session.query(QuestionProgress.proficiency).filter_by(
+            user_id=user.id, question_id=q_id).with_for_update().scalar()
+        stage, proficiency, next_review = self._schedule(0, 0, is_correct, now)
+        stmt = upsert(QuestionProgress).values(
+            user_id=user.id,
+            question_id=q_id,
+            attempts=1,
+            errors=0 if is_correct else 1,
+            proficiency=proficiency,
+            stage=stage,
+            next_review_time=next_review,
+            last_reviewed_at=datetime.now()
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'question_id'],
+            set_=self._schedule_sql(is_correct, now)
+        ).returning(QuestionProgress.proficiency, QuestionProgress.attempts, QuestionProgress.errors)
+        prog = db.session.execute(stmt).one()
+
+        # 变化量：错题数每次恰好 +0/+1；首次作答旧值为 0。
+        # PostgreSQL 上两个首次作答并发时，后到者读不到行 (FOR UPDATE 锁不住不存在的行)，此时按规则由新值反推
+        d_errors = 0 if is_correct else 1
+        if prog.attempts == 1:
+            old_proficiency = 0
+        elif old_proficiency is None:
+            old_proficiency = max(0, prog.proficiency - 15) if is_correct else min(100, prog.proficiency + 10)
+        d_proficiency = prog.proficiency - (old_proficiency or 0)
+
+        # 所在本子的汇总随进度变化 (与答题同一事务)
+        self._rollup_progress_change(user.id, q_id, d_errors, d_proficiency)
+
+        # 用户统计行 (题数、熟练度、连续打卡) 同事务更新
+        self._record_activity(
+            user.id,
+            new_questions=1 if prog.attempts == 1 else 0, # 首次作答 (RETURNING 的计数，并发下也只算一次)
+            d_proficiency=d_proficiency
+        )
+        self._record_daily_activity(user.id, {date.today(): (1, 1 if is_correct else 0)})
 
-        if is_correct:
-            prog.proficiency = min(100, prog.proficiency + 15)
-            current_stage = prog.stage
-            next_stage = min(current_stage + 1, len(self.review_intervals) - 1)
-            prog.stage = next_stage
-            prog.next_review_time = now + (self.review_intervals[next_stage] * 24 * 3600)
-        else:
-            prog.errors += 1
-            prog.proficiency = max(0, prog.proficiency - 10)
-            prog.stage = 0
-            prog.next_review_time = now + (12 * 3600)
-            
+        if not is_correct:
             # 自动加入 Inbox
-            self._add_to_inbox(q_id)
+            self._add_to_inbox([q_id])
 
+        # 日志 + 进度 + 统计 + Inbox 在同一个事务里提交
         db.session.commit()
+        self._discard_due(user.id, q_id)
 
         return {
             "is_correct": is_correct,
@@ -696,53 +1622,378 @@ $$ i\\hbar\\frac{\\partial}{\\partial t}\\psi = \\hat{H}\\psi $$
             "explanation": question['analysis'] or '暂无详细解析。'
         }
 
-    def _add_to_inbox(self, q_id):
+    def submit_batch(self, answers, chunk_size=500):
+        """离线答题批量同步：按作答时间顺序重放遗忘曲线，日志一次 executemany，进度一次集合式 UPSERT
+        answers: [{q_id, choice, answered_at(毫秒时间戳), duration_ms}, ...] 或同顺序的元组列表
+        整批在一个事务里持有写锁，超过 SUBMIT_BATCH_MAX 条的请求直接拒绝 (too_large)，不做部分写入"""
+        limit = current_app.config.get('SUBMIT_BATCH_MAX', 500)
+        if len(answers) > limit:
+            return {"success": False, "too_large": True, "max": limit, "msg": f"at most {limit} answers per batch"}
+        user = self._get_user()
+        now = time.time()
+
+        # 1. 规范化，并按作答时间稳定排序 (同一时刻保持客户端顺序)
+        records = []
+        skipped = 0
+        for item in answers:
+            try:
+                if isinstance(item, dict):
+                    q_id, choice, answered_at, duration = item.get('q_id'), item.get('choice'), item.get('answered_at'), item.get('duration_ms')
+                else:
+                    q_id, choice, answered_at, duration = (list(item) + [None] * 4)[:4]
+            except TypeError: # 既不是 dict 也不可迭代
+                skipped += 1
+                continue
+            if not q_id or choice is None:
+                skipped += 1
+                continue
+            try:
+                ts = min(float(answered_at) / 1000, now) if answered_at else now # 不接受未来时间
+                if not ts > 0: ts = now # NaN / 负数
+            except (TypeError, ValueError, OverflowError):
+                ts = now
+            try:
+                duration = max(0, min(int(duration or 0), 2 ** 31 - 1))
+            except (TypeError, ValueError, OverflowError):
+                duration = 0
+            records.append({"q_id": str(q_id), "choice": str(choice), "ts": ts, "duration_ms": duration})
+        records.sort(key=lambda r: r['ts'])
+
+        q_ids = list({r['q_id'] for r in records})
+        chunks = [q_ids[i:i + chunk_size] for i in range(0, len(q_ids), chunk_size)]
+
+        # 2. 正确答案 + 当前进度：按块批量读取。
+        #    先拿写锁再读进度，读到写入之间其它 worker 的 check_answer 只能排队，重放结果与增量都不会被覆盖
+        acquire_write_lock(QuestionProgress.__table__)
+        correct = {}
+        state = {}
+        for chunk in chunks:
+            correct.update(db.session.query(Question.id, Question.correct_id).filter(Question.id.in_(chunk)).all())
+            for row in db.session.query(
+                QuestionProgress.question_id, QuestionProgress.attempts, QuestionProgress.errors,
+                QuestionProgress.proficiency, QuestionProgress.stage
+            ).filter(QuestionProgress.user_id == user.id, QuestionProgress.question_id.in_(chunk)).with_for_update():
+                state[row.question_id] = {
+                    "attempts": row.attempts or 0, "errors": row.errors or 0,
+                    "proficiency": row.proficiency or 0, "stage": row.stage or 0
+                }
+        before = {qid: (st['attempts'], st['errors'], st['proficiency']) for qid, st in state.items()}
+
+        # 3. 按时间顺序重放，与逐题调用 check_answer 的结果一致
+        logs = []
+        wrong_ids = set()
+        for r in records:
+            if r['q_id'] not in correct:
+                skipped += 1
+                continue
+            is_correct = (r['choice'] == correct[r['q_id']])
+            st = state.setdefault(r['q_id'], {"attempts": 0, "errors": 0, "proficiency": 0, "stage": 0})
+            st['stage'], st['proficiency'], st['next_review_time'] = self._schedule(st['stage'], st['proficiency'], is_correct, r['ts'])
+            st['attempts'] += 1
+            st['last_reviewed_at'] = datetime.fromtimestamp(r['ts'])
+            if not is_correct:
+                st['errors'] += 1
+                wrong_ids.add(r['q_id'])
+            logs.append({
+                "user_id": user.id, "question_id": r['q_id'], "is_correct": is_correct,
+                "user_choice": r['choice'], "duration_ms": r['duration_ms'],
+                "created_at": datetime.fromtimestamp(r['ts'])
+            })
+
+        if not logs:
+            return {"success": True, "accepted": 0, "skipped": skipped, "results": {}}
+
+        # 4. 写入：日志 executemany + 进度集合式 UPSERT，全部在一个事务里
+        for i in range(0, len(logs), chunk_size):
+            db.session.execute(insert(QuestionLog), logs[i:i + chunk_size])
+
+        # attempts / errors 写增量 (冲突时在库里累加)，其余字段是重放后的结果
+        touched = []
+        for qid, st in state.items():
+            if 'next_review_time' not in st: continue
+            old_attempts, old_errors, old_prof = before.get(qid, (0, 0, 0))
+            touched.append(dict(
+                st, user_id=user.id, question_id=qid,
+                attempts=st['attempts'] - old_attempts, errors=st['errors'] - old_errors,
+                d_proficiency=st['proficiency'] - old_prof
+            ))
+        stmt = upsert(QuestionProgress)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'question_id'],
+            set_=dict(
+                attempts=QuestionProgress.attempts + stmt.excluded.attempts,
+                errors=QuestionProgress.errors + stmt.excluded.errors,
+                **{col: stmt.excluded[col] for col in ('proficiency', 'stage', 'next_review_time', 'last_reviewed_at')}
+            )
+        )
+        columns = ('user_id', 'question_id', 'attempts', 'errors', 'proficiency', 'stage', 'next_review_time', 'last_reviewed_at')
+        for i in range(0, len(touched), chunk_size):
+            db.session.execute(stmt, [{col: row[col] for col in columns} for row in touched[i:i + chunk_size]])
+
+        self._rollup_progress_changes(user.id, {row['question_id']: (row['errors'], row['d_proficiency']) for row in touched})
+
+        self._merge_activity_days(
+            user.id,
+            new_questions=sum(1 for row in touched if row['question_id'] not in before),
+            d_proficiency=sum(row['d_proficiency'] for row in touched),
+            day_counts=Counter(log['created_at'].date() for log in logs)
+        )
+        daily = {}
+        for log in logs:
+            day_answers, day_correct = daily.get(log['created_at'].date(), (0, 0))
+            daily[log['created_at'].date()] = (day_answers + 1, day_correct + (1 if log['is_correct'] else 0))
+        self._record_daily_activity(user.id, daily)
+
+        self._add_to_inbox(wrong_ids)
+
+        db.session.commit()
+        for row in touched:
+            self._discard_due(user.id, row['question_id'])
+
+        return {
+            "success": True,
+            "accepted": len(logs),
+            "skipped": skipped,
+            "results": {row['question_id']: {"proficiency": row['proficiency'], "attempts": state[row['question_id']]['attempts']} for row in touched}
+        }
+
+    def _add_to_inbox(self, q_ids):
+        """把一批题目加入 Inbox (不单独提交，随调用方的事务一起提交)"""
         user = self._get_user()
         inbox = Notebook.query.filter_by(user_id=user.id, name="Inbox").first()
         if not inbox:
-            inbox = Notebook(user_id=user.id, name="Inbox")
+            inbox = Notebook(user_id=user.id, name="Inbox", order_key=self._edge_order_key(Notebook, user.id, None))
             db.session.add(inbox)
             db.session.flush()
-        
-        question = db.session.get(Question, q_id)
-        if question and question not in inbox.questions:
-            inbox.questions.append(question)
-            db.session.commit()
+            set_path(inbox)
+            self._ensure_rollup(inbox.id)
+        self._add_members(inbox, q_ids)
+
+    # --- 用户统计 (user_stats) 的增量维护 ---
+
+    def _record_activity(self, user_id, new_questions, d_proficiency, day=None, count=1):
+        """记 count 次答题：题数/熟练度增量 + 按日期推进连续打卡 (原子 UPSERT，并发安全)；不提交
+        早于最近活跃日的 day (离线补交) 只累加题数/熟练度，不影响连续天数"""
+        day = day or date.today()
+        S = UserStats
+        older = S.last_active_day > day
+        streak = case(
+            (older, S.current_streak),
+            (S.last_active_day == day, S.current_streak),
+            (S.last_active_day == day - timedelta(days=1), S.current_streak + 1),
+            else_=1
+        )
+        stmt = upsert(UserStats).values(
+            user_id=user_id, questions_done=new_questions, proficiency_sum=d_proficiency,
+            current_streak=1, longest_streak=1, last_active_day=day, today_count=count, updated_at=datetime.now()
+        )
+        stmt = stmt.on_conflict_do_update(index_elements=['user_id'], set_={
+            "questions_done": S.questions_done + new_questions,
+            "proficiency_sum": S.proficiency_sum + d_proficiency,
+            "current_streak": streak,
+            "longest_streak": case((streak > S.longest_streak, streak), else_=S.longest_streak),
+            "today_count": case((older, S.today_count), (S.last_active_day == day, S.today_count + count), else_=count),
+            "last_active_day": case((older, S.last_active_day), else_=day),
+            "updated_at": datetime.now()
+        })
+        db.session.execute(stmt)
+
+    def _merge_activity_days(self, user_id, new_questions, d_proficiency, day_counts):
+        """离线批量同步：按日期顺序逐天并入统计行 (同样是原子 UPSERT)，题数/熟练度增量随第一天一起加；不提交"""
+        for i, day in enumerate(sorted(day_counts)):
+            self._record_activity(
+                user_id, new_questions if i == 0 else 0, d_proficiency if i == 0 else 0,
+                day=day, count=day_counts[day]
+            )
+
+    def _record_daily_activity(self, user_id, day_counts):
+        """按日累加答题量；用户当天第一次答题时全站日活 +1 (以 RETURNING 判断，并发下只算一次)；不提交
+        day_counts: {date: (答题数, 答对数)}"""
+        A, D = UserDailyActivity, DailyActivity
+        for day, (answers, correct) in sorted(day_counts.items()):
+            stmt = upsert(A).values(user_id=user_id, day=day, answers=answers, correct=correct)
+            stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'day'], set_={
+                "answers": A.answers + answers,
+                "correct": A.correct + correct
+            }).returning(A.answers)
+            first = 1 if db.session.execute(stmt).scalar() == answers else 0
+            stmt = upsert(D).values(day=day, active_users=first, answers=answers, correct=correct)
+            db.session.execute(stmt.on_conflict_do_update(index_elements=['day'], set_={
+                "active_users": D.active_users + first,
+                "answers": D.answers + answers,
+                "correct": D.correct + correct
+            }))
+
+    def rebuild_daily_activity(self):
+        """由 question_logs 按 (用户, 日期) 聚合一次，重建 user_daily_activity 与 daily_activity"""
+        day = func.date(QuestionLog.created_at)
+        rows = db.session.query(
+            QuestionLog.user_id, day, func.count(QuestionLog.id),
+            func.sum(case((QuestionLog.is_correct, 1), else_=0))
+        ).group_by(QuestionLog.user_id, day)
+
+        per_user, per_day = [], {}
+        for uid, active_day, answers, correct in rows:
+            if not active_day: continue
+            active_day = active_day if isinstance(active_day, date) else date.fromisoformat(active_day)
+            per_user.append({"user_id": uid, "day": active_day, "answers": answers, "correct": correct or 0})
+            agg = per_day.setdefault(active_day, {"day": active_day, "active_users": 0, "answers": 0, "correct": 0})
+            agg['active_users'] += 1
+            agg['answers'] += answers
+            agg['correct'] += correct or 0
+
+        db.session.execute(UserDailyActivity.__table__.delete())
+        db.session.execute(DailyActivity.__table__.delete())
+        for i in range(0, len(per_user), 1000):
+            db.session.execute(insert(UserDailyActivity), per_user[i:i + 1000])
+        if per_day:
+            db.session.execute(insert(DailyActivity), list(per_day.values()))
+        db.session.commit()
+        return len(per_day)
+
+    def rebuild_user_stats(self, user_id=None):
+        """按明细重建统计行：进度按用户聚合一次，答题日志按 (用户, 日期) 聚合一次，再顺序扫描算连续天数"""
+        progress = db.session.query(
+            QuestionProgress.user_id, func.count(QuestionProgress.id), func.coalesce(func.sum(QuestionProgress.proficiency), 0)
+        ).group_by(QuestionProgress.user_id)
+        day = func.date(QuestionLog.created_at)
+        days = db.session.query(QuestionLog.user_id, day, func.count(QuestionLog.id)).group_by(
+            QuestionLog.user_id, day).order_by(QuestionLog.user_id, day)
+        if user_id:
+            progress = progress.filter(QuestionProgress.user_id == user_id)
+            days = days.filter(QuestionLog.user_id == user_id)
+
+        rows = {}
+        for uid, done, prof in progress:
+            rows[uid] = {"user_id": uid, "questions_done": done, "proficiency_sum": prof, "current_streak": 0,
+                         "longest_streak": 0, "last_active_day": None, "today_count": 0, "updated_at": datetime.now()}
+        for uid, active_day, count in days:
+            if not active_day: continue
+            active_day = active_day if isinstance(active_day, date) else date.fromisoformat(active_day)
+            row = rows.setdefault(uid, {"user_id": uid, "questions_done": 0, "proficiency_sum": 0, "current_streak": 0,
+                                        "longest_streak": 0, "last_active_day": None, "today_count": 0,
+                                        "updated_at": datetime.now()})
+            last = row['last_active_day']
+            row['current_streak'] = row['current_streak'] + 1 if last == active_day - timedelta(days=1) else 1
+            row['longest_streak'] = max(row['longest_streak'], row['current_streak'])
+            row['last_active_day'] = active_day
+            row['today_count'] = count
+
+        delete = UserStats.__table__.delete()
+        if user_id: delete = delete.where(UserStats.user_id == user_id)
+        db.session.execute(delete)
+        if rows:
+            db.session.execute(insert(UserStats), list(rows.values()))
+        db.session.commit()
+        return len(rows)
 
     def get_dashboard_stats(self):
         user = self._get_user()
         if not user: return {}
         
-        total_done = QuestionProgress.query.filter_by(user_id=user.id).count()
-        avg_score = db.session.query(func.avg(QuestionProgress.proficiency)).filter_by(user_id=user.id).scalar() or 0
+        # 统计按主键读一行 (只读，不在 GET 里重建)；还没答过题的用户没有这一行，按 0 显示。
+        # 老数据由 update_db / maintenance.py rebuild-user-stats 回填
+        stats = db.session.get(UserStats, user.id)
+        today = date.today()
+        last = stats.last_active_day if stats else None
+        # 昨天之前就断了的连续天数显示为 0；今天还没做题时保留到昨天为止的连续天数
+        streak = stats.current_streak if last and last >= today - timedelta(days=1) else 0
+        done = stats.questions_done if stats else 0
         
         top_books = Notebook.query.filter_by(user_id=user.id, parent_id=None).limit(3).all()
         books_data = [{"id": b.id, "name": b.name, "tags": b.tags} for b in top_books]
 
         return {
-            "streak_days": 1, 
-            "mastery_rate": int(avg_score),
-            "questions_done": total_done,
+            "streak_days": streak, 
+            "longest_streak": stats.longest_streak if stats else 0,
+            "today_count": stats.today_count if last == today else 0,
+            "due_forecast": self.get_due_forecast(),
+            "mastery_rate": int(stats.proficiency_sum / done) if done else 0,
+            "questions_done": done,
             "top_books": books_data
         }
 
+    # --- 管理后台 ---
+
+    def get_admin_users(self, search=None, after=None, limit=50):
+        """用户列表：按用户名 keyset 分页 (after = 上一页最后一个用户名)，可按用户名/昵称搜索；
+        本页用户的最近活跃日、近 7 天答题数与正确率由一次分组查询取回"""
+        query = User.query.order_by(User.username)
+        if search:
+            pattern = f"%{search}%"
+            query = query.filter(or_(User.username.ilike(pattern), User.nickname.ilike(pattern)))
+        if after:
+            query = query.filter(User.username > after)
+        users = query.limit(limit + 1).all()
+        has_more = len(users) > limit
+        users = users[:limit]
+
+        A = UserDailyActivity
+        since = date.today() - timedelta(days=6)
+        recent = lambda col: func.coalesce(func.sum(case((A.day >= since, col), else_=0)), 0)
+        activity = {}
+        if users:
+            rows = db.session.query(A.user_id, func.max(A.day), recent(A.answers), recent(A.correct)).filter(
+                A.user_id.in_([u.id for u in users])).group_by(A.user_id)
+            activity = {uid: (last, answers, correct) for uid, last, answers, correct in rows}
+
+        items = []
+        for u in users:
+            last, answers, correct = activity.get(u.id, (None, 0, 0))
+            items.append({
+                "user": u,
+                "last_active": last,
+                "answers_7d": answers,
+                "accuracy_7d": round(correct * 100 / answers) if answers else None
+            })
+        return {"items": items, "next_after": users[-1].username if has_more else None}
+
+    def get_activity_trend(self, days=30):
+        """最近 days 天的日活、答题数、正确率 (读 daily_activity，没有记录的日期补 0)"""
+        start = date.today() - timedelta(days=days - 1)
+        rows = {r.day: r for r in DailyActivity.query.filter(DailyActivity.day >= start)}
+        trend = []
+        for i in range(days):
+            day = start + timedelta(days=i)
+            row = rows.get(day)
+            trend.append({
+                "day": day.isoformat(),
+                "active_users": row.active_users if row else 0,
+                "answers": row.answers if row else 0,
+                "accuracy": round(row.correct * 100 / row.answers) if row and row.answers else None
+            })
+        return trend
+
+    def get_due_forecast(self):
+        """读取夜间批处理 (scheduler.py) 预先算好的到期量与未来复习量预测"""
+        user = self._get_user()
+        row = db.session.get(UserDueQueue, user.id) if user else None
+        if not row: return None
+        return {"due_count": row.due_count, "forecast": row.forecast, "computed_at": row.computed_at.isoformat()}
+
     def find_notes_by_question(self, q_id):
         user = self._get_user()
-        related = []
-        ref_tag = f"[[{q_id}]]"
-        
-        notes = Note.query.filter(
-            Note.user_id == user.id,
-            Note.type == 'file',
-            Note.content.contains(ref_tag)
-        ).all()
-        
-        for n in notes:
-            related.append({
-                "id": n.id,
-                "name": n.name,
-                "preview": (n.content or "")[:60] + "..."
-            })
-        return related
+        return self._notes_linking_to('question', q_id, user.id)
+
+    def _notes_linking_to(self, kind, target_id, user_id):
+        """引用了某个目标的笔记 (note_links 索引查找，摘要读 preview 列)"""
+        rows = db.session.execute(
+            select(Note.id, Note.name, Note.preview)
+            .join(NoteLink, NoteLink.source_id == Note.id)
+            .where(NoteLink.user_id == user_id, NoteLink.kind == kind, NoteLink.target_id == target_id,
+                   Note.type == 'file')
+        )
+        return [{"id": nid, "name": name, "preview": (head or "")[:60] + "..."} for nid, name, head in rows]
+
+    def backfill_note_links(self, user_id=None):
+        """按正文全量重建引用索引 (一次性回填/修复)"""
+        query = db.session.query(Note.id, Note.user_id, Note.content).filter(Note.type == 'file')
+        if user_id: query = query.filter(Note.user_id == user_id)
+        count = 0
+        for note_id, owner_id, content in query.all():
+            sync_note_links(note_id, owner_id, content)
+            count += 1
+        db.session.commit()
+        return count
 
 service = QuestionService()
\ No newline at end of file
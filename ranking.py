@@ -0,0 +1,119 @@
+"""分数排序键 (lexicographic rank)
+
+同级条目按字符串 order_key 升序排列。拖拽移动时只需在相邻两个键之间生成一个新键，
+只改写被移动的那一行；键过长时再整组重新均匀分配 (rebalance)。
+字符集只用 0-9a-z，且生成的键不以 '0' 结尾，保证任意两个键之间总能再插入新键。"""
+from bisect import bisect_left
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+# 键长度超过该值时触发整组重排
+MAX_KEY_LENGTH = 24
+
+
+def rank_between(lo=None, hi=None):
+    """返回严格介于 lo 与 hi 之间的键 (None 表示无下界 / 无上界)"""
+    lo = lo or ''
+    if hi is not None and lo >= hi:
+        raise ValueError(f"rank_between: {lo!r} >= {hi!r}")
+    out = []
+    i = 0
+    while True:
+        a = DIGITS.index(lo[i]) if i < len(lo) else 0
+        b = DIGITS.index(hi[i]) if hi is not None and i < len(hi) else BASE
+        if a == b:
+            out.append(DIGITS[a])
+            i += 1
+            continue
+        mid = (a + b) // 2
+        out.append(DIGITS[mid] if mid > a else DIGITS[a])
+        if mid > a:
+            return ''.join(out)
+        # 两位相邻：取下界这一位，之后只需大于 lo 的剩余部分
+        i += 1
+        hi = None
+
+
+def rank_after(key):
+    """追加到队尾用的键：把 key 第一个不是 'z' 的位加一 (结果不会比 key 长)；
+    全是 'z' 时才在末尾补一位，所以连续追加约 35 次键才变长一位"""
+    if not key: return rank_between(None, None)
+    for i, ch in enumerate(key):
+        if ch != DIGITS[-1]:
+            return key[:i] + DIGITS[DIGITS.index(ch) + 1]
+    return key + DIGITS[1]
+
+
+def rank_before(key):
+    """插到队首用的键：把 key 第一个不是 '0' 的位减一；减到 '0' 时补一个 'z' (键不能以 '0' 结尾)"""
+    if not key: return rank_between(None, None)
+    for i, ch in enumerate(key):
+        if ch != DIGITS[0]:
+            d = DIGITS.index(ch) - 1
+            return key[:i] + (DIGITS[d] if d else DIGITS[0] + DIGITS[-1])
+
+
+def ranks_between(lo, hi, n):
+    """在 lo 与 hi 之间生成 n 个递增的键 (二分取中点，键长只按 log(n) 增长)"""
+    if n <= 0: return []
+    half = n // 2
+    key = rank_between(lo, hi)
+    return ranks_between(lo, key, half) + [key] + ranks_between(key, hi, n - half - 1)
+
+
+def rank_sequence(n):
+    """为 n 个条目生成等宽、均匀分布的键 (用于回填和 rebalance)"""
+    width, space = 1, BASE
+    while space <= n * 2:
+        width += 1
+        space *= BASE
+    step = space // (n + 1)
+    keys = []
+    for i in range(1, n + 1):
+        value, digits = step * i, []
+        for _ in range(width):
+            value, r = divmod(value, BASE)
+            digits.append(DIGITS[r])
+        keys.append(''.join(reversed(digits)).rstrip('0'))
+    return keys
+
+
+def rerank(ordered_ids, current):
+    """按前端提交的完整新顺序计算需要改写的键。
+
+    current: {id: 当前键或 None}。新顺序里相对次序没变的条目 (当前键的最长递增子序列) 保持不动，
+    只给其余条目在相邻保留键之间分配新键，所以一次拖拽只改写一行。返回 {id: 新键}。"""
+    seq = [i for i in dict.fromkeys(ordered_ids) if i in current]
+
+    # 最长严格递增子序列 (O(n log n))
+    tails, tail_idx, prev = [], [], [None] * len(seq)
+    for pos, item in enumerate(seq):
+        key = current[item]
+        if key is None: continue
+        j = bisect_left(tails, key)
+        if j == len(tails):
+            tails.append(key)
+            tail_idx.append(pos)
+        else:
+            tails[j] = key
+            tail_idx[j] = pos
+        prev[pos] = tail_idx[j - 1] if j else None
+    kept = set()
+    pos = tail_idx[-1] if tail_idx else None
+    while pos is not None:
+        kept.add(pos)
+        pos = prev[pos]
+
+    changes, gap, lo = {}, [], None
+    for pos, item in enumerate(seq + [None]):
+        if pos < len(seq) and pos not in kept:
+            gap.append(item)
+            continue
+        hi = current[item] if pos < len(seq) else None
+        changes.update(zip(gap, ranks_between(lo, hi, len(gap))))
+        gap, lo = [], hi
+    return changes
+
+
+def needs_rebalance(keys):
+    return any(k and len(k) > MAX_KEY_LENGTH for k in keys)
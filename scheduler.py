@@ -0,0 +1,128 @@
+import argparse
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sqlalchemy import select, delete, insert
+from app import app
+from models import db, QuestionProgress, UserDueQueue
+
+DAY = 24 * 3600
+
+def load_progress(batch_size=50000):
+    """把 question_progress 的调度相关列读成 NumPy 数组 (用户/题目 ID 映射成整数编码)"""
+    user_codes, question_codes = {}, {}
+    cols = {"user": [], "question": [], "next_review": [], "errors": []}
+
+    stmt = select(
+        QuestionProgress.user_id, QuestionProgress.question_id,
+        QuestionProgress.next_review_time, QuestionProgress.errors
+    ).execution_options(yield_per=batch_size)
+    for uid, qid, nrt, errors in db.session.execute(stmt):
+        cols["user"].append(user_codes.setdefault(uid, len(user_codes)))
+        cols["question"].append(question_codes.setdefault(qid, len(question_codes)))
+        cols["next_review"].append(nrt or 0)
+        cols["errors"].append(errors or 0)
+
+    arrays = {
+        "user": np.asarray(cols["user"], dtype=np.int32),
+        "question": np.asarray(cols["question"], dtype=np.int32),
+        "next_review": np.asarray(cols["next_review"], dtype=np.float64),
+        "errors": np.asarray(cols["errors"], dtype=np.int32),
+    }
+    return arrays, list(user_codes), list(question_codes)
+
+def compute_chunk(user, question, next_review, errors, now, day_start, horizon, queue_limit):
+    """向量化计算一段用户的到期队列与复习量预测 (数组已按用户编码排好序，可在子进程中运行)
+    与每日特训同口径：只统计 errors > 0 的题目"""
+    results = []
+    if len(user) == 0: return results
+
+    # 1. 未来 horizon 天的到期量：每行落到 (用户, 第几天) 的桶里，已逾期的算第 0 天
+    review = errors > 0
+    days = np.floor((next_review - day_start) / DAY).astype(np.int64)
+    days = np.clip(days, 0, None)
+    in_window = review & (days < horizon)
+    first_user = int(user[0])
+    local_user = user.astype(np.int64) - first_user
+    n_users = int(local_user[-1]) + 1
+    forecast = np.bincount(local_user[in_window] * horizon + days[in_window],
+                           minlength=n_users * horizon).reshape(n_users, horizon)
+
+    # 2. 当前到期的题：按 (用户, 到期时间) 排序，逾期最久的排前面
+    due = review & (next_review <= now)
+    due_user, due_q, due_t = local_user[due], question[due], next_review[due]
+    order = np.lexsort((due_t, due_user))
+    due_user, due_q = due_user[order], due_q[order]
+    starts = np.searchsorted(due_user, np.arange(n_users), side='left')
+    ends = np.searchsorted(due_user, np.arange(n_users), side='right')
+
+    present = np.unique(local_user)
+    for u in present:
+        results.append((
+            first_user + int(u),
+            due_q[starts[u]:min(ends[u], starts[u] + queue_limit)].tolist(),
+            int(ends[u] - starts[u]),
+            forecast[u].tolist()
+        ))
+    return results
+
+def run(workers=1, horizon=30, queue_limit=200, chunk_rows=500000):
+    start = time.time()
+    arrays, user_ids, question_ids = load_progress()
+    print(f"📥 Loaded {len(arrays['user'])} progress rows for {len(user_ids)} users ({time.time() - start:.1f}s)")
+
+    # 按用户排序后切块，块边界对齐到用户，保证同一用户的数据只落在一个块里
+    order = np.argsort(arrays["user"], kind='stable')
+    for key in arrays: arrays[key] = arrays[key][order]
+    bounds = [0]
+    while bounds[-1] < len(order):
+        cut = bounds[-1] + chunk_rows
+        if cut >= len(order):
+            cut = len(order)
+        else:
+            # 向后延伸到块内最后一个用户的末尾
+            cut = int(np.searchsorted(arrays["user"], arrays["user"][cut - 1], side='right'))
+        bounds.append(cut)
+
+    now = time.time()
+    day_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    jobs = [
+        (arrays["user"][a:b], arrays["question"][a:b], arrays["next_review"][a:b], arrays["errors"][a:b],
+         now, day_start, horizon, queue_limit)
+        for a, b in zip(bounds, bounds[1:])
+    ]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(compute_chunk, *zip(*jobs)))
+    else:
+        chunks = [compute_chunk(*job) for job in jobs]
+
+    computed_at = datetime.now()
+    rows = [
+        {
+            "user_id": user_ids[u],
+            "question_ids": [question_ids[q] for q in due_q],
+            "due_count": due_count,
+            "forecast": forecast,
+            "computed_at": computed_at
+        }
+        for chunk in chunks for u, due_q, due_count, forecast in chunk
+    ]
+
+    # 整表替换：一次删除 + 批量插入，同一事务
+    db.session.execute(delete(UserDueQueue))
+    for i in range(0, len(rows), 1000):
+        db.session.execute(insert(UserDueQueue), rows[i:i + 1000])
+    db.session.commit()
+    print(f"✅ Wrote due queues for {len(rows)} users in {len(jobs)} chunk(s) ({time.time() - start:.1f}s)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Nightly spaced-repetition scheduler: due queues + 30-day forecast")
+    parser.add_argument('--workers', type=int, default=1, help="process pool size")
+    parser.add_argument('--horizon', type=int, default=30, help="forecast length in days")
+    parser.add_argument('--queue-limit', type=int, default=200, help="max due question ids stored per user")
+    parser.add_argument('--chunk-rows', type=int, default=500000, help="progress rows per pool task")
+    args = parser.parse_args()
+    with app.app_context():
+        run(args.workers, args.horizon, args.queue_limit, args.chunk_rows)
@@ -0,0 +1,165 @@
+import os
+import sys
+import argparse
+import tempfile
+import multiprocessing as mp
+from collections import Counter
+
+# 服务层回归检查：在临时 SQLite 库上准备一小套题目，逐项验证容易在多 worker / 边界条件下出错的逻辑。
+# 每个检查是一个 check_* 函数，任何一项失败都以非 0 退出。
+# 用法: python service_checks.py [-k 名称片段]
+
+QUESTIONS = {
+    # id: (mode, tags)
+    "sc-1": ("exam", ["力学", "牛顿定律"]),
+    "sc-2": ("exam", ["电磁学"]),
+    "sc-3": ("exam", ["动量", "能量"]),
+    "sc-4": ("exam", ["光学"]),
+    # 同一组标签的题：做熟之后成批抽题时会互相换成变式
+    "sc-v1": ("exam", ["热学"]),
+    "sc-v2": ("exam", ["热学"]),
+    "sc-v3": ("exam", ["热学"]),
+    "sc-v4": ("exam", ["热学"]),
+    "sc-v5": ("exam", ["热学"]),
+}
+USERNAME, PASSWORD = 'checks', 'checks-123'
+failures = []
+
+def check(ok, label):
+    print(f"  {'✅' if ok else '❌'} {label}")
+    if not ok: failures.append(label)
+
+def seed(app):
+    from models import db, Question, User
+    from question_service import service
+    with app.app_context():
+        db.create_all()
+        for qid, (mode, tags) in QUESTIONS.items():
+            db.session.add(Question(id=qid, content=qid, options=[{"id": "A", "text": "A"}, {"id": "B", "text": "B"}],
+                                    correct_id='A', tags=tags, mode=mode))
+        user = User(username=USERNAME)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        service.init_new_user(user)
+
+def login(app):
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    return client
+
+# ================= 检查项 =================
+
+def check_tag_index_across_workers(app):
+    """两个 worker (两个 QuestionService 实例) 先后改标签：各自的倒排索引都要看到对方的修改"""
+    from question_service import QuestionService
+    a, b = QuestionService(), QuestionService()
+    for worker in (a, b):
+        with app.app_context():
+            worker._variant_candidates('sc-2') # 构建索引
+    with app.app_context():
+        a.update_question_tags('sc-1', ["力学", "电磁学"])
+    with app.app_context():
+        b.update_question_tags('sc-3', ["动量", "电磁学"])
+    expected = [('sc-1', 1), ('sc-3', 1)]
+    for name, worker in (('A', a), ('B', b)):
+        with app.app_context():
+            got = sorted(worker._variant_candidates('sc-2'))
+        check(got == expected, f"worker {name} variants of sc-2: {got}")
+
+def check_batch_has_no_duplicates(app):
+    """错题本成批抽题：做熟的题会换成变式，换上来的变式不能与同一批里的其它题重复"""
+    from models import Notebook
+    client = login(app)
+    group = [qid for qid in QUESTIONS if qid.startswith('sc-v')]
+    client.post('/api/create_book', json={'name': 'sc-variants', 'parent': 'root'})
+    with app.app_context():
+        book = Notebook.query.filter_by(name='sc-variants').first().id
+    client.post('/api/questions/bulk_copy', json={'q_ids': group[:4], 'to_book': book})
+    for qid in group:
+        for _ in range(4): # 每题做 4 次 (> 3 次即尝试换变式)
+            client.post('/api/submit', json={'q_id': qid, 'choice': 'A'})
+    duplicated = 0
+    for _ in range(30):
+        ids = [q['id'] for q in client.get(f'/api/get_question?mode=mistake&book={book}&count=4').get_json()['questions']]
+        duplicated += len(ids) != len(set(ids))
+    check(duplicated == 0, f"mistake batches with duplicate ids: {duplicated}/30")
+
+def check_submit_batch_limit(app):
+    """批量同步超过 SUBMIT_BATCH_MAX 条整批拒绝 (413，不写任何日志)；恰好等于上限的照常接受"""
+    from models import db, QuestionLog
+    client = login(app)
+    limit, app.config['SUBMIT_BATCH_MAX'] = app.config['SUBMIT_BATCH_MAX'], 5
+    try:
+        with app.app_context():
+            before = db.session.query(QuestionLog).count()
+        resp = client.post('/api/submit_batch', json={'answers': [{'q_id': 'sc-4', 'choice': 'A'}] * 6})
+        with app.app_context():
+            written = db.session.query(QuestionLog).count() - before
+        check(resp.status_code == 413 and written == 0, f"6 answers over a limit of 5: status {resp.status_code}, {written} logs written")
+        resp = client.post('/api/submit_batch', json={'answers': [{'q_id': 'sc-4', 'choice': 'A'}] * 5})
+        accepted = (resp.get_json(silent=True) or {}).get('accepted')
+        check(resp.status_code == 200 and accepted == 5, f"5 answers at a limit of 5: status {resp.status_code}, accepted {accepted}")
+    finally:
+        app.config['SUBMIT_BATCH_MAX'] = limit
+
+def check_daily_reads_nightly_queue(app):
+    """每日特训补充到期队列时按夜间批处理 (scheduler.py) 排好的顺序出题：跳过之后已作答的，夜间之后新到期的排在后面"""
+    import time
+    import scheduler
+    from models import db, User, QuestionProgress
+    from question_service import service
+    now = time.time()
+    with app.app_context():
+        uid = User.query.filter_by(username=USERNAME).first().id
+        for qid, overdue in (('sc-1', 300), ('sc-2', 200), ('sc-3', 100)):
+            db.session.add(QuestionProgress(user_id=uid, question_id=qid, attempts=1, errors=1, next_review_time=now - overdue))
+        db.session.commit()
+        scheduler.run()
+        # 夜间之后：sc-1 已在别处作答 (复习时间后移)，sc-4 新到期
+        QuestionProgress.query.filter_by(user_id=uid, question_id='sc-1').update({"next_review_time": now + 3600})
+        QuestionProgress.query.filter_by(user_id=uid, question_id='sc-4').update({"errors": 1, "next_review_time": now - 50})
+        db.session.commit()
+        got = [service._due_ids(uid, 10) for _ in range(5)]
+    check(all(ids == ['sc-2', 'sc-3', 'sc-4'] for ids in got), f"daily refills follow the nightly order: {got[0]}")
+
+def draw_questions(n):
+    """子进程：逐题抽 n 道考试题 (每次一题)，返回抽到的 ID"""
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = login(app)
+    return [q['id'] for _ in range(n) for q in client.get('/api/get_question?mode=exam&count=1').get_json()['questions']]
+
+def check_deck_rounds_across_workers(app):
+    """3 个进程同时抽题，合计恰好两整副：每道题恰好发两次 (重洗只发生一次，领取不丢不重)"""
+    from models import db, Question
+    with app.app_context():
+        size = db.session.query(Question).filter_by(mode='exam').count()
+    per = [2 * size // 3 + (i < 2 * size % 3) for i in range(3)]
+    with mp.get_context('spawn').Pool(3) as pool:
+        drawn = Counter(q for ids in pool.map(draw_questions, per) for q in ids)
+    check(sum(drawn.values()) == 2 * size and set(drawn.values()) == {2},
+          f"{sum(drawn.values())} draws over two rounds of {size}: counts {sorted(Counter(drawn.values()).items())}")
+
+CHECKS = [check_tag_index_across_workers, check_batch_has_no_duplicates, check_submit_batch_limit, check_daily_reads_nightly_queue,
+          check_deck_rounds_across_workers]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run service-level regression checks against a throwaway SQLite database")
+    parser.add_argument('-k', default='', help="only run checks whose name contains this")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # config.py 在导入 app 时读取 DATABASE_URL，必须先设置
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'checks.db')}"
+        os.environ['QUESTION_LOG_WRITE_BEHIND'] = '0'
+        from app import app
+        app.config['WTF_CSRF_ENABLED'] = False
+        seed(app)
+        for fn in CHECKS:
+            if args.k not in fn.__name__: continue
+            print(fn.__name__)
+            fn(app)
+    if failures:
+        sys.exit(f"{len(failures)} check(s) failed")
+    print("✅ All checks passed")
@@ -0,0 +1,119 @@
+import re
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql.elements import TextClause
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy.session import Session
+
+# SQLite 生产配置：多个 gunicorn worker 共用一个数据库文件时，
+# 1. 每个连接建立时设置 PRAGMA (WAL、synchronous=NORMAL、busy_timeout、mmap、页缓存)；
+# 2. 可选：GET/HEAD 请求里的只读查询走单独的只读连接池 (WAL 下读不阻塞写)；
+# 3. 可选：写事务一开始就 BEGIN IMMEDIATE 拿写锁，排队等待 busy_timeout，
+#    避免默认的延迟事务在“读锁升级写锁”时直接报 database is locked。
+#    开启后一并启用只读连接池：GET 里的读都走只读池，写连接上开启的事务一律是写事务，
+#    GET 处理里的写 (如抽题推进牌堆游标) 同样以 BEGIN IMMEDIATE 开始，不会在读锁上升级。
+# 非 SQLite 数据库不做任何处理。
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+READ_SQL = re.compile(r'\s*select\b', re.I)
+
+
+def pragmas(settings):
+    """按配置生成连接建立时要执行的 PRAGMA 语句 (值为空/None 的跳过)"""
+    statements = []
+    if settings.get('SQLITE_JOURNAL_MODE'):
+        statements.append(f"PRAGMA journal_mode = {settings['SQLITE_JOURNAL_MODE']}")
+    if settings.get('SQLITE_SYNCHRONOUS'):
+        statements.append(f"PRAGMA synchronous = {settings['SQLITE_SYNCHRONOUS']}")
+    if settings.get('SQLITE_BUSY_TIMEOUT_MS') is not None:
+        statements.append(f"PRAGMA busy_timeout = {int(settings['SQLITE_BUSY_TIMEOUT_MS'])}")
+    if settings.get('SQLITE_MMAP_SIZE') is not None:
+        statements.append(f"PRAGMA mmap_size = {int(settings['SQLITE_MMAP_SIZE'])}")
+    if settings.get('SQLITE_CACHE_SIZE_KB'):
+        statements.append(f"PRAGMA cache_size = -{int(settings['SQLITE_CACHE_SIZE_KB'])}") # 负数表示 KiB
+    return statements
+
+
+def install(engine, settings, immediate=False, read_only=False, is_read=None):
+    """给引擎挂上连接事件；immediate=True 时写事务用 BEGIN IMMEDIATE，
+    is_read() 为真时 (默认：GET/HEAD 请求内) 仍用普通 BEGIN"""
+    is_read = is_read or in_read_request
+    statements = pragmas(settings)
+    if read_only:
+        statements = [s for s in statements if 'journal_mode' not in s] + ["PRAGMA query_only = ON"]
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        if immediate:
+            # 关掉 pysqlite 自己发的 BEGIN，改由下面的 begin 事件控制事务模式
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    if immediate:
+        @event.listens_for(engine, 'begin')
+        def on_begin(conn):
+            conn.exec_driver_sql("BEGIN" if is_read() else "BEGIN IMMEDIATE")
+
+
+def in_read_request():
+    return has_request_context() and request.method in READ_METHODS
+
+
+def is_write(clause):
+    """语句是否可能写库 (ORM 查询/select() 以外的都按写处理；text() 只认 SELECT 开头的为读)"""
+    if clause is None: return False
+    if getattr(clause, 'is_select', False): return False
+    if isinstance(clause, TextClause): return not READ_SQL.match(clause.text)
+    return True
+
+
+class RoutingSession(Session):
+    """GET/HEAD 请求里的只读查询走只读连接池；本事务一旦写过 (flush/DML)，后续查询都留在写连接上，
+    保证请求内读到自己刚写的数据。未启用只读池时与默认 Session 完全一致。"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        profile = current_app.extensions.get('sqlite_profile') if bind is None and in_read_request() else None
+        if profile and profile.read_engine is not None and not self.info.get('wrote'):
+            if not self._flushing and not is_write(clause):
+                return profile.read_engine
+            self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def _reset_routing(session):
+    session.info.pop('wrote', None)
+
+
+class SQLiteProfile:
+
+    def __init__(self):
+        self.read_engine = None
+        self.settings = {}
+
+    def init_app(self, app, db):
+        app.extensions['sqlite_profile'] = self
+        with app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+            return
+        self.settings = {k: v for k, v in app.config.items() if k.startswith('SQLITE_')}
+        immediate = app.config.get('SQLITE_IMMEDIATE_WRITES', False)
+        # 读写分流后写连接只承载写事务 (GET 里的写也一样)，所以一律 BEGIN IMMEDIATE
+        install(engine, self.settings, immediate=immediate, is_read=lambda: False)
+        if app.config.get('SQLITE_READ_POOL', False) or immediate:
+            self.read_engine = create_engine(engine.url, pool_size=app.config.get('SQLITE_READ_POOL_SIZE', 5))
+            install(self.read_engine, self.settings, read_only=True)
+
+    def stats(self):
+        return {
+            "pragmas": pragmas(self.settings),
+            "read_pool": self.read_engine.pool.status() if self.read_engine is not None else None,
+            "immediate_writes": bool(self.settings.get('SQLITE_IMMEDIATE_WRITES'))
+        }
+
+
+sqlite_profile = SQLiteProfile()
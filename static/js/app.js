@@ -462,6 +462,11 @@ document.addEventListener('alpine:init', () => {
         futureStack: [],
         isNavigating: false,
         
+        // Prefetch Queue (next questions fetched while the current one is answered)
+        prefetchQueue: [],
+        prefetching: false,
+        prefetchSize: 3,
+        
         // Notebook Mgmt States
         showCreateModal: false,
         subBookName: '',
@@ -735,11 +740,38 @@ document.addEventListener('alpine:init', () => {
             this.currentQIndex = index;
             await this.loadNext(this.bookData.questions[index].id);
         },
+        async fillPrefetch() {
+            // 错题本模式按目录顺序逐题加载，不走预取
+            if (this.mode === 'mistake' || this.prefetching) return;
+            const need = this.prefetchSize - this.prefetchQueue.length;
+            if (need <= 0) return;
+            this.prefetching = true;
+            try {
+                const res = await fetch(`/api/get_question?mode=${this.mode}&count=${need}`);
+                if (!res.ok) return;
+                const data = await res.json();
+                const known = new Set([this.question.id, ...this.prefetchQueue.map(q => q.id)]);
+                (data.questions || []).forEach(q => {
+                    if (!known.has(q.id)) { this.prefetchQueue.push(q); known.add(q.id); }
+                });
+            } catch(e) { console.error(e); }
+            finally { this.prefetching = false; }
+        },
         async loadNext(targetId=null) {
-            this.loading = true;
             this.showExplanation = false;
             this.relatedNotes = [];
             
+            // 预取队列里有题：直接渲染，无需等待网络
+            if (!targetId && this.mode !== 'mistake' && this.prefetchQueue.length > 0) {
+                this.submitted = false; this.selectedOption = null; this.feedback = {};
+                this.question = this.prefetchQueue.shift();
+                this.loading = false;
+                this.$nextTick(() => { if(window.MathJax) MathJax.typesetPromise(); });
+                this.fillPrefetch();
+                return;
+            }
+            this.loading = true;
+            
             if (this.mode === 'mistake' && !targetId) {
                 this.currentQIndex++;
                 if (this.currentQIndex >= this.bookData.questions.length) { 
@@ -766,6 +798,7 @@ document.addEventListener('alpine:init', () => {
                         alert("Error"); return; 
                     }
                     this.question = await res.json();
+                    if (!targetId) this.fillPrefetch();
                 } catch(e) { console.error(e); }
                 finally { 
                     this.loading = false; 
@@ -830,7 +863,10 @@ document.addEventListener('alpine:init', () => {
         
         // Auto Save & Notification
         saveTimer: null,
-        lastSavedContent: '',
+        lastSavedContent: '',   // 服务器上当前版本的正文 (增量保存的基准)
+        noteVersion: null,
+        saving: false,
+        savePending: false,
         showAutoSaveNotify: false,
         saveNotifyText: 'Auto Saved', 
         
@@ -924,6 +960,7 @@ document.addEventListener('alpine:init', () => {
             if (this.viewData.info.type === 'file') {
                 this.editorContent = this.viewData.content || '';
                 this.lastSavedContent = this.editorContent;
+                this.noteVersion = this.viewData.version;
                 this.renderMarkdown();
                 this.viewMode = 'read';
             }
@@ -971,16 +1008,57 @@ document.addEventListener('alpine:init', () => {
         },
 
         // --- Save Logic ---
+        // 只发送相对上次保存版本的改动：去掉公共前缀/后缀，剩下的一段替换 (下标为 UTF-16 码元，与服务端一致)
+        diffPatch(base, next) {
+            let start = 0;
+            const maxStart = Math.min(base.length, next.length);
+            while (start < maxStart && base.charCodeAt(start) === next.charCodeAt(start)) start++;
+            let endBase = base.length, endNext = next.length;
+            while (endBase > start && endNext > start && base.charCodeAt(endBase - 1) === next.charCodeAt(endNext - 1)) { endBase--; endNext--; }
+            // 不把代理对 (emoji 等) 切成两半
+            const isHigh = (c) => c >= 0xD800 && c <= 0xDBFF;
+            const isLow = (c) => c >= 0xDC00 && c <= 0xDFFF;
+            if (start > 0 && isHigh(base.charCodeAt(start - 1))) start--;
+            if (endBase < base.length && isLow(base.charCodeAt(endBase))) { endBase++; endNext++; }
+            return { start: start, end: endBase, text: next.slice(start, endNext) };
+        },
         async saveNote(isAuto = false) {
             if(!this.editorContent) return;
-            fetch('/api/notes/save', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ id: this.noteId, content: this.editorContent }) })
-            .then(r=>r.json()).then(d => { 
-                if(d.success) {
-                    this.lastSavedContent = this.editorContent;
+            const noteId = this.noteId;
+            const content = this.editorContent;
+            if (content === this.lastSavedContent) return;
+            // 同一篇笔记的保存串行化：基准必须是服务器已确认的版本
+            if (this.saving) { this.savePending = true; return; }
+            this.saving = true;
+            const payload = this.noteVersion === null || this.noteVersion === undefined
+                ? { id: noteId, content: content }
+                : { id: noteId, base_version: this.noteVersion, patch: this.diffPatch(this.lastSavedContent, content) };
+            try {
+                const res = await fetch('/api/notes/save', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify(payload) });
+                const d = await res.json();
+                if (noteId !== this.noteId) return;
+                if (d.success) {
+                    this.lastSavedContent = content;
+                    this.noteVersion = d.version;
                     if (isAuto) this.triggerAutoSaveNotify("Auto Saved");
                     else this.triggerAutoSaveNotify("Saved Successfully");
+                } else if (res.status === 409) {
+                    // 另一个标签页/设备已经保存过新版本
+                    if (confirm("This note was changed elsewhere. OK: overwrite it with your version. Cancel: load the latest version.")) {
+                        this.lastSavedContent = d.content || '';
+                        this.noteVersion = d.version;
+                        this.savePending = true;
+                    } else {
+                        this.editorContent = d.content || '';
+                        this.lastSavedContent = this.editorContent;
+                        this.noteVersion = d.version;
+                        this.renderMarkdown();
+                    }
                 }
-            });
+            } finally {
+                this.saving = false;
+                if (this.savePending) { this.savePending = false; this.saveNote(isAuto); }
+            }
         },
 
         // --- Drag & Drop Logic ---
@@ -0,0 +1,165 @@
+import os
+import sys
+import random
+import argparse
+import tempfile
+import multiprocessing as mp
+from collections import Counter
+
+# 多进程并发答题压测 + 一致性检查：模拟 gunicorn 多 worker 共用一个 SQLite 文件，
+# N 个进程同时对同一批题目调用 /api/submit (check_answer) 和 /api/submit_batch (离线批量同步)，
+# 结束后逐项核对：
+#   1. 每题的 attempts / errors 与各进程实际提交的次数完全一致 (丢失更新)；
+#   2. 错题本汇总 (含标签计数)、用户统计、每日活跃度与按明细全量重建的结果一致 (增量漂移)。
+# 任何不一致或请求报错都以非 0 退出。
+# 用法: python stress_submit.py [--workers 4] [--rounds 60] [--questions 6] [--batch-every 5] [--immediate-writes] [--read-pool]
+
+USERNAME, PASSWORD = 'stress', 'stress-123'
+TAGS = ['力学', '牛顿定律', '动量', '能量', '电磁学']
+
+
+def question_ids(n):
+    return [f'stress-{i}' for i in range(n)]
+
+
+def seed(n_questions):
+    """建表并准备一个用户、一批题目 (正确答案都是 A)，以及两级错题本 (题目放在子本子里，汇总要传到父本子)"""
+    from app import app
+    from models import db, User, Question, Notebook
+    from question_service import service
+    with app.app_context():
+        db.create_all()
+        user = User(username=USERNAME)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        for i, qid in enumerate(question_ids(n_questions)):
+            db.session.add(Question(id=qid, content=qid, options=[{"id": "A", "text": "A"}, {"id": "B", "text": "B"}],
+                                    correct_id='A', tags=[TAGS[i % len(TAGS)], TAGS[(i + 1) % len(TAGS)]], mode='exam'))
+        db.session.commit()
+        service.init_new_user(user)
+
+    client = login(app)
+    client.post('/api/create_book', json={'name': 'S-root', 'parent': 'root'})
+    with app.app_context():
+        root = Notebook.query.filter_by(name='S-root').first().id
+    client.post('/api/create_book', json={'name': 'S-child', 'parent': root})
+    with app.app_context():
+        child = Notebook.query.filter_by(name='S-child').first().id
+    for qid in question_ids(n_questions):
+        client.post('/api/add_to_book', json={'book_id': child, 'q_id': qid})
+
+
+def login(app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    return client
+
+
+def worker(args):
+    """返回 (每题提交次数, 每题答错次数, 失败请求数)；只统计服务端确认成功的提交"""
+    seed_value, rounds, n_questions, batch_every = args
+    from app import app
+    client = login(app)
+    rnd = random.Random(seed_value)
+    qids = question_ids(n_questions)
+    attempts, errors, failed = Counter(), Counter(), 0
+    for r in range(rounds):
+        if batch_every and r % batch_every == batch_every - 1:
+            answers = [{"q_id": rnd.choice(qids), "choice": rnd.choice('AB'), "duration_ms": rnd.randint(500, 30000)}
+                       for _ in range(rnd.randint(2, 5))]
+            resp = client.post('/api/submit_batch', json={'answers': answers})
+            body = resp.get_json(silent=True) or {}
+            if resp.status_code != 200 or not body.get('success') or body.get('accepted') != len(answers):
+                failed += 1
+                continue
+            for a in answers:
+                attempts[a['q_id']] += 1
+                errors[a['q_id']] += a['choice'] != 'A'
+        else:
+            qid, choice = rnd.choice(qids), rnd.choice('AB')
+            resp = client.post('/api/submit', json={'q_id': qid, 'choice': choice})
+            if resp.status_code != 200:
+                failed += 1
+                continue
+            attempts[qid] += 1
+            errors[qid] += choice != 'A'
+    return attempts, errors, failed
+
+
+def verify(expected_attempts, expected_errors):
+    from app import app
+    from models import db, User, QuestionProgress, QuestionLog, NotebookRollup, UserStats, UserDailyActivity, DailyActivity
+    from question_service import service
+    problems = []
+    with app.app_context():
+        uid = User.query.filter_by(username=USERNAME).first().id
+
+        progress = {p.question_id: (p.attempts, p.errors) for p in QuestionProgress.query.filter_by(user_id=uid)}
+        logs = Counter(qid for qid, in db.session.query(QuestionLog.question_id).filter_by(user_id=uid))
+        for qid in sorted(set(expected_attempts) | set(progress)):
+            want = (expected_attempts[qid], expected_errors[qid])
+            if progress.get(qid, (0, 0)) != want:
+                problems.append(f"{qid}: attempts/errors {progress.get(qid)} != submitted {want}")
+            if logs[qid] != want[0]:
+                problems.append(f"{qid}: {logs[qid]} logs != {want[0]} submitted")
+
+        def snapshot():
+            db.session.expire_all()
+            rollups = {r.notebook_id: (r.direct_count, r.total_count, r.error_sum, r.proficiency_sum,
+                                       tuple(sorted(service._rollup_tags(r.notebook_id)))) for r in NotebookRollup.query}
+            s = db.session.get(UserStats, uid)
+            stats = (s.questions_done, s.proficiency_sum, s.current_streak, s.longest_streak, s.last_active_day, s.today_count) if s else None
+            daily = (sorted((a.user_id, a.day, a.answers, a.correct) for a in UserDailyActivity.query),
+                     sorted((d.day, d.active_users, d.answers, d.correct) for d in DailyActivity.query))
+            return rollups, stats, daily
+
+        live = snapshot()
+        service.rebuild_notebook_rollups()
+        service.rebuild_user_stats()
+        service.rebuild_daily_activity()
+        rebuilt = snapshot()
+        for label, a, b in zip(('notebook rollups', 'user stats', 'daily activity'), live, rebuilt):
+            if a != b:
+                problems.append(f"{label} drifted from rebuild:\n    live    {a}\n    rebuilt {b}")
+    return problems
+
+
+def run(workers, rounds, n_questions, batch_every):
+    seed(n_questions)
+    # spawn：每个进程重新导入 app，各自建立数据库连接 (同 gunicorn worker)
+    with mp.get_context('spawn').Pool(workers) as pool:
+        results = pool.map(worker, [(i, rounds, n_questions, batch_every) for i in range(workers)])
+    attempts, errors, failed = Counter(), Counter(), 0
+    for a, e, f in results:
+        attempts.update(a)
+        errors.update(e)
+        failed += f
+    print(f"{workers} workers x {rounds} rounds: {sum(attempts.values())} answers accepted, {failed} failed requests")
+    problems = verify(attempts, errors)
+    if failed:
+        problems.append(f"{failed} requests failed")
+    for p in problems:
+        print(f"❌ {p}")
+    return not problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent submit stress test with exact-count and rollup consistency checks")
+    parser.add_argument('--workers', type=int, default=4, help="concurrent processes (like gunicorn -w)")
+    parser.add_argument('--rounds', type=int, default=60, help="requests per process")
+    parser.add_argument('--questions', type=int, default=6, help="questions shared by all processes (fewer = more contention)")
+    parser.add_argument('--batch-every', type=int, default=5, help="every Nth request is a /api/submit_batch (0 = never)")
+    parser.add_argument('--immediate-writes', action='store_true', help="set SQLITE_IMMEDIATE_WRITES")
+    parser.add_argument('--read-pool', action='store_true', help="set SQLITE_READ_POOL")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # config.py 在导入 app 时读取环境变量，子进程 (spawn) 继承同样的设置
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'stress.db')}"
+        os.environ['QUESTION_LOG_WRITE_BEHIND'] = '0' # 日志同步落库，才能逐题核对条数
+        if args.immediate_writes: os.environ['SQLITE_IMMEDIATE_WRITES'] = '1'
+        if args.read_pool: os.environ['SQLITE_READ_POOL'] = '1'
+        ok = run(args.workers, args.rounds, args.questions, args.batch_every)
+    if not ok: sys.exit(1)
+    print("✅ Counts and rollups are consistent")
@@ -1,8 +1,17 @@
 from app import app
-from models import db
-import sqlite3
+from models import db, POSTGRES_INDEXES
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import JSONB
 import os
 
+def add_column(conn, table, column, ddl):
+    """表里还没有该列时补上 (先查表结构再 ALTER：PostgreSQL 上语句报错会中断整个事务，不能靠捕获异常跳过)"""
+    if column in {c['name'] for c in inspect(conn).get_columns(table)}:
+        print(f"ℹ️  Column '{table}.{column}' already exists.")
+        return
+    conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    print(f"✅ Added '{table}.{column}' column.")
+
 def update_database():
     print("🔄 Updating Database Schema...")
     
@@ -12,24 +21,86 @@ def update_database():
         os.makedirs(upload_path)
         print(f"📂 Created avatars folder: {upload_path}")
 
-    conn = sqlite3.connect(os.path.join('instance', 'physics.db'))
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN nickname VARCHAR(80)")
-        print("✅ Added 'nickname' column.")
-    except Exception as e:
-        print(f"ℹ️  Column 'nickname' might already exist: {e}")
-
-    # 确保 avatar 列存在（以防万一）
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN avatar VARCHAR(100) DEFAULT 'default.png'")
-        print("✅ Added 'avatar' column.")
-    except:
-        pass
-
-    conn.commit()
-    conn.close()
+    with app.app_context():
+        # 新增的数据表 (如 question_decks) 直接按模型创建，已存在的表不受影响；全新数据库下面的补列都会跳过
+        db.create_all()
+        print("✅ Created missing tables.")
+
+        # 旧表的补列/补索引走应用的数据库连接 (DATABASE_URL)，SQLite 与 PostgreSQL 通用
+        with db.engine.begin() as conn:
+            add_column(conn, 'users', 'nickname', "VARCHAR(80)")
+            add_column(conn, 'users', 'avatar', "VARCHAR(100) DEFAULT 'default.png'")
+
+            # 每日特训到期队列的复合索引
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_progress_due_queue "
+                "ON question_progress (user_id, next_review_time, errors, question_id)"
+            )
+            print("✅ Ensured index 'ix_progress_due_queue'.")
+
+            # 进度表唯一键：先把历史上并发写出的重复行合并到最新一行，再建唯一索引
+            conn.exec_driver_sql("""
+                UPDATE question_progress SET
+                    attempts = (SELECT SUM(p.attempts) FROM question_progress p
+                                WHERE p.user_id = question_progress.user_id AND p.question_id = question_progress.question_id),
+                    errors = (SELECT SUM(p.errors) FROM question_progress p
+                              WHERE p.user_id = question_progress.user_id AND p.question_id = question_progress.question_id)
+                WHERE id IN (SELECT MAX(id) FROM question_progress GROUP BY user_id, question_id HAVING COUNT(*) > 1)
+            """)
+            conn.exec_driver_sql("""
+                DELETE FROM question_progress
+                WHERE id NOT IN (SELECT MAX(id) FROM question_progress GROUP BY user_id, question_id)
+            """)
+            conn.exec_driver_sql(
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_progress_user_question "
+                "ON question_progress (user_id, question_id)"
+            )
+            print("✅ Ensured unique index 'uq_progress_user_question'.")
+
+            # 错题本 / 笔记的物化路径
+            for table in ('notebooks', 'notes'):
+                add_column(conn, table, 'path', "TEXT")
+                conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{table}_path ON {table} (path)")
+
+            # 分数排序键
+            for table in ('notes', 'notebooks', 'notebook_questions'):
+                add_column(conn, table, 'order_key', "VARCHAR(64)")
+            for table in ('notes', 'notebooks'):
+                conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{table}_sibling_order ON {table} (user_id, parent_id, order_key)")
+
+            # 笔记增量保存的版本号与内容哈希
+            add_column(conn, 'notes', 'version', "INTEGER NOT NULL DEFAULT 0")
+            add_column(conn, 'notes', 'content_hash', "VARCHAR(64)")
+
+            # 列表用的纯文本摘要 (正文列改为延迟加载)
+            add_column(conn, 'notes', 'preview', "VARCHAR(200) DEFAULT ''")
+            add_column(conn, 'questions', 'summary', "VARCHAR(200) DEFAULT ''")
+
+            if conn.dialect.name == 'postgresql':
+                # 旧库的 tags 是 json 类型，转成 jsonb 后才能建 GIN 索引
+                for table in ('questions', 'notebooks'):
+                    tags = next(c for c in inspect(conn).get_columns(table) if c['name'] == 'tags')
+                    if not isinstance(tags['type'], JSONB):
+                        conn.exec_driver_sql(f"ALTER TABLE {table} ALTER COLUMN tags TYPE jsonb USING tags::jsonb")
+                        print(f"✅ Converted '{table}.tags' to jsonb.")
+                for statements in POSTGRES_INDEXES.values():
+                    for statement in statements:
+                        conn.exec_driver_sql(statement)
+                print("✅ Ensured PostgreSQL GIN / pattern indexes.")
+
+        # 回填物化路径 (按 parent_id 全量计算，可重复执行)
+        from question_service import service
+        print(f"✅ Rebuilt paths for {service.rebuild_notebook_paths()} notebooks.")
+        print(f"✅ Rebuilt paths for {service.rebuild_note_paths()} notes.")
+        # 按现有顺序重新分配排序键 (没有键的按旧 order_index 回填，已有键的相对顺序不变)
+        print(f"✅ Backfilled order keys for {service.rebuild_order_keys()} notes/notebooks.")
+        print(f"✅ Indexed links for {service.backfill_note_links()} notes.")
+        print(f"✅ Indexed {service.rebuild_note_search()} notes for full-text search.")
+        print(f"✅ Generated previews for {service.backfill_previews()} notes/questions.")
+        # 错题本汇总 (含新的标签计数表 notebook_rollup_tags)
+        print(f"✅ Rebuilt rollups for {service.rebuild_notebook_rollups()} notebooks.")
+        print(f"✅ Rebuilt stats for {service.rebuild_user_stats()} users.")
+        print(f"✅ Rebuilt daily activity for {service.rebuild_daily_activity()} days.")
     print("🎉 Update complete!")
 
 if __name__ == '__main__':